@@ -2,9 +2,8 @@ import numpy as np
 
 from collections import defaultdict
 from ssdutils import jaccard_overlap
-from utils import Size, prop2abs
-
-IMG_SIZE = Size(1000, 1000)
+from detections import DETECTIONS_IMG_SIZE
+from geometry import boxes2props, props2corners
 
 #-------------------------------------------------------------------------------
 
@@ -47,23 +46,21 @@ class APCalculator:
         self.clear()
 
     #---------------------------------------------------------------------------
-    def add_detections(self, gt_boxes, boxes):
+    def add_detections(self, gt_boxes, detections):
         """
         Add new detections to the calculator.
-        :param gt_sample: ground truth sample
-        :param boxes:     a list of (float, Box) tuples representing
-                          detections and their confidences, the detections
-                          must have a correctly set label
+        :param gt_sample:  ground truth sample
+        :param detections: Detections of the sample
         """
 
         sample_id = len(self.gt_boxes)
         self.gt_boxes.append(gt_boxes)
 
-        for conf, box in boxes:
-            arr = np.array(prop2abs(box.center, box.size, IMG_SIZE))
-            self.det_params[box.label].append(arr)
-            self.det_confidence[box.label].append(conf)
-            self.det_sample_ids[box.label].append(sample_id)
+        self.det_params.append(detections.corners)
+        self.det_confidence.append(detections.scores)
+        self.det_labels.append(detections.labels)
+        self.det_sample_ids.append(np.full(len(detections), sample_id,
+                                           dtype=np.int64))
 
     #---------------------------------------------------------------------------
     def compute_aps(self):
@@ -76,20 +73,34 @@ class APCalculator:
         #-----------------------------------------------------------------------
         counts = defaultdict(lambda: 0)
         gt_map = defaultdict(dict)
+        names = {}
 
         for sample_id, boxes in enumerate(self.gt_boxes):
             boxes_by_class = defaultdict(list)
             for box in boxes:
-                counts[box.label] += 1
-                boxes_by_class[box.label].append(box)
+                counts[box.labelid] += 1
+                names[box.labelid] = box.label
+                boxes_by_class[box.labelid].append(box)
 
             for k, v in boxes_by_class.items():
-                arr = np.zeros((len(v), 4))
-                match = np.zeros((len(v)), dtype=np.bool)
-                for i, box in enumerate(v):
-                    arr[i] = np.array(prop2abs(box.center, box.size, IMG_SIZE))
+                arr = props2corners(boxes2props(v), DETECTIONS_IMG_SIZE)
+                match = np.zeros((len(v)), dtype=bool)
                 gt_map[k][sample_id] = (arr, match)
 
+        #-----------------------------------------------------------------------
+        # Put all the detections together
+        #-----------------------------------------------------------------------
+        if self.det_params:
+            det_params = np.concatenate(self.det_params)
+            det_confidence = np.concatenate(self.det_confidence)
+            det_labels = np.concatenate(self.det_labels)
+            det_sample_ids = np.concatenate(self.det_sample_ids)
+        else:
+            det_params = np.zeros((0, 4))
+            det_confidence = np.zeros(0)
+            det_labels = np.zeros(0, dtype=np.int64)
+            det_sample_ids = np.zeros(0, dtype=np.int64)
+
         #-----------------------------------------------------------------------
         # Compare predictions to ground truth
         #-----------------------------------------------------------------------
@@ -99,9 +110,10 @@ class APCalculator:
             # Create numpy arrays of detection parameters and sort them
             # in descending order
             #-------------------------------------------------------------------
-            params = np.array(self.det_params[k], dtype=np.float32)
-            confs = np.array(self.det_confidence[k], dtype=np.float32)
-            sample_ids = np.array(self.det_sample_ids[k], dtype=np.int)
+            in_class = det_labels == k
+            params = det_params[in_class].astype(np.float32)
+            confs = det_confidence[in_class].astype(np.float32)
+            sample_ids = det_sample_ids[in_class]
             idxs_max = np.argsort(-confs)
             params = params[idxs_max]
             confs = confs[idxs_max]
@@ -161,7 +173,7 @@ class APCalculator:
                     ap += np.amax(prec_rec)
 
             ap /= 11.
-            aps[k] = ap
+            aps[names[k]] = ap
 
         return aps
 
@@ -171,7 +183,8 @@ class APCalculator:
         Clear the current detection cache. Useful for restarting the calculation
         for a new batch of data.
         """
-        self.det_params = defaultdict(list)
-        self.det_confidence = defaultdict(list)
-        self.det_sample_ids = defaultdict(list)
+        self.det_params = []
+        self.det_confidence = []
+        self.det_labels = []
+        self.det_sample_ids = []
         self.gt_boxes = []
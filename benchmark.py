@@ -0,0 +1,425 @@
+import argparse
+import platform
+import tracemalloc
+import random
+import json
+import time
+import sys
+
+import numpy as np
+import cv2
+
+from ssdutils import get_preset_by_name, get_anchor_table, build_anchor_table
+from ssdutils import get_anchors_for_preset, compute_overlap, AnchorIndex
+from ssdutils import decode_boxes, suppress_overlaps, non_maximum_suppression
+from ssdutils import batched_nms
+from transforms import LabelCreatorTransform, PhotometricDistortTransform
+from utils import Size, Point, Sample, Box, prop2abs
+from collections import OrderedDict
+
+#-------------------------------------------------------------------------------
+# Synthetic inputs
+#-------------------------------------------------------------------------------
+
+
+def make_boxes(rng, num_boxes, num_classes):
+    """
+    Make a list of random ground truth boxes lying within the image
+    """
+    boxes = []
+    for _ in range(num_boxes):
+        w, h = rng.uniform(0.05, 0.6, 2)
+        cx = rng.uniform(w/2, 1-w/2)
+        cy = rng.uniform(h/2, 1-h/2)
+        labelid = int(rng.randint(num_classes))
+        boxes.append(Box(str(labelid), labelid, Point(cx, cy), Size(w, h)))
+    return boxes
+
+#-------------------------------------------------------------------------------
+
+
+def make_predictions(rng, preset, num_classes, batch_size, density):
+    """
+    Make a batch of raw network predictions in which the given fraction of
+    anchors has an object confidence above 0.5. The remaining anchors are
+    spread over the lower confidences so that a low threshold lets more of
+    them through, the way it happens in practice.
+    """
+    num_anchors = preset.num_anchors
+    pred = np.zeros((batch_size, num_anchors, num_classes+5), dtype=np.float32)
+    scores = rng.uniform(0, 0.5, (batch_size, num_anchors))**4
+    hits = rng.uniform(size=(batch_size, num_anchors)) < density
+    scores[hits] = rng.uniform(0.5, 1, np.count_nonzero(hits))
+    labels = rng.randint(num_classes, size=(batch_size, num_anchors))
+    img_ids, anchor_ids = np.indices((batch_size, num_anchors))
+    pred[img_ids, anchor_ids, labels] = scores
+    pred[:, :, num_classes] = 1-scores
+    pred[:, :, num_classes+1:] = rng.normal(0, 1, (batch_size, num_anchors, 4))
+    return pred
+
+#-------------------------------------------------------------------------------
+# Benchmark cases. Every case function yields (params, fn) tuples where fn
+# is a callable running the code path once.
+#-------------------------------------------------------------------------------
+
+
+def case_anchors(rng, preset, args):
+    yield OrderedDict(impl='list'), lambda: get_anchors_for_preset(preset)
+    yield OrderedDict(impl='table'), lambda: build_anchor_table(preset)
+
+#-------------------------------------------------------------------------------
+
+
+def case_compute_overlap(rng, preset, args):
+    table = get_anchor_table(preset)
+    index = AnchorIndex(preset, table)
+    img_size = Size(1000, 1000)
+    box = make_boxes(rng, 1, args.num_classes)[0]
+    box_arr = np.array(prop2abs(box.center, box.size, img_size))
+    yield (OrderedDict(impl='dense'),
+           lambda: compute_overlap(box_arr, table.corners, 0.5))
+    yield (OrderedDict(impl='index'),
+           lambda: index.compute_overlap(box_arr, 0.5))
+
+#-------------------------------------------------------------------------------
+
+
+def case_label_creator(rng, preset, args):
+    for matching in ['dense', 'index']:
+        label_creator = LabelCreatorTransform(preset=preset,
+                                              num_classes=args.num_classes,
+                                              matching=matching)
+        for num_boxes in args.box_counts:
+            gt = Sample('synthetic', make_boxes(rng, num_boxes,
+                                                args.num_classes),
+                        preset.image_size)
+            params = OrderedDict(matching=matching, boxes=num_boxes)
+            yield params, lambda l=label_creator, gt=gt: l(None, None, gt)
+
+#-------------------------------------------------------------------------------
+
+
+def case_decode_boxes(rng, preset, args):
+    anchors = get_anchor_table(preset).prop
+    for density in args.densities:
+        pred = make_predictions(rng, preset, args.num_classes,
+                                args.batch_size, density)
+        for threshold in [0.01, 0.5]:
+            params = OrderedDict(density=density, threshold=threshold)
+            yield params, lambda p=pred, t=threshold: \
+                decode_boxes(p, anchors, t)
+
+#-------------------------------------------------------------------------------
+
+
+def case_nms(rng, preset, args):
+    anchors = get_anchor_table(preset).prop
+    for density in args.densities:
+        pred = make_predictions(rng, preset, args.num_classes,
+                                args.batch_size, density)
+        for threshold in [0.01, 0.5]:
+            detections = decode_boxes(pred, anchors, threshold)
+            params = OrderedDict(density=density, threshold=threshold,
+                                 detections=len(detections))
+            yield (OrderedDict(params, per_class=True),
+                   lambda d=detections: suppress_overlaps(d, 0.45))
+            yield (OrderedDict(params, per_class=False),
+                   lambda d=detections: non_maximum_suppression(d, 0.45))
+
+#-------------------------------------------------------------------------------
+
+
+def case_photometric(rng, preset, args):
+    """
+    Resize a batch of HD frames and distort their colors: every full size
+    image before the resize, every resized image, or the whole resized
+    batch at once
+    """
+    distort = PhotometricDistortTransform(brightness_prob=0.5,
+                                          brightness_delta=32,
+                                          contrast_prob=0.5,
+                                          contrast_lower=0.5,
+                                          contrast_upper=1.5,
+                                          hue_prob=0.5,
+                                          hue_delta=18,
+                                          saturation_prob=0.5,
+                                          saturation_lower=0.5,
+                                          saturation_upper=1.5,
+                                          reorder_prob=0.5)
+    size = (preset.image_size.w, preset.image_size.h)
+    images = [rng.randint(0, 256, (1080, 1920, 3)).astype(np.uint8)
+              for _ in range(args.batch_size)]
+
+    def per_image():
+        return np.array([cv2.resize(distort(img, None, None)[0], size)
+                         for img in images])
+
+    def resized_image():
+        return np.array([distort(cv2.resize(img, size), None, None)[0]
+                         for img in images])
+
+    def batch():
+        return distort.distort_batch(np.array([cv2.resize(img, size)
+                                               for img in images]))
+
+    yield OrderedDict(placement='image'), per_image
+    yield OrderedDict(placement='resized-image'), resized_image
+    yield OrderedDict(placement='batch'), batch
+
+#-------------------------------------------------------------------------------
+CASES = OrderedDict([
+    ('anchors', case_anchors),
+    ('compute_overlap', case_compute_overlap),
+    ('label_creator', case_label_creator),
+    ('decode_boxes', case_decode_boxes),
+    ('nms', case_nms),
+    ('photometric', case_photometric)
+])
+
+#-------------------------------------------------------------------------------
+# Correctness checks, run with --check instead of the benchmark. Every check
+# function raises a RuntimeError if the check fails.
+#-------------------------------------------------------------------------------
+
+
+def check_nms_non_finite(rng, preset, args):
+    """
+    Make sure that a detection with non-finite params only gets itself
+    dropped and doesn't change what's picked out of the others
+    """
+    anchors = get_anchor_table(preset).prop
+    for density in args.densities:
+        pred = make_predictions(rng, preset, args.num_classes,
+                                args.batch_size, density)
+        detections = decode_boxes(pred, anchors, 0.01)
+        if not len(detections):
+            continue
+
+        boxes = np.vstack([detections.corners, [[np.nan, 1, 2, 3]]])
+        scores = np.r_[detections.scores, 1]
+        labels = np.r_[detections.labels, detections.labels.max()+1]
+        image_ids = np.r_[detections.image_ids, 0]
+        expected = batched_nms(detections.corners, detections.scores,
+                               detections.labels, 0.45, detections.image_ids)
+        pick = batched_nms(boxes, scores, labels, 0.45, image_ids)
+        if not np.array_equal(np.sort(pick), np.sort(expected)):
+            raise RuntimeError('a non-finite detection changed the NMS '
+                               'result at density {}'.format(density))
+
+#-------------------------------------------------------------------------------
+CHECKS = OrderedDict([
+    ('nms_non_finite', check_nms_non_finite)
+])
+
+#-------------------------------------------------------------------------------
+# Measurement
+#-------------------------------------------------------------------------------
+
+
+def measure(fn, repeats, warmup, min_time):
+    """
+    Time the calls of fn and trace the memory allocated by a single call.
+    :param repeats:  minimum number of timed calls
+    :param min_time: minimum total time of the timed calls in seconds
+    :return: a dictionary of latency percentiles in microseconds and
+             allocation stats
+    """
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    start = time.perf_counter()
+    while len(times) < repeats or time.perf_counter()-start < min_time:
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter()-t0)
+    times = np.array(times)*1e6
+
+    #---------------------------------------------------------------------------
+    # Tracing slows everything down, so it's done in a separate call
+    #---------------------------------------------------------------------------
+    tracemalloc.start()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    stats = tracemalloc.take_snapshot().compare_to(snapshot, 'lineno')
+    tracemalloc.stop()
+
+    result = OrderedDict()
+    result['calls'] = len(times)
+    result['mean_us'] = float(times.mean())
+    for p in [50, 90, 99]:
+        result['p{}_us'.format(p)] = float(np.percentile(times, p))
+    result['min_us'] = float(times.min())
+    result['alloc_peak_bytes'] = int(peak)
+    result['alloc_blocks'] = int(sum(max(s.count_diff, 0) for s in stats))
+    return result
+
+#-------------------------------------------------------------------------------
+
+
+def case_key(result):
+    params = ','.join('{}={}'.format(k, v) for k, v in result['params'].items())
+    return '{}/{}[{}]'.format(result['case'], result['preset'], params)
+
+#-------------------------------------------------------------------------------
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare the median latencies with the baseline and print the report
+    :return: the number of cases slower than the baseline by more than the
+             tolerance
+    """
+    baseline = {case_key(r): r for r in baseline['results']}
+    regressions = 0
+    print('[i] Comparison with the baseline (p50):')
+    for result in results:
+        key = case_key(result)
+        if key not in baseline:
+            print('    {:60} new'.format(key))
+            continue
+        ratio = result['p50_us']/baseline[key]['p50_us']
+        flag = ''
+        if ratio > 1+tolerance:
+            flag = ' [!] regression'
+            regressions += 1
+        elif ratio < 1-tolerance:
+            flag = ' improvement'
+        print('    {:60} {:6.2f}x{}'.format(key, ratio, flag))
+    return regressions
+
+#-------------------------------------------------------------------------------
+
+
+def main():
+    #---------------------------------------------------------------------------
+    # Parse the commandline
+    #---------------------------------------------------------------------------
+    parser = argparse.ArgumentParser(description='Benchmark the SSD utilities')
+    parser.add_argument('--cases', nargs='+', default=list(CASES.keys()),
+                        choices=list(CASES.keys()), help='cases to run')
+    parser.add_argument('--presets', nargs='+', default=['vgg300', 'vgg512'],
+                        help='SSD presets')
+    parser.add_argument('--num-classes', type=int, default=20,
+                        help='number of object classes')
+    parser.add_argument('--box-counts', type=int, nargs='+',
+                        default=[1, 4, 16], help='ground truth boxes per image')
+    parser.add_argument('--densities', type=float, nargs='+',
+                        default=[0.001, 0.01, 0.05],
+                        help='fractions of confident anchors in predictions')
+    parser.add_argument('--batch-size', type=int, default=8,
+                        help='batch size of the predictions')
+    parser.add_argument('--repeats', type=int, default=20,
+                        help='minimum number of timed calls per case')
+    parser.add_argument('--warmup', type=int, default=2,
+                        help='number of untimed calls per case')
+    parser.add_argument('--min-time', type=float, default=0.5,
+                        help='minimum timing duration per case in seconds')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='random seed of the synthetic inputs')
+    parser.add_argument('--output', default=None,
+                        help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=None,
+                        help='compare the results with this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative slowdown reported as a regression')
+    parser.add_argument('--check', action='store_true',
+                        help='run the correctness checks instead of the '
+                             'benchmark')
+    args = parser.parse_args()
+
+    #---------------------------------------------------------------------------
+    # Run the correctness checks
+    #---------------------------------------------------------------------------
+    if args.check:
+        failed = False
+        for preset_name in args.presets:
+            try:
+                preset = get_preset_by_name(preset_name)
+            except RuntimeError as e:
+                print('[!]', str(e))
+                return 1
+
+            for name, check in CHECKS.items():
+                rng = np.random.RandomState(args.seed)
+                random.seed(args.seed)
+                try:
+                    check(rng, preset, args)
+                    print('[i] {}/{}: ok'.format(name, preset_name))
+                except RuntimeError as e:
+                    print('[!] {}/{}: {}'.format(name, preset_name, str(e)))
+                    failed = True
+        return 1 if failed else 0
+
+    #---------------------------------------------------------------------------
+    # Print parameters
+    #---------------------------------------------------------------------------
+    print('[i] Cases:       ', ', '.join(args.cases))
+    print('[i] Presets:     ', ', '.join(args.presets))
+    print('[i] Num classes: ', args.num_classes)
+    print('[i] Box counts:  ', args.box_counts)
+    print('[i] Densities:   ', args.densities)
+    print('[i] Batch size:  ', args.batch_size)
+    print('[i] Repeats:     ', args.repeats)
+    print('[i] Seed:        ', args.seed)
+    print('[i] Output:      ', args.output)
+    print('[i] Baseline:    ', args.baseline)
+
+    #---------------------------------------------------------------------------
+    # Run the cases
+    #---------------------------------------------------------------------------
+    results = []
+    for preset_name in args.presets:
+        try:
+            preset = get_preset_by_name(preset_name)
+        except RuntimeError as e:
+            print('[!]', str(e))
+            return 1
+
+        for case in args.cases:
+            rng = np.random.RandomState(args.seed)
+            random.seed(args.seed)
+            for params, fn in CASES[case](rng, preset, args):
+                result = OrderedDict(case=case, preset=preset_name,
+                                     params=params)
+                result.update(measure(fn, args.repeats, args.warmup,
+                                      args.min_time))
+                results.append(result)
+                print('[i] {:60} p50 {:10.1f}us p90 {:10.1f}us '
+                      'p99 {:10.1f}us {:8d} blocks {:10d} B'
+                      .format(case_key(result), result['p50_us'],
+                              result['p90_us'], result['p99_us'],
+                              result['alloc_blocks'],
+                              result['alloc_peak_bytes']))
+
+    #---------------------------------------------------------------------------
+    # Store the results and compare them with the baseline
+    #---------------------------------------------------------------------------
+    meta = OrderedDict(python=platform.python_version(),
+                       numpy=np.__version__, opencv=cv2.__version__,
+                       machine=platform.machine(),
+                       timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       seed=args.seed, batch_size=args.batch_size,
+                       num_classes=args.num_classes)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict(meta=meta, results=results), f, indent=2)
+        print('[i] Results written to:', args.output)
+
+    if args.baseline is not None:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except (IOError, ValueError) as e:
+            print('[!] Unable to load the baseline:', str(e))
+            return 1
+        if compare(results, baseline, args.tolerance):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,94 +1,74 @@
-import Queue as q
+import queue as q
 import numpy as np
 import multiprocessing as mp
 
+from multiprocessing import shared_memory
+
 #-------------------------------------------------------------------------------
 
 
 class DataQueue:
+    """
+    A ring of image batch slots in one shared memory block. A slot gets
+    leased, the batch is written directly into it by whichever process
+    holds a view of it, and the slot goes back to the ring when it's
+    released. Passing the batches on, with their labels and boxes, is up to
+    the user of the ring, see WorkerPool.
+    """
     #---------------------------------------------------------------------------
-    def __init__(self, img_template, label_template, maxsize):
+    def __init__(self, img_template, maxsize):
         #-----------------------------------------------------------------------
-        # Figure out the data tupes, sizes and shapes of both arrays
+        # Figure out the data type, size and shape of the slots
         #-----------------------------------------------------------------------
         self.img_dtype = img_template.dtype
         self.img_shape = img_template.shape
-        self.img_bc = len(img_template.tobytes())
-        self.label_dtype = label_template.dtype
-        self.label_shape = label_template.shape
-        self.label_bc = len(label_template.tobytes())
+        self.img_bc = img_template.nbytes
 
         #-----------------------------------------------------------------------
-        # Make an array pool and queue
+        # Make the ring and the queue of the free slots
         #-----------------------------------------------------------------------
-        self.array_pool = []
-        self.array_queue = mp.Queue(maxsize)
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=self.img_bc*maxsize)
+        self.slots = []
+        self.free_queue = mp.Queue(maxsize)
         for i in range(maxsize):
-            img_buff = mp.Array('c', self.img_bc, lock=False)
-            img_arr = np.frombuffer(img_buff, dtype=self.img_dtype)
-            img_arr = img_arr.reshape(self.img_shape)
-
-            label_buff = mp.Array('c', self.label_bc, lock=False)
-            label_arr = np.frombuffer(label_buff, dtype=self.label_dtype)
-            label_arr = label_arr.reshape(self.label_shape)
-
-            self.array_pool.append((img_arr, label_arr))
-            self.array_queue.put(i)
-
-        self.queue = mp.Queue(maxsize)
+            slot = np.ndarray(self.img_shape, dtype=self.img_dtype,
+                              buffer=self.shm.buf, offset=i*self.img_bc)
+            self.slots.append(slot)
+            self.free_queue.put(i)
 
     #---------------------------------------------------------------------------
-    def put(self, img, label, boxes, *args, **kwargs):
-        #-----------------------------------------------------------------------
-        # Check whether the params are consistent with the data we can store
-        #-----------------------------------------------------------------------
-        def check_consistency(name, arr, dtype, shape, byte_count):
-            if type(arr) is not np.ndarray:
-                raise ValueError(name + ' needs to be a numpy array')
-            if arr.dtype != dtype:
-                raise ValueError('{}\'s elements need to be of type {} but is {}'
-                                 .format(name, str(dtype), str(arr.dtype)))
-            if arr.shape != shape:
-                raise ValueError('{}\'s shape needs to be {} but is {}'
-                                 .format(name, shape, arr.shape))
-            if len(arr.tobytes()) != byte_count:
-                raise ValueError('{}\'s byte count needs to be {} but is {}'
-                                 .format(name, byte_count, len(arr.data)))
-
-        check_consistency('img', img, self.img_dtype, self.img_shape,
-                          self.img_bc)
-        check_consistency('label', label, self.label_dtype, self.label_shape,
-                          self.label_bc)
-
+    def lease(self, *args, **kwargs):
+        """
+        Get a free slot to write a batch into
+        :return: a tuple of the slot id and the slot array
+        """
         #-----------------------------------------------------------------------
         # If we can not get the slot within timeout we are actually full, not
         # empty
         #-----------------------------------------------------------------------
         try:
-            arr_id = self.array_queue.get(*args, **kwargs)
+            slot_id = self.free_queue.get(*args, **kwargs)
         except q.Empty:
             raise q.Full()
-
-        #-----------------------------------------------------------------------
-        # Copy the arrays into the shared pool
-        #-----------------------------------------------------------------------
-        self.array_pool[arr_id][0][:] = img
-        self.array_pool[arr_id][1][:] = label
-        self.queue.put((arr_id, boxes), *args, **kwargs)
+        return slot_id, self.slots[slot_id]
 
     #---------------------------------------------------------------------------
-    def get(self, *args, **kwargs):
-        item = self.queue.get(*args, **kwargs)
-        arr_id = item[0]
-        boxes = item[1]
-
-        img = np.copy(self.array_pool[arr_id][0])
-        label = np.copy(self.array_pool[arr_id][1])
-
-        self.array_queue.put(arr_id)
-
-        return img, label, boxes
+    def release(self, slot_id):
+        """
+        Give a leased slot back to the ring
+        """
+        self.free_queue.put(slot_id)
 
     #---------------------------------------------------------------------------
-    def empty(self):
-        return self.queue.empty()
+    def close(self):
+        """
+        Free the shared memory. The block stays mapped as long as the views
+        of the slots are still around.
+        """
+        self.slots = []
+        self.shm.unlink()
+        try:
+            self.shm.close()
+        except BufferError:
+            pass
@@ -6,8 +6,9 @@ import sys
 import cv2
 import os
 
-from ssdutils import get_anchors_for_preset, decode_boxes, suppress_overlaps
-from utils import draw_box
+from ssdutils import get_anchor_table
+from ssdutils import decode_boxes, suppress_overlaps
+from utils import draw_detections
 from tqdm import tqdm
 
 #-------------------------------------------------------------------------------
@@ -52,7 +53,8 @@ def main():
         preset = data['preset']
         colors = data['colors']
         lid2name = data['lid2name']
-        anchors = get_anchors_for_preset(preset)
+        anchors = get_anchor_table(preset,
+                                   os.path.dirname(args.training_data)).prop
 
     #---------------------------------------------------------------------------
     # Create the output directory
@@ -84,18 +86,19 @@ def main():
             feed = {img_input: batch}
             enc_boxes = sess.run(result, feed_dict=feed)
 
-            for i in range(len(batch_names)):
-                boxes = decode_boxes(enc_boxes[i], anchors, 0.5, lid2name, None)
-                boxes = suppress_overlaps(boxes)[:200]
+            detections = decode_boxes(enc_boxes, anchors, 0.5, None)
+            detections = suppress_overlaps(detections, max_detections=200)
+            detections = detections.split(len(batch_names))
+            for i, boxes in enumerate(detections):
                 name = os.path.basename(batch_names[i])
+                draw_detections(batch_imgs[i], boxes, colors, lid2name)
 
                 with open(os.path.join(args.output_dir, name+'.txt'), 'w') as f:
-                    for box in boxes:
-                        draw_box(batch_imgs[i], box[1], colors[box[1].label])
-
-                        box_data = '{} {} {} {} {} {}\n'.format(box[1].label,
-                                                                box[1].labelid, box[1].center.x, box[1].center.y,
-                                                                box[1].size.w, box[1].size.h)
+                    names = boxes.label_names(lid2name)
+                    for j, label in enumerate(names):
+                        box_data = '{} {} {} {} {} {}\n'.format(label,
+                                                                boxes.labels[j], boxes.boxes[j, 0], boxes.boxes[j, 1],
+                                                                boxes.boxes[j, 2], boxes.boxes[j, 3])
                         f.write(box_data)
 
                 cv2.imwrite(os.path.join(args.output_dir, name),
@@ -0,0 +1,110 @@
+import numpy as np
+
+from utils import Size, Point, Box
+from geometry import props2corners
+
+#-------------------------------------------------------------------------------
+# The reference frame of the absolute corner params
+#-------------------------------------------------------------------------------
+DETECTIONS_IMG_SIZE = Size(1000, 1000)
+
+#-------------------------------------------------------------------------------
+
+
+class Detections:
+    """
+    A set of detections, possibly coming from many images, stored as numpy
+    arrays:
+     * boxes     - (N, 4) proportional [cx, cy, w, h] params
+     * corners   - (N, 4) absolute [xmin, xmax, ymin, ymax] params in the
+                   1000x1000 reference frame
+     * scores    - (N) confidences
+     * labels    - (N) class ids
+     * image_ids - (N) ids of the images the detections come from
+    The per-image operations assume that the detections are grouped by image,
+    which is how decode_boxes produces them.
+    """
+    __slots__ = ['boxes', 'corners', 'scores', 'labels', 'image_ids']
+
+    #---------------------------------------------------------------------------
+    def __init__(self, boxes, scores, labels, image_ids=None, corners=None):
+        self.boxes = boxes
+        self.scores = scores
+        self.labels = labels
+        if image_ids is None:
+            image_ids = np.zeros(len(scores), dtype=np.int64)
+        self.image_ids = image_ids
+        if corners is None:
+            corners = props2corners(boxes, DETECTIONS_IMG_SIZE)
+        self.corners = corners
+
+    #---------------------------------------------------------------------------
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros((0, 4)), np.zeros(0, dtype=np.float32),
+                   np.zeros(0, dtype=np.int64))
+
+    #---------------------------------------------------------------------------
+    @classmethod
+    def concatenate(cls, detections):
+        """
+        Concatenate a list of detections into one object
+        """
+        if not detections:
+            return cls.empty()
+        return cls(np.concatenate([d.boxes for d in detections]),
+                   np.concatenate([d.scores for d in detections]),
+                   np.concatenate([d.labels for d in detections]),
+                   np.concatenate([d.image_ids for d in detections]),
+                   np.concatenate([d.corners for d in detections]))
+
+    #---------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.scores)
+
+    #---------------------------------------------------------------------------
+    def __getitem__(self, idx):
+        """
+        Select detections using a slice, an index array or a boolean mask;
+        slices give views of the underlying arrays
+        """
+        if isinstance(idx, (int, np.integer)):
+            idx = slice(idx, idx+1 if idx != -1 else None)
+        return Detections(self.boxes[idx], self.scores[idx], self.labels[idx],
+                          self.image_ids[idx], self.corners[idx])
+
+    #---------------------------------------------------------------------------
+    def split(self, num_images):
+        """
+        Split the detections into per-image views
+        """
+        bounds = np.searchsorted(self.image_ids, np.arange(num_images+1))
+        return [self[bounds[i]:bounds[i+1]] for i in range(num_images)]
+
+    #---------------------------------------------------------------------------
+    def abs_corners(self, img_size):
+        """
+        Compute the integer [xmin, xmax, ymin, ymax] params of the boxes in an
+        image of the given size
+        """
+        return props2corners(self.boxes, img_size).astype(np.int64)
+
+    #---------------------------------------------------------------------------
+    def label_names(self, lid2name):
+        """
+        Translate the class ids to names; None if the id is unknown
+        """
+        return [lid2name.get(int(lid)) for lid in self.labels]
+
+    #---------------------------------------------------------------------------
+    def to_boxes(self, lid2name={}):
+        """
+        Convert the detections to a list of (confidence, Box) tuples
+        """
+        boxes = []
+        for i, name in enumerate(self.label_names(lid2name)):
+            center = Point(self.boxes[i, 0], self.boxes[i, 1])
+            size = Size(self.boxes[i, 2], self.boxes[i, 3])
+            box = Box(name, int(self.labels[i]), center, size)
+            boxes.append((self.scores[i], box))
+        return boxes
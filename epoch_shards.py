@@ -0,0 +1,201 @@
+import pickle
+import random
+import math
+import os
+
+import multiprocessing as mp
+import numpy as np
+
+from transform_compiler import compile_transforms
+from transforms import run_steps
+
+#-------------------------------------------------------------------------------
+# Augmented training epochs materialized on disk. Every epoch is a directory
+# of shards and every shard is a pair of files:
+#  * shard-NNNNN-images.npy - an (N, H, W, 3) uint8 array of the images
+#  * shard-NNNNN-gt.pkl     - a list of the N transformed ground truth samples
+# The samples of an epoch are shuffled and every sample is augmented with
+# its own seed, so any shard can be regenerated on its own.
+#-------------------------------------------------------------------------------
+
+# the state of the shard writers, set before forking them
+writer_state = {}
+
+#-------------------------------------------------------------------------------
+
+
+def sample_seed(seed, epoch, index):
+    return '{}-{}-{}'.format(seed, epoch, index)
+
+#-------------------------------------------------------------------------------
+
+
+def epoch_order(seed, epoch, num_samples):
+    order = list(range(num_samples))
+    random.Random(sample_seed(seed, epoch, 'order')).shuffle(order)
+    return order
+
+#-------------------------------------------------------------------------------
+
+
+def shard_path(shards_dir, epoch, shard, kind):
+    return '{}/epoch-{:04d}/shard-{:05d}-{}'.format(shards_dir, epoch, shard,
+                                                    kind)
+
+#-------------------------------------------------------------------------------
+
+
+def write_shard(task):
+    """
+    Augment the samples of a shard and write it to disk
+    :param task: a tuple of (epoch, shard, sample indices)
+    :return: the number of samples written
+    """
+    epoch, shard, indices = task
+    compiled = writer_state['compiled']
+    samples = writer_state['samples']
+    seed = writer_state['seed']
+    batch_distort = writer_state['batch-distort']
+
+    images = []
+    gts = []
+    for index in indices:
+        random.seed(sample_seed(seed, epoch, index))
+        label, gt, steps = compiled.prepare_matched(None, samples[index])
+        image = run_steps(steps, None)
+        if batch_distort is not None:
+            image = batch_distort.distort_batch(image[None])[0]
+        images.append(np.clip(image, 0, 255).astype(np.uint8))
+        gts.append(gt)
+
+    shards_dir = writer_state['shards-dir']
+    np.save(shard_path(shards_dir, epoch, shard, 'images.npy'),
+            np.array(images))
+    with open(shard_path(shards_dir, epoch, shard, 'gt.pkl'), 'wb') as f:
+        pickle.dump(gts, f)
+    return len(indices)
+
+#-------------------------------------------------------------------------------
+
+
+def write_epoch_shards(shards_dir, transforms, samples, num_epochs,
+                       shard_size, seed, preset, batch_distort=None,
+                       num_workers=0, progress=None):
+    """
+    Generate the augmented epochs
+    :param transforms:    the training transforms
+    :param samples:       the training samples
+    :param batch_distort: the photometric distortion to apply to every image
+                          if the transforms don't do it, see
+                          PhotometricDistortTransform.distort_batch
+    :param progress:      a function called with the number of samples
+                          written after every shard
+    """
+    num_shards = int(math.ceil(len(samples)/float(shard_size)))
+    tasks = []
+    for epoch in range(num_epochs):
+        path = '{}/epoch-{:04d}'.format(shards_dir, epoch)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        order = epoch_order(seed, epoch, len(samples))
+        for shard in range(num_shards):
+            indices = order[shard*shard_size:(shard+1)*shard_size]
+            tasks.append((epoch, shard, indices))
+
+    writer_state['compiled'] = compile_transforms(transforms)
+    writer_state['samples'] = samples
+    writer_state['seed'] = seed
+    writer_state['batch-distort'] = batch_distort
+    writer_state['shards-dir'] = shards_dir
+
+    if num_workers > 0:
+        pool = mp.Pool(num_workers)
+        results = pool.imap_unordered(write_shard, tasks)
+    else:
+        results = map(write_shard, tasks)
+
+    for num_written in results:
+        if progress is not None:
+            progress(num_written)
+
+    if num_workers > 0:
+        pool.close()
+        pool.join()
+
+    #---------------------------------------------------------------------------
+    # Write the info file last, so that it only exists for complete shards
+    #---------------------------------------------------------------------------
+    info = {
+        'num-epochs': num_epochs,
+        'num-shards': num_shards,
+        'num-samples': len(samples),
+        'seed': seed,
+        'image-size': preset.image_size
+    }
+    with open(shards_dir+'/info.pkl', 'wb') as f:
+        pickle.dump(info, f)
+
+#-------------------------------------------------------------------------------
+
+
+class EpochShards:
+    """
+    Read the materialized epochs, one after another and starting over after
+    the last one
+    """
+
+    #---------------------------------------------------------------------------
+    def __init__(self, shards_dir, start_epoch=0):
+        """
+        :param start_epoch: the training epoch to start at, eg. when
+                            resuming the training
+        """
+        try:
+            with open(shards_dir+'/info.pkl', 'rb') as f:
+                info = pickle.load(f)
+        except (FileNotFoundError, IOError) as e:
+            raise RuntimeError(str(e))
+
+        self.shards_dir = shards_dir
+        self.num_epochs = info['num-epochs']
+        self.num_shards = info['num-shards']
+        self.num_samples = info['num-samples']
+        self.image_size = info['image-size']
+        self.epoch = start_epoch % self.num_epochs
+
+    #---------------------------------------------------------------------------
+    def read_epoch(self, batch_size):
+        """
+        Read the next epoch
+        :return: a generator of (images, gts) tuples, where the images are
+                 a uint8 array of the batch and the gts are the ground truth
+                 samples
+        """
+        epoch = self.epoch
+        self.epoch = (self.epoch+1) % self.num_epochs
+
+        images = []
+        gts = []
+        num_items = 0
+        for shard in range(self.num_shards):
+            path = shard_path(self.shards_dir, epoch, shard, 'images.npy')
+            shard_images = np.load(path, mmap_mode='r')
+            path = shard_path(self.shards_dir, epoch, shard, 'gt.pkl')
+            with open(path, 'rb') as f:
+                shard_gts = pickle.load(f)
+
+            offset = 0
+            while offset < len(shard_gts):
+                count = min(batch_size-num_items, len(shard_gts)-offset)
+                images.append(shard_images[offset:offset+count])
+                gts += shard_gts[offset:offset+count]
+                num_items += count
+                offset += count
+                if num_items == batch_size:
+                    yield np.concatenate(images), gts
+                    images = []
+                    gts = []
+                    num_items = 0
+
+        if num_items:
+            yield np.concatenate(images), gts
@@ -0,0 +1,158 @@
+import numpy as np
+
+from collections import namedtuple
+
+#-------------------------------------------------------------------------------
+# Box geometry on arrays of boxes. Two forms of box params are used:
+#  * props   - (N, 4) proportional center-size [cx, cy, w, h] params
+#  * corners - (N, 4) absolute min-max [xmin, xmax, ymin, ymax] params
+# The image sizes are objects with w and h attributes, ie. utils.Size.
+#-------------------------------------------------------------------------------
+RefSize = namedtuple('RefSize', ['w', 'h'])
+
+# the reference frame used for normalizing boxes
+NORMALIZE_SIZE = RefSize(1000, 1000)
+
+#-------------------------------------------------------------------------------
+
+
+def boxes2props(boxes):
+    """
+    Make an array of props out of a list of objects having center and size
+    attributes, like Box or Anchor
+    """
+    arr = [(b.center.x, b.center.y, b.size.w, b.size.h) for b in boxes]
+    return np.array(arr, dtype=np.float64).reshape(-1, 4)
+
+#-------------------------------------------------------------------------------
+
+
+def props2corners(props, imgsize, integer=True):
+    """
+    Convert proportional center-width bounds to absolute min-max bounds. In
+    the integer mode the bounds are truncated to integers the same way
+    utils.prop2abs does, but they are still returned as floats so that NaNs
+    survive.
+    """
+    props = np.asarray(props, dtype=np.float64)
+    width2 = props[:, 2]*imgsize.w/2
+    height2 = props[:, 3]*imgsize.h/2
+    cx = props[:, 0]*imgsize.w
+    cy = props[:, 1]*imgsize.h
+    corners = np.empty(props.shape, dtype=np.float64)
+    corners[:, 0] = cx-width2
+    corners[:, 1] = cx+width2
+    corners[:, 2] = cy-height2
+    corners[:, 3] = cy+height2
+    if integer:
+        np.trunc(corners, out=corners)
+    return corners
+
+#-------------------------------------------------------------------------------
+
+
+def corners2props(corners, imgsize):
+    """
+    Convert the absolute min-max box bounds to proportional center-width bounds
+    """
+    corners = np.asarray(corners, dtype=np.float64)
+    width = corners[:, 1]-corners[:, 0]
+    height = corners[:, 3]-corners[:, 2]
+    props = np.empty(corners.shape, dtype=np.float64)
+    props[:, 0] = (corners[:, 0]+width/2)/imgsize.w
+    props[:, 1] = (corners[:, 2]+height/2)/imgsize.h
+    props[:, 2] = width/imgsize.w
+    props[:, 3] = height/imgsize.h
+    return props
+
+#-------------------------------------------------------------------------------
+
+
+def clip_corners(corners, imgsize):
+    """
+    Clip the absolute box bounds to the pixels of the image: the minima are
+    clipped from below and the maxima from above, and then the minima are
+    made not to exceed the maxima
+    """
+    corners = np.asarray(corners, dtype=np.float64)
+    clipped = np.empty(corners.shape, dtype=np.float64)
+    clipped[:, 1] = np.minimum(corners[:, 1], imgsize.w-1)
+    clipped[:, 3] = np.minimum(corners[:, 3], imgsize.h-1)
+    clipped[:, 0] = np.minimum(np.maximum(corners[:, 0], 0), clipped[:, 1])
+    clipped[:, 2] = np.minimum(np.maximum(corners[:, 2], 0), clipped[:, 3])
+    return clipped
+
+#-------------------------------------------------------------------------------
+
+
+def offset_corners(corners, w_off, h_off):
+    """
+    Move the absolute box bounds by the given offsets
+    """
+    corners = np.array(corners, dtype=np.float64)
+    corners[:, :2] += w_off
+    corners[:, 2:] += h_off
+    return corners
+
+#-------------------------------------------------------------------------------
+
+
+def flip_props(props):
+    """
+    Flip the boxes horizontally
+    """
+    props = np.array(props, dtype=np.float64)
+    props[:, 0] = 1-props[:, 0]
+    return props
+
+#-------------------------------------------------------------------------------
+
+
+def valid_props(props):
+    """
+    Find the boxes whose params are all finite
+    """
+    return np.all(np.isfinite(props), axis=1)
+
+#-------------------------------------------------------------------------------
+
+
+def normalize_props(props):
+    """
+    Clip the boxes to the image in the 1000x1000 reference frame. Boxes with
+    NaN or infinite params are returned unchanged.
+    """
+    props = np.asarray(props, dtype=np.float64)
+    valid = valid_props(props)
+
+    with np.errstate(invalid='ignore'):
+        corners = props2corners(props, NORMALIZE_SIZE)
+
+    # this happens early in the training when box min and max are outside
+    # of the image
+    corners = clip_corners(corners, NORMALIZE_SIZE)
+    normalized = corners2props(corners, NORMALIZE_SIZE)
+    normalized[~valid] = props[~valid]
+    return normalized
+
+#-------------------------------------------------------------------------------
+
+
+def transform_props(props, orig_size, new_size, h_off, w_off):
+    """
+    Compute the proportional params of the boxes in an image of new_size
+    into which the original image has been placed at the given offsets.
+    :return: a tuple of (props, keep), where keep is a mask of the boxes whose
+             centers fall within the new image
+    """
+    corners = offset_corners(props2corners(props, orig_size), w_off, h_off)
+
+    #---------------------------------------------------------------------------
+    # Check if the center falls within the image
+    #---------------------------------------------------------------------------
+    new_cx = corners[:, 0] + np.trunc((corners[:, 1]-corners[:, 0])/2)
+    new_cy = corners[:, 2] + np.trunc((corners[:, 3]-corners[:, 2])/2)
+    keep = (new_cx >= 0) & (new_cx < new_size.w) & \
+           (new_cy >= 0) & (new_cy < new_size.h)
+
+    return corners2props(corners, new_size), keep
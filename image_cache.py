@@ -0,0 +1,361 @@
+import hashlib
+import mmap
+
+import multiprocessing as mp
+import numpy as np
+
+from collections import OrderedDict
+
+#-------------------------------------------------------------------------------
+# Indices of the counters in the shared state array
+#-------------------------------------------------------------------------------
+FREE_HEAD = 0
+FREE_BLOCKS = 1
+FREE_ENTRY = 2
+LRU_HEAD = 3
+LRU_TAIL = 4
+TOMBSTONES = 5
+HITS = 6
+MISSES = 7
+EVICTIONS = 8
+NUM_ENTRIES = 9
+STATE_SIZE = 10
+
+#-------------------------------------------------------------------------------
+# Markers of the hash table slots
+#-------------------------------------------------------------------------------
+EMPTY = -1
+TOMBSTONE = -2
+
+#-------------------------------------------------------------------------------
+
+
+def key2hash(key):
+    """
+    Hash a cache key to a 64-bit integer
+    """
+    digest = hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest()
+    return int(np.frombuffer(digest, dtype=np.int64)[0])
+
+#-------------------------------------------------------------------------------
+
+
+def shared_array(dtype, shape, fill):
+    arr = np.frombuffer(mp.RawArray('b', int(np.prod(shape)) *
+                                    np.dtype(dtype).itemsize), dtype=dtype)
+    arr = arr.reshape(shape)
+    arr[:] = fill
+    return arr
+
+#-------------------------------------------------------------------------------
+
+
+class ImageCache:
+    """
+    A cache of decoded uint8 images living in shared memory, so that all the
+    processes forked after its creation see the same contents. Every image
+    is stored once, at one resolution, along with the reduction factor it
+    was decoded at; the image loader scales it down further as needed. The
+    pixels are stored in fixed-size blocks of an anonymous shared mapping,
+    which only takes up memory as it gets filled, and the images are
+    chained lists of blocks. When the byte budget is exhausted the least
+    recently used images get evicted.
+
+    The images are looked up in an open addressing hash table and kept in
+    a doubly linked LRU list, so no operation scans all the images. The
+    lock only guards the bookkeeping; the pixels are copied outside of it
+    while the image is pinned, so that it can't be evicted in the meantime.
+    """
+
+    #---------------------------------------------------------------------------
+    def __init__(self, size, block_size=64*1024):
+        """
+        :param size:       the byte budget
+        :param block_size: the allocation unit in bytes
+        """
+        self.block_size = block_size
+        self.num_blocks = max(int(size//block_size), 1)
+        self.size = self.num_blocks*block_size
+        self.buffer = mmap.mmap(-1, self.size)
+        self.data = np.frombuffer(self.buffer, dtype=np.uint8)
+        self.data = self.data.reshape(self.num_blocks, block_size)
+        self.lock = mp.Lock()
+
+        #-----------------------------------------------------------------------
+        # The free blocks and the blocks of every image make linked lists.
+        # An image needs at least one block, so there are never more images
+        # than blocks. The free entries are linked through entry_next.
+        #-----------------------------------------------------------------------
+        n = self.num_blocks
+        self.next_block = shared_array(np.int32, (n,), -1)
+        self.next_block[:-1] = np.arange(1, n)
+        self.entry_key = shared_array(np.int64, (n,), 0)
+        self.entry_head = shared_array(np.int32, (n,), -1)
+        self.entry_shape = shared_array(np.int32, (n, 3), 0)
+        self.entry_reduction = shared_array(np.int32, (n,), 1)
+        self.entry_pins = shared_array(np.int32, (n,), 0)
+        self.entry_dead = shared_array(np.int8, (n,), 0)
+        self.entry_slot = shared_array(np.int32, (n,), -1)
+        self.entry_prev = shared_array(np.int32, (n,), -1)
+        self.entry_next = shared_array(np.int32, (n,), -1)
+        self.entry_next[:-1] = np.arange(1, n)
+
+        #-----------------------------------------------------------------------
+        # The hash table has at least twice as many slots as there can be
+        # images, so the probe sequences stay short
+        #-----------------------------------------------------------------------
+        capacity = 1
+        while capacity < 2*n:
+            capacity *= 2
+        self.mask = capacity-1
+        self.table = shared_array(np.int32, (capacity,), EMPTY)
+
+        self.state = shared_array(np.int64, (STATE_SIZE,), 0)
+        self.state[FREE_BLOCKS] = n
+        self.state[LRU_HEAD] = -1
+        self.state[LRU_TAIL] = -1
+
+    #---------------------------------------------------------------------------
+    def find(self, key_hash):
+        slot = key_hash & self.mask
+        while True:
+            entry = self.table[slot]
+            if entry == EMPTY:
+                return None
+            if entry >= 0 and self.entry_key[entry] == key_hash:
+                return entry
+            slot = (slot+1) & self.mask
+
+    #---------------------------------------------------------------------------
+    def insert(self, entry):
+        slot = self.entry_key[entry] & self.mask
+        while self.table[slot] >= 0:
+            slot = (slot+1) & self.mask
+        if self.table[slot] == TOMBSTONE:
+            self.state[TOMBSTONES] -= 1
+        self.table[slot] = entry
+        self.entry_slot[entry] = slot
+
+    #---------------------------------------------------------------------------
+    def remove(self, entry):
+        self.table[self.entry_slot[entry]] = TOMBSTONE
+        self.state[TOMBSTONES] += 1
+
+        #-----------------------------------------------------------------------
+        # Rehash once the tombstones start making the misses slow
+        #-----------------------------------------------------------------------
+        if self.state[TOMBSTONES] > len(self.table)//4:
+            entries = self.table[self.table >= 0].copy()
+            self.table[:] = EMPTY
+            self.state[TOMBSTONES] = 0
+            for e in entries:
+                self.insert(e)
+
+    #---------------------------------------------------------------------------
+    def unlink(self, entry):
+        prev = self.entry_prev[entry]
+        next = self.entry_next[entry]
+        if prev >= 0:
+            self.entry_next[prev] = next
+        else:
+            self.state[LRU_HEAD] = next
+        if next >= 0:
+            self.entry_prev[next] = prev
+        else:
+            self.state[LRU_TAIL] = prev
+
+    #---------------------------------------------------------------------------
+    def push_front(self, entry):
+        head = self.state[LRU_HEAD]
+        self.entry_prev[entry] = -1
+        self.entry_next[entry] = head
+        if head >= 0:
+            self.entry_prev[head] = entry
+        else:
+            self.state[LRU_TAIL] = entry
+        self.state[LRU_HEAD] = entry
+
+    #---------------------------------------------------------------------------
+    def blocks(self, head):
+        blocks = []
+        while head >= 0:
+            blocks.append(head)
+            head = self.next_block[head]
+        return blocks
+
+    #---------------------------------------------------------------------------
+    def allocate(self, num_blocks):
+        """
+        Take an entry and a chain of blocks off the free lists
+        """
+        head = int(self.state[FREE_HEAD])
+        block = head
+        for i in range(num_blocks):
+            last = block
+            block = self.next_block[block]
+        self.state[FREE_HEAD] = block
+        self.state[FREE_BLOCKS] -= num_blocks
+        self.next_block[last] = -1
+
+        entry = int(self.state[FREE_ENTRY])
+        self.state[FREE_ENTRY] = self.entry_next[entry]
+        self.entry_head[entry] = head
+        self.entry_dead[entry] = 0
+        return entry
+
+    #---------------------------------------------------------------------------
+    def free(self, entry):
+        """
+        Put the blocks and the entry back on the free lists
+        """
+        blocks = self.blocks(self.entry_head[entry])
+        self.next_block[blocks[-1]] = self.state[FREE_HEAD]
+        self.state[FREE_HEAD] = blocks[0]
+        self.state[FREE_BLOCKS] += len(blocks)
+        self.entry_head[entry] = -1
+        self.entry_next[entry] = self.state[FREE_ENTRY]
+        self.state[FREE_ENTRY] = entry
+
+    #---------------------------------------------------------------------------
+    def evict(self, entry):
+        """
+        Drop an image; if somebody is still reading it, its blocks get freed
+        when they are done
+        """
+        self.remove(entry)
+        self.unlink(entry)
+        self.state[NUM_ENTRIES] -= 1
+        if self.entry_pins[entry]:
+            self.entry_dead[entry] = 1
+        else:
+            self.free(entry)
+
+    #---------------------------------------------------------------------------
+    def unpin(self, entry):
+        self.entry_pins[entry] -= 1
+        if not self.entry_pins[entry] and self.entry_dead[entry]:
+            self.free(entry)
+
+    #---------------------------------------------------------------------------
+    def get(self, key, reduction=1):
+        """
+        Look an image up
+        :param reduction: the reduction factor the caller needs; images
+                          stored at a coarser one don't count
+        :return: a tuple of (image, reduction) with a copy of the cached
+                 image and the reduction factor it was stored at, or None
+                 if it's not cached
+        """
+        key_hash = key2hash(key)
+        with self.lock:
+            entry = self.find(key_hash)
+            if entry is None or self.entry_reduction[entry] > reduction:
+                self.state[MISSES] += 1
+                return None
+
+            self.state[HITS] += 1
+            self.unlink(entry)
+            self.push_front(entry)
+            self.entry_pins[entry] += 1
+            head = self.entry_head[entry]
+            shape = tuple(self.entry_shape[entry])
+            stored_reduction = int(self.entry_reduction[entry])
+
+        #-----------------------------------------------------------------------
+        # Copy the pixels of the pinned image
+        #-----------------------------------------------------------------------
+        try:
+            img = np.empty(shape, dtype=np.uint8)
+            flat = img.reshape(-1)
+            for i, block in enumerate(self.blocks(head)):
+                start = i*self.block_size
+                chunk = flat[start:start+self.block_size]
+                chunk[:] = self.data[block, :len(chunk)]
+        finally:
+            with self.lock:
+                self.unpin(entry)
+        return img, stored_reduction
+
+    #---------------------------------------------------------------------------
+    def put(self, key, img, reduction=1):
+        """
+        Store a 3-channel uint8 image decoded at the given reduction factor,
+        replacing the stored one if that one is coarser and evicting the
+        least recently used images if needed. Images larger than the whole
+        cache are not stored.
+        """
+        if img.dtype != np.uint8 or img.ndim != 3:
+            raise ValueError('Only 3-dimensional uint8 images can be cached')
+
+        num_blocks = max(-(-img.nbytes//self.block_size), 1)
+        if num_blocks > self.num_blocks:
+            return
+
+        key_hash = key2hash(key)
+        flat = np.ascontiguousarray(img).reshape(-1)
+        with self.lock:
+            entry = self.find(key_hash)
+            if entry is not None and \
+               self.entry_reduction[entry] <= reduction:
+                return
+
+            #-------------------------------------------------------------------
+            # Make room, skipping the images that are being read
+            #-------------------------------------------------------------------
+            victim = self.state[LRU_TAIL]
+            while self.state[FREE_BLOCKS] < num_blocks:
+                while victim >= 0 and self.entry_pins[victim]:
+                    victim = self.entry_prev[victim]
+                if victim < 0:
+                    return
+                prev = self.entry_prev[victim]
+                self.evict(victim)
+                self.state[EVICTIONS] += 1
+                victim = prev
+
+            entry = self.allocate(num_blocks)
+            head = self.entry_head[entry]
+
+        #-----------------------------------------------------------------------
+        # Copy the pixels; the new entry is not reachable until it's
+        # published below
+        #-----------------------------------------------------------------------
+        for i, block in enumerate(self.blocks(head)):
+            start = i*self.block_size
+            chunk = flat[start:start+self.block_size]
+            self.data[block, :len(chunk)] = chunk
+
+        with self.lock:
+            #-------------------------------------------------------------------
+            # Somebody may have stored the image in the meantime
+            #-------------------------------------------------------------------
+            other = self.find(key_hash)
+            if other is not None:
+                if self.entry_reduction[other] <= reduction:
+                    self.free(entry)
+                    return
+                self.evict(other)
+
+            self.entry_key[entry] = key_hash
+            self.entry_shape[entry] = img.shape
+            self.entry_reduction[entry] = reduction
+            self.entry_pins[entry] = 0
+            self.insert(entry)
+            self.push_front(entry)
+            self.state[NUM_ENTRIES] += 1
+
+    #---------------------------------------------------------------------------
+    def stats(self):
+        """
+        :return: a dictionary of the counters
+        """
+        with self.lock:
+            state = self.state.copy()
+        stats = OrderedDict()
+        stats['hits'] = int(state[HITS])
+        stats['misses'] = int(state[MISSES])
+        stats['evictions'] = int(state[EVICTIONS])
+        stats['images'] = int(state[NUM_ENTRIES])
+        stats['bytes'] = int(self.num_blocks-state[FREE_BLOCKS]) * \
+            self.block_size
+        return stats
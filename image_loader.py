@@ -0,0 +1,172 @@
+import math
+import cv2
+
+from utils import Size
+
+#-------------------------------------------------------------------------------
+# Image decoding at reduced resolutions. A JPEG decoder can scale the image
+# down by 2, 4 or 8 while doing the inverse DCT, which costs a fraction of a
+# full decode. The regions are [xmin, xmax, ymin, ymax] pixel bounds.
+#-------------------------------------------------------------------------------
+REDUCTIONS = [8, 4, 2]
+
+REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+# the start-of-frame markers holding the image size; 0xc4, 0xc8 and 0xcc
+# are the huffman, extension and arithmetic coding markers
+SOF_MARKERS = set(range(0xc0, 0xd0)) - set([0xc4, 0xc8, 0xcc])
+
+# the shared cache of the decoded images, see set_image_cache
+image_cache = None
+
+#-------------------------------------------------------------------------------
+
+
+def set_image_cache(cache):
+    """
+    Make load_image look the decoded images up in an ImageCache before
+    decoding them. Set it before forking the workers so that they share it.
+    """
+    global image_cache
+    image_cache = cache
+
+#-------------------------------------------------------------------------------
+
+
+def read_jpeg_size(filename):
+    """
+    Read the image size from the header of a JPEG file
+    :return: the Size of the image or None if the file is not a JPEG file
+    """
+    with open(filename, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+
+        while True:
+            marker = f.read(2)
+            if len(marker) != 2 or marker[0] != 0xff:
+                return None
+
+            #-------------------------------------------------------------------
+            # Skip the fill bytes and the markers without payload
+            #-------------------------------------------------------------------
+            code = marker[1]
+            while code == 0xff:
+                code = f.read(1)
+                if not code:
+                    return None
+                code = code[0]
+            if code == 0x01 or 0xd0 <= code <= 0xd7:
+                continue
+
+            length = f.read(2)
+            if len(length) != 2:
+                return None
+            length = length[0] << 8 | length[1]
+
+            if code in SOF_MARKERS:
+                frame = f.read(5)
+                if len(frame) != 5:
+                    return None
+                return Size(frame[3] << 8 | frame[4], frame[1] << 8 | frame[2])
+
+            f.seek(length-2, 1)
+
+#-------------------------------------------------------------------------------
+
+
+def pick_reduction(scale):
+    """
+    Pick the largest reduction after which the image still has at least as
+    many pixels as the consumer needs
+    :param scale: a (sx, sy) tuple of output pixels per source pixel
+    """
+    scale = max(abs(scale[0]), abs(scale[1]))
+    for reduction in REDUCTIONS:
+        if reduction*scale <= 1:
+            return reduction
+    return 1
+
+#-------------------------------------------------------------------------------
+
+
+def reduce_region(region, reduction, margin=4):
+    """
+    Convert a region of the full resolution image into the pixel bounds of
+    the reduced image, extended by the margin needed by the interpolation
+    :return: a [xmin, xmax, ymin, ymax] list of ints
+    """
+    return [max(int(math.floor(region[0]/reduction))-margin, 0),
+            int(math.ceil(region[1]/reduction))+margin,
+            max(int(math.floor(region[2]/reduction))-margin, 0),
+            int(math.ceil(region[3]/reduction))+margin]
+
+#-------------------------------------------------------------------------------
+
+
+def reduce_cached(img, factor, region=None):
+    """
+    Scale a cached image down by an integer factor to the size a reduced
+    decode would have, ie. rounding up, scaling only the requested region
+    :param region: the bounds of the region of the scaled down image, None
+                   for the entire image
+    """
+    h = -(-img.shape[0]//factor)
+    w = -(-img.shape[1]//factor)
+    if region is None:
+        region = [0, w, 0, h]
+    x0, x1 = min(region[0], w), min(region[1], w)
+    y0, y1 = min(region[2], h), min(region[3], h)
+    img = img[y0*factor:y1*factor, x0*factor:x1*factor]
+    if factor == 1 or x1 <= x0 or y1 <= y0:
+        return img
+    return cv2.resize(img, (x1-x0, y1-y0), interpolation=cv2.INTER_AREA)
+
+#-------------------------------------------------------------------------------
+
+
+def load_image(filename, reduction=1, region=None):
+    """
+    Load a BGR image. The cache keeps every image once, at the finest
+    reduction requested so far, and the coarser ones are scaled down from
+    it.
+    :param reduction: the factor to scale the image down by, 1, 2, 4 or 8
+    :param region:    the bounds of the region of the reduced image to
+                      return, None for the entire image
+    """
+    if image_cache is not None:
+        cached = image_cache.get(filename, reduction)
+        if cached is not None:
+            img, cached_reduction = cached
+            return reduce_cached(img, reduction//cached_reduction, region)
+
+    img = cv2.imread(filename, REDUCED_FLAGS[reduction])
+    if img is not None and image_cache is not None:
+        image_cache.put(filename, img, reduction)
+
+    if img is not None and region is not None:
+        img = img[region[2]:region[3], region[0]:region[1]]
+    return img
+
+#-------------------------------------------------------------------------------
+
+
+def load_resized(filename, size, interpolation=cv2.INTER_LINEAR):
+    """
+    Load an image scaled to the given size, decoding JPEG files at the
+    lowest resolution that is still not smaller than the size
+    """
+    reduction = 1
+    imgsize = read_jpeg_size(filename)
+    if imgsize is not None:
+        reduction = pick_reduction((size.w/float(imgsize.w),
+                                    size.h/float(imgsize.h)))
+    img = load_image(filename, reduction)
+    if img is None:
+        return None
+    return cv2.resize(img, (size.w, size.h), interpolation=interpolation)
@@ -10,22 +10,27 @@ import numpy as np
 
 from average_precision import APCalculator, APs2mAP
 from pascal_summary import PascalSummary
-from ssdutils import get_anchors_for_preset, decode_boxes, suppress_overlaps
+from ssdutils import get_anchor_table
+from ssdutils import decode_boxes, suppress_overlaps
 from ssdvgg import SSDVGG
-from utils import str2bool, load_data_source, draw_box
+from image_loader import load_resized
+from utils import str2bool, load_data_source, draw_detections
 from tqdm import tqdm
 
 #-------------------------------------------------------------------------------
 
 
-def sample_generator(samples, image_size, batch_size):
-    image_size = (image_size.w, image_size.h)
+def sample_generator(samples, image_size, batch_size, reduced_decode=True):
     for offset in range(0, len(samples), batch_size):
         files = samples[offset:offset+batch_size]
         images = []
         idxs = []
         for i, image_file in enumerate(files):
-            image = cv2.resize(cv2.imread(image_file), image_size)
+            if reduced_decode:
+                image = load_resized(image_file, image_size)
+            else:
+                image = cv2.resize(cv2.imread(image_file),
+                                   (image_size.w, image_size.h))
             images.append(image.astype(np.float32))
             idxs.append(offset+i)
         yield np.array(images), idxs
@@ -60,12 +65,23 @@ def main():
                         help='Use test files from the data source')
     parser.add_argument('--batch-size', type=int, default=1,
                         help='batch size')
+    parser.add_argument('--reduced-decode', type=str2bool, default='True',
+                        help='decode the JPEG images at the lowest resolution '
+                             'not smaller than the network input')
     parser.add_argument('--sample', default='test',
                         choices=['test', 'trainval'], help='sample to run on')
     parser.add_argument('--threshold', type=float, default=0.5,
                         help='confidence threshold')
     parser.add_argument('--pascal-summary', type=str2bool, default='False',
                         help='dump the detections in Pascal VOC format')
+    parser.add_argument('--nms-threshold', type=float, default=0.45,
+                        help='jaccard overlap threshold of the non-maximum '
+                             'suppression')
+    parser.add_argument('--nms-top-k', type=int, default=None,
+                        help='number of the most confident detections per '
+                             'image considered by the non-maximum suppression')
+    parser.add_argument('--max-detections', type=int, default=200,
+                        help='maximum number of detections per image')
 
     args = parser.parse_args()
 
@@ -75,6 +91,7 @@ def main():
     print('[i] Project name:      ', args.name)
     print('[i] Training data:     ', args.training_data)
     print('[i] Batch size:        ', args.batch_size)
+    print('[i] Reduced decode:    ', args.reduced_decode)
     print('[i] Data source:       ', args.data_source)
     print('[i] Data directory:    ', args.data_dir)
     print('[i] Output directory:  ', args.output_dir)
@@ -83,6 +100,9 @@ def main():
     print('[i] Sample:            ', args.sample)
     print('[i] Threshold:         ', args.threshold)
     print('[i] Pascal summary:    ', args.pascal_summary)
+    print('[i] NMS threshold:     ', args.nms_threshold)
+    print('[i] NMS top-k:         ', args.nms_top_k)
+    print('[i] Max detections:    ', args.max_detections)
 
     #---------------------------------------------------------------------------
     # Check if we can get the checkpoint
@@ -115,7 +135,8 @@ def main():
         lid2name = data['lid2name']
         num_classes = data['num-classes']
         image_size = preset.image_size
-        anchors = get_anchors_for_preset(preset)
+        anchors = get_anchor_table(preset,
+                                   os.path.dirname(args.training_data)).prop
     except (FileNotFoundError, IOError, KeyError) as e:
         print('[!] Unable to load training data:', str(e))
         return 1
@@ -195,7 +216,8 @@ def main():
         #-----------------------------------------------------------------------
         # Process the images
         #-----------------------------------------------------------------------
-        generator = sample_generator(files, image_size, args.batch_size)
+        generator = sample_generator(files, image_size, args.batch_size,
+                                     args.reduced_decode)
         n_sample_batches = int(math.ceil(len(files)/args.batch_size))
         description = '[i] Processing samples'
 
@@ -208,10 +230,11 @@ def main():
             #-------------------------------------------------------------------
             # Process the predictions
             #-------------------------------------------------------------------
-            for i in range(enc_boxes.shape[0]):
-                boxes = decode_boxes(enc_boxes[i], anchors, args.threshold,
-                                     lid2name, None)
-                boxes = suppress_overlaps(boxes)[:200]
+            detections = decode_boxes(enc_boxes, anchors, args.threshold, None)
+            detections = suppress_overlaps(detections, args.nms_threshold,
+                                           args.nms_top_k, args.max_detections)
+            detections = detections.split(enc_boxes.shape[0])
+            for i, boxes in enumerate(detections):
                 filename = files[idxs[i]]
                 basename = os.path.basename(filename)
 
@@ -220,8 +243,7 @@ def main():
                 #---------------------------------------------------------------
                 if args.annotate:
                     img = cv2.imread(filename)
-                    for box in boxes:
-                        draw_box(img, box[1], colors[box[1].label])
+                    draw_detections(img, boxes, colors, lid2name)
                     fn = args.output_dir+'/'+basename
                     cv2.imwrite(fn, img)
 
@@ -240,7 +262,7 @@ def main():
                     ap_calc.add_detections(samples[idxs[i]].boxes, boxes)
 
                 if args.pascal_summary:
-                    pascal_summary.add_detections(filename, boxes)
+                    pascal_summary.add_detections(filename, boxes, lid2name)
 
     #---------------------------------------------------------------------------
     # Compute and print the stats
@@ -1,8 +1,10 @@
 import cv2
 import os
 
+import numpy as np
+
 from collections import defaultdict, namedtuple
-from utils import prop2abs, Size
+from utils import Size
 
 #-------------------------------------------------------------------------------
 Detection = namedtuple('Detection', ['fileid', 'confidence', 'left', 'top',
@@ -17,32 +19,20 @@ class PascalSummary:
         self.boxes = defaultdict(list)
 
     #---------------------------------------------------------------------------
-    def add_detections(self, filename, boxes):
+    def add_detections(self, filename, detections, lid2name):
         fileid = os.path.basename(filename)
         fileid = ''.join(fileid.split('.')[:-1])
         img = cv2.imread(filename)
         img_size = Size(img.shape[1], img.shape[0])
-        for conf, box in boxes:
-            xmin, xmax, ymin, ymax = prop2abs(box.center, box.size, img_size)
-            if xmin < 0:
-                xmin = 0
-            if xmin >= img_size.w:
-                xmin = img_size.w-1
-            if xmax < 0:
-                xmax = 0
-            if xmax >= img_size.w:
-                xmax = img_size.w-1
-            if ymin < 0:
-                ymin = 0
-            if ymin >= img_size.h:
-                ymin = img_size.h-1
-            if ymax < 0:
-                ymax = 0
-            if ymax >= img_size.h:
-                ymax = img_size.h-1
-            det = Detection(fileid, conf, float(xmin+1), float(ymin+1),
-                            float(xmax+1), float(ymax+1))
-            self.boxes[box.label].append(det)
+        corners = detections.abs_corners(img_size)
+        corners[:, :2] = np.clip(corners[:, :2], 0, img_size.w-1)
+        corners[:, 2:] = np.clip(corners[:, 2:], 0, img_size.h-1)
+        names = detections.label_names(lid2name)
+        for i, name in enumerate(names):
+            xmin, xmax, ymin, ymax = corners[i]
+            det = Detection(fileid, detections.scores[i], float(xmin+1),
+                            float(ymin+1), float(xmax+1), float(ymax+1))
+            self.boxes[name].append(det)
 
     #---------------------------------------------------------------------------
     def write_summary(self, target_dir):
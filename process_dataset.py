@@ -4,9 +4,13 @@ import sys
 import cv2
 import os
 
+import multiprocessing as mp
+
 import numpy as np
 
 from transforms import *
+from epoch_shards import write_epoch_shards
+from training_data import TrainingData
 from ssdutils import get_preset_by_name
 from utils import load_data_source, str2bool, draw_box
 from tqdm import tqdm
@@ -44,56 +48,32 @@ def build_sampler(overlap, trials):
 #-------------------------------------------------------------------------------
 
 
-def build_train_transforms(preset, num_classes, sampler_trials, expand_prob):
-    #---------------------------------------------------------------------------
-    # Resizing
-    #---------------------------------------------------------------------------
-    tf_resize = ResizeTransform(width=preset.image_size.w,
-                                height=preset.image_size.h,
-                                algorithms=[cv2.INTER_LINEAR,
-                                            cv2.INTER_AREA,
-                                            cv2.INTER_NEAREST,
-                                            cv2.INTER_CUBIC,
-                                            cv2.INTER_LANCZOS4])
-
+def build_photometric_distort():
     #---------------------------------------------------------------------------
-    # Image distortions
+    # Image distortions: brightness, then contrast, saturation and hue in one
+    # of two orders, and channel reordering, all done in one pass
     #---------------------------------------------------------------------------
-    tf_brightness = BrightnessTransform(delta=32)
-    tf_rnd_brightness = RandomTransform(prob=0.5, transform=tf_brightness)
+    return PhotometricDistortTransform(brightness_prob=0.5,
+                                       brightness_delta=32,
+                                       contrast_prob=0.5,
+                                       contrast_lower=0.5,
+                                       contrast_upper=1.5,
+                                       hue_prob=0.5,
+                                       hue_delta=18,
+                                       saturation_prob=0.5,
+                                       saturation_lower=0.5,
+                                       saturation_upper=1.5,
+                                       reorder_prob=0.5)
 
-    tf_contrast = ContrastTransform(lower=0.5, upper=1.5)
-    tf_rnd_contrast = RandomTransform(prob=0.5, transform=tf_contrast)
-
-    tf_hue = HueTransform(delta=18)
-    tf_rnd_hue = RandomTransform(prob=0.5, transform=tf_hue)
-
-    tf_saturation = SaturationTransform(lower=0.5, upper=1.5)
-    tf_rnd_saturation = RandomTransform(prob=0.5, transform=tf_saturation)
+#-------------------------------------------------------------------------------
 
-    tf_reorder_channels = ReorderChannelsTransform()
-    tf_rnd_reorder_channels = RandomTransform(prob=0.5,
-                                              transform=tf_reorder_channels)
-
-    #---------------------------------------------------------------------------
-    # Compositions of image distortions
-    #---------------------------------------------------------------------------
-    tf_distort_lst = [
-        tf_rnd_contrast,
-        tf_rnd_saturation,
-        tf_rnd_hue,
-        tf_rnd_contrast
-    ]
-    tf_distort_1 = ComposeTransform(transforms=tf_distort_lst[:-1])
-    tf_distort_2 = ComposeTransform(transforms=tf_distort_lst[1:])
-    tf_distort_comp = [tf_distort_1, tf_distort_2]
-    tf_distort = TransformPickerTransform(transforms=tf_distort_comp)
 
+def build_train_transforms(preset, num_classes, sampler_trials, expand_prob,
+                           reduced_decode=True, batch_photometric=False):
     #---------------------------------------------------------------------------
     # Expand sample
     #---------------------------------------------------------------------------
     tf_expand = ExpandTransform(max_ratio=4.0, mean_value=[104, 117, 123])
-    tf_rnd_expand = RandomTransform(prob=expand_prob, transform=tf_expand)
 
     #---------------------------------------------------------------------------
     # Samplers
@@ -110,36 +90,42 @@ def build_train_transforms(preset, num_classes, sampler_trials, expand_prob):
     tf_sample_picker = SamplePickerTransform(samplers=samplers)
 
     #---------------------------------------------------------------------------
-    # Horizontal flip
+    # Expand, crop, flip and resize in one warp
     #---------------------------------------------------------------------------
-    tf_flip = HorizontalFlipTransform()
-    tf_rnd_flip = RandomTransform(prob=0.5, transform=tf_flip)
+    tf_geometric = GeometricTransform(expand_prob=expand_prob,
+                                      expand=tf_expand,
+                                      sampler=tf_sample_picker,
+                                      flip_prob=0.5,
+                                      width=preset.image_size.w,
+                                      height=preset.image_size.h,
+                                      algorithms=[cv2.INTER_LINEAR,
+                                                  cv2.INTER_AREA,
+                                                  cv2.INTER_NEAREST,
+                                                  cv2.INTER_CUBIC,
+                                                  cv2.INTER_LANCZOS4])
 
     #---------------------------------------------------------------------------
-    # Transform list
+    # Transform list; with the batch photometric distortion the colors get
+    # distorted later, on whole batches of resized images
     #---------------------------------------------------------------------------
-    transforms = [
-        ImageLoaderTransform(),
-        tf_rnd_brightness,
-        tf_distort,
-        tf_rnd_reorder_channels,
-        tf_rnd_expand,
-        tf_sample_picker,
-        tf_rnd_flip,
-        LabelCreatorTransform(preset=preset, num_classes=num_classes),
-        tf_resize
+    transforms = [ImageLoaderTransform(reduce=reduced_decode)]
+    if not batch_photometric:
+        transforms.append(build_photometric_distort())
+    transforms += [
+        tf_geometric,
+        LabelCreatorTransform(preset=preset, num_classes=num_classes)
     ]
     return transforms
 
 #-------------------------------------------------------------------------------
 
 
-def build_valid_transforms(preset, num_classes):
+def build_valid_transforms(preset, num_classes, reduced_decode=True):
     tf_resize = ResizeTransform(width=preset.image_size.w,
                                 height=preset.image_size.h,
                                 algorithms=[cv2.INTER_LINEAR])
     transforms = [
-        ImageLoaderTransform(),
+        ImageLoaderTransform(reduce=reduced_decode),
         LabelCreatorTransform(preset=preset, num_classes=num_classes),
         tf_resize
     ]
@@ -161,6 +147,12 @@ def main():
                         help='probability of running sample expander')
     parser.add_argument('--sampler-trials', type=int, default=50,
                         help='number of time a sampler tries to find a sample')
+    parser.add_argument('--reduced-decode', type=str2bool, default='True',
+                        help='decode the JPEG images at the lowest resolution '
+                             'the transforms need')
+    parser.add_argument('--batch-photometric', type=str2bool, default='False',
+                        help='distort the colors of whole batches after '
+                             'resizing instead of every full size image')
     parser.add_argument('--annotate', type=str2bool, default='False',
                         help="Annotate the data samples")
     parser.add_argument('--compute-td', type=str2bool, default='True', help="Compute training data")
@@ -168,17 +160,46 @@ def main():
                         choices=['vgg300', 'vgg512'], help="The neural network preset")
     parser.add_argument('--process-test', type=str2bool,
                         default='False', help="process the test dataset")
+    parser.add_argument('--materialize-epochs', type=int, default=0,
+                        help='number of augmented training epochs to write '
+                             'to the shards directory')
+    parser.add_argument('--shards-dir', default=None,
+                        help='directory of the materialized epochs; '
+                             'data-dir/shards by default')
+    parser.add_argument('--shard-size', type=int, default=256,
+                        help='number of samples per shard')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the augmentation of the materialized '
+                             'epochs')
+    parser.add_argument('--num-workers', type=int, default=mp.cpu_count(),
+                        help='number of processes writing the shards')
+    parser.add_argument('--explain', type=int, default=None,
+                        help='print the image steps planned for the training '
+                             'sample with this index')
     args = parser.parse_args()
 
+    if args.shards_dir is None:
+        args.shards_dir = args.data_dir+'/shards'
+
     print('[i] Data source:          ', args.data_source)
     print('[i] Data directory:       ', args.data_dir)
     print('[i] Validation fraction:  ', args.validation_fraction)
     print('[i] Expand probability:   ', args.expand_probability)
     print('[i] Sampler trials:       ', args.sampler_trials)
+    print('[i] Reduced decode:       ', args.reduced_decode)
+    print('[i] Batch photometric:    ', args.batch_photometric)
     print('[i] Annotate:             ', args.annotate)
     print('[i] Compute training data:', args.compute_td)
     print('[i] Preset:               ', args.preset)
     print('[i] Process test dataset: ', args.process_test)
+    print('[i] Materialize epochs:   ', args.materialize_epochs)
+    if args.materialize_epochs:
+        print('[i] Shards directory:     ', args.shards_dir)
+        print('[i] Shard size:           ', args.shard_size)
+        print('[i] Seed:                 ', args.seed)
+        print('[i] Number of workers:    ', args.num_workers)
+    if args.explain is not None:
+        print('[i] Explain sample:       ', args.explain)
 
     #---------------------------------------------------------------------------
     # Load the data source
@@ -226,12 +247,59 @@ def main():
                 'lname2id': source.lname2id,
                 'train-transforms': build_train_transforms(preset,
                                                            source.num_classes, args.sampler_trials,
-                                                           args.expand_probability),
+                                                           args.expand_probability,
+                                                           args.reduced_decode,
+                                                           args.batch_photometric),
                 'valid-transforms': build_valid_transforms(preset,
-                                                           source.num_classes)
+                                                           source.num_classes,
+                                                           args.reduced_decode),
+                'batch-distort': build_photometric_distort()
+                                 if args.batch_photometric else None
             }
             pickle.dump(data, f)
 
+    #---------------------------------------------------------------------------
+    # Materialize the augmented epochs
+    #---------------------------------------------------------------------------
+    if args.materialize_epochs > 0:
+        try:
+            with open(args.data_dir+'/training-data.pkl', 'rb') as f:
+                data = pickle.load(f)
+            with open(args.data_dir+'/train-samples.pkl', 'rb') as f:
+                train_samples = pickle.load(f)
+        except (FileNotFoundError, IOError) as e:
+            print('[!] Unable to load training data:', str(e))
+            return 1
+
+        print('[i] Materializing the epochs...')
+        total = args.materialize_epochs*len(train_samples)
+        with tqdm(total=total, desc='[i] Epochs', unit='samples') as bar:
+            write_epoch_shards(args.shards_dir, data['train-transforms'],
+                               train_samples, args.materialize_epochs,
+                               args.shard_size, args.seed, data['preset'],
+                               data.get('batch-distort'), args.num_workers,
+                               bar.update)
+
+    #---------------------------------------------------------------------------
+    # Show the plan of a training sample
+    #---------------------------------------------------------------------------
+    if args.explain is not None:
+        try:
+            td = TrainingData(args.data_dir)
+        except (AttributeError, RuntimeError) as e:
+            print('[!] Unable to load training data:', str(e))
+            return 1
+
+        if not 0 <= args.explain < td.num_train:
+            print('[!] There are only {} training samples'
+                  .format(td.num_train))
+            return 1
+
+        print('[i] Image steps of training sample {}:'.format(args.explain))
+        for step in td.explain(args.explain):
+            print('[i]    ', step)
+        td.close()
+
     return 0
 
 
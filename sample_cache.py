@@ -0,0 +1,163 @@
+import hashlib
+import pickle
+import glob
+import os
+
+import numpy as np
+
+from sparse_labels import SparseLabels
+
+#-------------------------------------------------------------------------------
+
+
+def transforms_key(transforms):
+    """
+    Describe a list of transforms by their types and parameters
+    """
+    return repr([(type(t).__name__,
+                  sorted((k, repr(v)) for k, v in vars(t).items()
+                         if k != 'initialized'))
+                 for t in transforms])
+
+#-------------------------------------------------------------------------------
+
+
+class SampleCache:
+    """
+    Processed samples stored in the cache directory: the images as uint8 in
+    a memory-mapped .npy file, the labels as the arrays of SparseLabels in
+    an .npz file, and the ground truth boxes in a pickle. The file names
+    carry a digest of the key, so the cache gets rebuilt whenever anything
+    the key describes changes, and the files of the other keys get removed
+    when it does.
+    """
+
+    #---------------------------------------------------------------------------
+    def __init__(self, cache_dir, name, key, num_anchors, num_classes):
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()[:8]
+        self.cache_dir = cache_dir
+        self.name = name
+        self.prefix = os.path.join(cache_dir, '{}-{}'.format(name, digest))
+        self.images_file = self.prefix+'-images.npy'
+        self.labels_file = self.prefix+'-labels.npz'
+        self.gt_file = self.prefix+'-gt.pkl'
+        self.num_anchors = num_anchors
+        self.num_classes = num_classes
+
+    #---------------------------------------------------------------------------
+    def complete(self):
+        """
+        The ground truth file gets written last, so the cache is complete
+        if it exists along with the others
+        """
+        return all(os.path.exists(f) for f in [self.images_file,
+                                               self.labels_file,
+                                               self.gt_file])
+
+    #---------------------------------------------------------------------------
+    def read(self, batch_size):
+        """
+        Stream the batches
+        :return: a generator of (images, labels, gt_boxes) tuples
+        """
+        images = np.load(self.images_file, mmap_mode='r')
+        with np.load(self.labels_file) as f:
+            anchor_ids = f['anchor_ids']
+            class_ids = f['class_ids']
+            offsets = f['offsets']
+            counts = f['counts']
+        with open(self.gt_file, 'rb') as f:
+            gt_boxes = pickle.load(f)
+
+        starts = np.r_[0, np.cumsum(counts)]
+        for offset in range(0, len(gt_boxes), batch_size):
+            batch_counts = counts[offset:offset+batch_size]
+            first = starts[offset]
+            last = starts[offset+len(batch_counts)]
+            sample_ids = np.repeat(np.arange(len(batch_counts),
+                                             dtype=np.int32), batch_counts)
+            labels = SparseLabels(sample_ids, anchor_ids[first:last],
+                                  class_ids[first:last],
+                                  offsets[first:last], len(batch_counts))
+            yield (images[offset:offset+batch_size].astype(np.float32),
+                   labels.to_dense(self.num_anchors, self.num_classes),
+                   gt_boxes[offset:offset+batch_size])
+
+    #---------------------------------------------------------------------------
+    def write(self, generator, num_samples):
+        """
+        Pass the batches of the generator through and store them. The cache
+        is only completed if the generator produces all the samples.
+        """
+        tmp = '.{}.tmp'.format(os.getpid())
+        images = None
+        labels = {'anchor_ids': [], 'class_ids': [], 'offsets': [],
+                  'counts': []}
+        gt_boxes = []
+        try:
+            for x, y, boxes in generator:
+                if images is None:
+                    images = np.lib.format.open_memmap(
+                        self.images_file+tmp, mode='w+', dtype=np.uint8,
+                        shape=(num_samples,)+x.shape[1:])
+
+                offset = len(gt_boxes)
+                images[offset:offset+len(boxes)] = x[:len(boxes)]
+                sparse = SparseLabels.from_dense(y[:len(boxes)],
+                                                 self.num_classes)
+                labels['anchor_ids'].append(sparse.anchor_ids)
+                labels['class_ids'].append(sparse.class_ids)
+                labels['offsets'].append(sparse.offsets)
+                labels['counts'].append(np.bincount(sparse.sample_ids,
+                                                    minlength=len(boxes)))
+                gt_boxes += boxes
+                yield x, y, boxes
+
+            if images is None or len(gt_boxes) != num_samples:
+                return
+
+            #-------------------------------------------------------------------
+            # Move the complete files in place and remove the ones made for
+            # the other keys
+            #-------------------------------------------------------------------
+            images.flush()
+            images = None
+            try:
+                os.rename(self.images_file+tmp, self.images_file)
+                with open(self.labels_file+tmp, 'wb') as f:
+                    np.savez(f, **{k: np.concatenate(v)
+                                   for k, v in labels.items()})
+                os.rename(self.labels_file+tmp, self.labels_file)
+                with open(self.gt_file+tmp, 'wb') as f:
+                    pickle.dump(gt_boxes, f)
+                os.rename(self.gt_file+tmp, self.gt_file)
+            except (IOError, OSError):
+                return
+            self.remove_stale()
+        finally:
+            #-------------------------------------------------------------------
+            # Remove whatever is left of an incomplete write, eg. when the
+            # consumer stops reading early
+            #-------------------------------------------------------------------
+            images = None
+            for filename in [self.images_file, self.labels_file,
+                             self.gt_file]:
+                try:
+                    os.remove(filename+tmp)
+                except (IOError, OSError):
+                    pass
+
+    #---------------------------------------------------------------------------
+    def remove_stale(self):
+        """
+        Remove the files of this cache made for any other key
+        """
+        current = set([self.images_file, self.labels_file, self.gt_file])
+        pattern = os.path.join(glob.escape(self.cache_dir), self.name+'-*')
+        for filename in glob.glob(pattern):
+            if filename in current:
+                continue
+            try:
+                os.remove(filename)
+            except (IOError, OSError):
+                pass
@@ -0,0 +1,92 @@
+import numpy as np
+
+#-------------------------------------------------------------------------------
+
+
+class SparseLabels:
+    """
+    The labels of a batch of samples keeping only the matched anchors,
+    stored as numpy arrays:
+     * sample_ids - (N) positions of the samples in the batch
+     * anchor_ids - (N) ids of the matched anchors
+     * class_ids  - (N) class ids of the objects matched with the anchors
+     * offsets    - (N, 4) encoded locations of the objects
+    All the other anchors are background with zero offsets, which is what
+    the dense (num_samples, num_anchors, num_classes+5) labels made by
+    LabelCreatorTransform hold for almost all the anchors.
+    """
+    __slots__ = ['sample_ids', 'anchor_ids', 'class_ids', 'offsets',
+                 'num_samples']
+
+    #---------------------------------------------------------------------------
+    def __init__(self, sample_ids, anchor_ids, class_ids, offsets,
+                 num_samples):
+        self.sample_ids = sample_ids
+        self.anchor_ids = anchor_ids
+        self.class_ids = class_ids
+        self.offsets = offsets
+        self.num_samples = num_samples
+
+    #---------------------------------------------------------------------------
+    def __getstate__(self):
+        return [getattr(self, x) for x in self.__slots__]
+
+    #---------------------------------------------------------------------------
+    def __setstate__(self, state):
+        for x, val in zip(self.__slots__, state):
+            setattr(self, x, val)
+
+    #---------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.anchor_ids)
+
+    #---------------------------------------------------------------------------
+    @property
+    def nbytes(self):
+        return self.sample_ids.nbytes + self.anchor_ids.nbytes + \
+            self.class_ids.nbytes + self.offsets.nbytes
+
+    #---------------------------------------------------------------------------
+    @staticmethod
+    def from_dense(labels, num_classes):
+        """
+        Make sparse labels out of a (num_samples, num_anchors, num_classes+5)
+        array
+        """
+        labels = np.asarray(labels)
+        sample_ids, anchor_ids = np.nonzero(labels[:, :, num_classes] == 0)
+        matched = labels[sample_ids, anchor_ids]
+        return SparseLabels(sample_ids.astype(np.int32),
+                            anchor_ids.astype(np.int32),
+                            np.argmax(matched[:, :num_classes],
+                                      axis=1).astype(np.int32),
+                            matched[:, num_classes+1:].astype(np.float32),
+                            labels.shape[0])
+
+    #---------------------------------------------------------------------------
+    @staticmethod
+    def stack(labels):
+        """
+        Make the labels of a batch out of a list of the labels of single
+        samples
+        """
+        sample_ids = [np.full(len(l), i, dtype=np.int32)
+                      for i, l in enumerate(labels)]
+        return SparseLabels(np.concatenate(sample_ids),
+                            np.concatenate([l.anchor_ids for l in labels]),
+                            np.concatenate([l.class_ids for l in labels]),
+                            np.concatenate([l.offsets for l in labels]),
+                            len(labels))
+
+    #---------------------------------------------------------------------------
+    def to_dense(self, num_anchors, num_classes):
+        """
+        Make the (num_samples, num_anchors, num_classes+5) float32 array
+        """
+        labels = np.zeros((self.num_samples, num_anchors, num_classes+5),
+                          dtype=np.float32)
+        labels[:, :, num_classes] = 1
+        labels[self.sample_ids, self.anchor_ids, num_classes] = 0
+        labels[self.sample_ids, self.anchor_ids, self.class_ids] = 1
+        labels[self.sample_ids, self.anchor_ids, num_classes+1:] = self.offsets
+        return labels
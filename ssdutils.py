@@ -1,7 +1,12 @@
+import hashlib
+import os
+
 import numpy as np
 
-from utils import Size, Point, Overlap, Score, Box, prop2abs, normalize_box
-from collections import namedtuple, defaultdict
+from utils import Size, Point, Overlap, Score, prop2abs
+from geometry import boxes2props, props2corners, normalize_props
+from detections import Detections
+from collections import namedtuple
 from math import sqrt, log, exp
 
 #-------------------------------------------------------------------------------
@@ -57,13 +62,10 @@ def get_preset_by_name(pname):
 #-------------------------------------------------------------------------------
 
 
-def get_anchors_for_preset(preset):
+def get_anchor_box_sizes(preset):
     """
-    Compute the default (anchor) boxes for the given SSD preset
+    Compute the width and heights of the anchor boxes for every scale
     """
-    #---------------------------------------------------------------------------
-    # Compute the width and heights of the anchor boxes for every scale
-    #---------------------------------------------------------------------------
     box_sizes = []
     for i in range(len(preset.maps)):
         map_params = preset.maps[i]
@@ -82,6 +84,17 @@ def get_anchors_for_preset(preset):
             s_prime = sqrt(s*preset.extra_scale)
         sizes.append((s_prime, s_prime))
         box_sizes.append(sizes)
+    return box_sizes
+
+#-------------------------------------------------------------------------------
+
+
+def get_anchors_for_preset(preset):
+    """
+    Compute the default (anchor) boxes for the given SSD preset
+    """
+    box_sizes = get_anchor_box_sizes(preset)
+    s = preset.maps[-1].scale
 
     #---------------------------------------------------------------------------
     # Compute the actual boxes for every scale and feature map
@@ -100,6 +113,91 @@ def get_anchors_for_preset(preset):
     return anchors
 
 #-------------------------------------------------------------------------------
+# Array-backed anchor tables:
+#  * prop    - (num_anchors, 4) proportional [cx, cy, w, h] params
+#  * corners - (num_anchors, 4) absolute [xmin, xmax, ymin, ymax] params in
+#              the 1000x1000 reference frame used for matching
+#  * maps    - (num_anchors) index of the feature map of each anchor
+# The anchors come in the same order as the ones of get_anchors_for_preset.
+#-------------------------------------------------------------------------------
+AnchorTable = namedtuple('AnchorTable', ['prop', 'corners', 'maps'])
+
+ANCHOR_IMG_SIZE = Size(1000, 1000)
+
+_anchor_tables = {}
+
+#-------------------------------------------------------------------------------
+
+
+def build_anchor_table(preset):
+    """
+    Compute the anchor table of the given SSD preset
+    """
+    box_sizes = get_anchor_box_sizes(preset)
+    props = []
+    maps = []
+    for k in range(len(preset.maps)):
+        fk = preset.maps[k].size[0]
+        coords = (np.arange(fk)+0.5)/float(fk)
+        x, y = np.meshgrid(coords, coords)
+        for w, h in box_sizes[k]:
+            prop = np.empty((fk*fk, 4))
+            prop[:, 0] = x.ravel()
+            prop[:, 1] = y.ravel()
+            prop[:, 2] = w
+            prop[:, 3] = h
+            props.append(prop)
+            maps.append(np.full(fk*fk, k, dtype=np.int32))
+
+    prop = np.concatenate(props)
+    corners = props2corners(prop, ANCHOR_IMG_SIZE)
+    return AnchorTable(prop.astype(np.float32), corners.astype(np.float32),
+                       np.concatenate(maps))
+
+#-------------------------------------------------------------------------------
+
+
+def get_anchor_table(preset, cache_dir=None):
+    """
+    Get the anchor table of the given SSD preset. The tables are memoized
+    per preset and, if cache_dir is given, stored there as .npy files so that
+    they don't have to be recomputed by other processes.
+    """
+    key = repr(preset)
+    if key in _anchor_tables:
+        return _anchor_tables[key]
+
+    table = None
+    if cache_dir is not None:
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()[:8]
+        filename = os.path.join(cache_dir, 'anchors-{}-{}.npy'
+                                .format(preset.name, digest))
+        try:
+            arr = np.load(filename)
+            if arr.shape == (preset.num_anchors, 9):
+                table = AnchorTable(np.ascontiguousarray(arr[:, :4]),
+                                    np.ascontiguousarray(arr[:, 4:8]),
+                                    arr[:, 8].astype(np.int32))
+        except (IOError, ValueError):
+            pass
+
+    if table is None:
+        table = build_anchor_table(preset)
+        if cache_dir is not None:
+            arr = np.concatenate([table.prop, table.corners,
+                                  table.maps[:, np.newaxis]], axis=1)
+            tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+            try:
+                with open(tmp_filename, 'wb') as f:
+                    np.save(f, arr.astype(np.float32))
+                os.rename(tmp_filename, filename)
+            except (IOError, OSError):
+                pass
+
+    _anchor_tables[key] = table
+    return table
+
+#-------------------------------------------------------------------------------
 
 
 def anchors2array(anchors, img_size):
@@ -107,12 +205,16 @@ def anchors2array(anchors, img_size):
     Computes a numpy array out of absolute anchor params (img_size is needed
     as a reference)
     """
-    arr = np.zeros((len(anchors), 4))
-    for i in range(len(anchors)):
-        anchor = anchors[i]
-        xmin, xmax, ymin, ymax = prop2abs(anchor.center, anchor.size, img_size)
-        arr[i] = np.array([xmin, xmax, ymin, ymax])
-    return arr
+    return props2corners(anchors2prop(anchors), img_size)
+
+#-------------------------------------------------------------------------------
+
+
+def anchors2prop(anchors):
+    """
+    Computes a numpy array of proportional [cx, cy, w, h] anchor params
+    """
+    return boxes2props(anchors)
 
 #-------------------------------------------------------------------------------
 
@@ -143,6 +245,266 @@ def jaccard_overlap(box_arr, anchors_arr):
 #-------------------------------------------------------------------------------
 
 
+def jaccard_overlap_matrix(boxes_arr, anchors_arr):
+    """
+    Compute the jaccard overlap of every box with every anchor. Takes an
+    (G, 4) and an (N, 4) array of absolute [xmin, xmax, ymin, ymax] params and
+    returns a (G, N) array of overlaps. The computation is done in the
+    precision of the anchors array; float32 is exact for the integral
+    coordinates of the 1000x1000 reference frame up to the final division.
+    """
+    boxes_arr = np.asarray(boxes_arr).astype(anchors_arr.dtype)
+    areaa = (anchors_arr[:, 1]-anchors_arr[:, 0]+1) * \
+            (anchors_arr[:, 3]-anchors_arr[:, 2]+1)
+    areab = (boxes_arr[:, 1]-boxes_arr[:, 0]+1) * \
+            (boxes_arr[:, 3]-boxes_arr[:, 2]+1)
+
+    w = np.minimum(boxes_arr[:, 1:2], anchors_arr[:, 1])
+    w -= np.maximum(boxes_arr[:, 0:1], anchors_arr[:, 0])
+    w += 1
+    np.maximum(w, 0, out=w)
+
+    h = np.minimum(boxes_arr[:, 3:4], anchors_arr[:, 3])
+    h -= np.maximum(boxes_arr[:, 2:3], anchors_arr[:, 2])
+    h += 1
+    np.maximum(h, 0, out=h)
+
+    intersection = w
+    intersection *= h
+    union = areab[:, np.newaxis] + areaa
+    union -= intersection
+    intersection /= union
+    return intersection
+
+#-------------------------------------------------------------------------------
+
+
+def match_overlaps(box_ids, anchor_ids, scores):
+    """
+    Match the ground truth boxes to anchors given the (box_id, anchor_id,
+    score) triplets of all the pairs whose jaccard overlap is above the
+    matching threshold. Every anchor is assigned to the box it overlaps the
+    most. Then every box claims the anchor it overlaps the most, and when
+    several boxes claim the same anchor the best one wins. The ties are
+    resolved in favor of the box (or anchor) that comes first.
+    :return: a tuple of (box_ids, anchor_ids) arrays of matched pairs
+    """
+    if len(scores) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+
+    #---------------------------------------------------------------------------
+    # Assign the anchors to the boxes they overlap the most
+    #---------------------------------------------------------------------------
+    order = np.lexsort((box_ids, -scores, anchor_ids))
+    anchors = anchor_ids[order]
+    first = np.r_[True, anchors[1:] != anchors[:-1]]
+    matched = anchors[first]
+    assignment = box_ids[order][first]
+
+    #---------------------------------------------------------------------------
+    # Let the boxes claim their best anchors
+    #---------------------------------------------------------------------------
+    order = np.lexsort((anchor_ids, -scores, box_ids))
+    boxes = box_ids[order]
+    first = np.r_[True, boxes[1:] != boxes[:-1]]
+    claims = order[first]
+
+    order = np.lexsort((box_ids[claims], -scores[claims], anchor_ids[claims]))
+    claims = claims[order]
+    anchors = anchor_ids[claims]
+    first = np.r_[True, anchors[1:] != anchors[:-1]]
+    claims = claims[first]
+
+    pos = np.searchsorted(matched, anchor_ids[claims])
+    assignment[pos] = box_ids[claims]
+    return assignment, matched
+
+#-------------------------------------------------------------------------------
+
+
+def match_anchors(overlaps, threshold=0.5):
+    """
+    Match the ground truth boxes to anchors given a (G, N) matrix of their
+    jaccard overlaps, only considering the overlaps above the threshold. See
+    match_overlaps for details.
+    :return: a tuple of (box_ids, anchor_ids) arrays of matched pairs
+    """
+    box_ids, anchor_ids = np.nonzero(overlaps > threshold)
+    return match_overlaps(box_ids, anchor_ids, overlaps[box_ids, anchor_ids])
+
+#-------------------------------------------------------------------------------
+
+
+class AnchorIndex:
+    """
+    Find the anchors that may overlap given boxes enough without computing
+    the overlap with every anchor. The anchors of a preset come in groups of
+    the same size laid out on a regular grid of a feature map, so for every
+    group we can tell whether its size allows for a large enough overlap and
+    which cells of the grid are close enough to the box.
+    """
+    #---------------------------------------------------------------------------
+    def __init__(self, preset, table=None):
+        if table is None:
+            table = get_anchor_table(preset)
+        self.corners = table.corners
+
+        #-----------------------------------------------------------------------
+        # Compute the grid parameters and the size bounds of every group of
+        # anchors. The bounds are computed from the actual absolute params,
+        # because truncating them to integers makes them differ by a pixel.
+        #-----------------------------------------------------------------------
+        groups = []
+        offset = 0
+        for k, sizes in enumerate(get_anchor_box_sizes(preset)):
+            fk = preset.maps[k].size[0]
+            for _ in sizes:
+                c = self.corners[offset:offset+fk*fk].astype(np.float64)
+                w = c[:, 1]-c[:, 0]+1
+                h = c[:, 3]-c[:, 2]+1
+                groups.append((offset, fk, ANCHOR_IMG_SIZE.w/float(fk),
+                               ANCHOR_IMG_SIZE.h/float(fk), w.min(), w.max(),
+                               h.min(), h.max()))
+                offset += fk*fk
+        groups = np.array(groups, dtype=np.float64)
+        self.offsets = groups[:, 0].astype(np.int64)
+        self.map_sizes = groups[:, 1].astype(np.int64)
+        self.cell_w = groups[:, 2]
+        self.cell_h = groups[:, 3]
+        self.w_min = groups[:, 4]
+        self.w_max = groups[:, 5]
+        self.h_min = groups[:, 6]
+        self.h_max = groups[:, 7]
+
+    #---------------------------------------------------------------------------
+    def candidates(self, boxes_arr, threshold):
+        """
+        Find the anchors that may have a jaccard overlap above the threshold
+        with the given boxes.
+        :param boxes_arr: a (G, 4) array of absolute [xmin, xmax, ymin, ymax]
+                          box params in the 1000x1000 reference frame
+        :return: a tuple of (box_ids, anchor_ids) arrays of candidate pairs
+        """
+        boxes_arr = np.asarray(boxes_arr, dtype=np.float64)
+        bw = (boxes_arr[:, 1]-boxes_arr[:, 0]+1)[:, np.newaxis]
+        bh = (boxes_arr[:, 3]-boxes_arr[:, 2]+1)[:, np.newaxis]
+        bcx = ((boxes_arr[:, 0]+boxes_arr[:, 1])/2)[:, np.newaxis]
+        bcy = ((boxes_arr[:, 2]+boxes_arr[:, 3])/2)[:, np.newaxis]
+
+        #-----------------------------------------------------------------------
+        # The best overlap an anchor of a group may have with a box is reached
+        # when they're centered at the same point and the anchor's size is
+        # as close as possible to the size of the box
+        #-----------------------------------------------------------------------
+        aw = np.clip(bw, self.w_min, self.w_max)
+        ah = np.clip(bh, self.h_min, self.h_max)
+        inter = np.minimum(aw, bw)*np.minimum(ah, bh)
+        best = inter/(aw*ah+bw*bh-inter)
+
+        #-----------------------------------------------------------------------
+        # The overlap is above the threshold only if the intersection is
+        # above threshold*(area_a+area_b)/(1+threshold); the width (height) of
+        # the intersection is at most (w_a+w_b)/2 minus the distance of the
+        # centers, which bounds how far from the box the anchors may be
+        #-----------------------------------------------------------------------
+        need = threshold*(self.w_min*self.h_min+bw*bh)/(1+threshold)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rx = (self.w_max+bw)/2 - need/np.minimum(self.h_max, bh)
+            ry = (self.h_max+bh)/2 - need/np.minimum(self.w_max, bw)
+
+        # anchors' centers differ from the grid points by less than a pixel
+        # after truncating their params to integers
+        i_lo = np.maximum(np.ceil((bcx-rx-1)/self.cell_w-0.5), 0)
+        i_hi = np.minimum(np.floor((bcx+rx+1)/self.cell_w-0.5),
+                          self.map_sizes-1)
+        j_lo = np.maximum(np.ceil((bcy-ry-1)/self.cell_h-0.5), 0)
+        j_hi = np.minimum(np.floor((bcy+ry+1)/self.cell_h-0.5),
+                          self.map_sizes-1)
+
+        hits = (best > threshold-1e-6) & (i_lo <= i_hi) & (j_lo <= j_hi)
+
+        #-----------------------------------------------------------------------
+        # Enumerate the anchors of the grid windows
+        #-----------------------------------------------------------------------
+        box_ids = []
+        anchor_ids = []
+        for g, k in zip(*np.nonzero(hits)):
+            ii = np.arange(i_lo[g, k], i_hi[g, k]+1, dtype=np.int64)
+            jj = np.arange(j_lo[g, k], j_hi[g, k]+1, dtype=np.int64)
+            idxs = self.offsets[k] + (jj[:, np.newaxis]*self.map_sizes[k]+ii)
+            anchor_ids.append(idxs.ravel())
+            box_ids.append(np.full(idxs.size, g, dtype=np.int64))
+
+        if not anchor_ids:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+        return np.concatenate(box_ids), np.concatenate(anchor_ids)
+
+    #---------------------------------------------------------------------------
+    def overlaps(self, boxes_arr, threshold, check=False):
+        """
+        Compute the jaccard overlaps above the threshold between the given
+        boxes and the anchors.
+        :param boxes_arr: a (G, 4) array of absolute [xmin, xmax, ymin, ymax]
+                          box params in the 1000x1000 reference frame
+        :param check:     compare the result with the one computed using all
+                          the anchors and raise a RuntimeError on mismatch
+        :return: a tuple of (box_ids, anchor_ids, scores) arrays
+        """
+        boxes_arr = np.asarray(boxes_arr).astype(self.corners.dtype)
+        box_ids, anchor_ids = self.candidates(boxes_arr, threshold)
+
+        boxes = boxes_arr[box_ids]
+        anchors = self.corners[anchor_ids]
+        areaa = (anchors[:, 1]-anchors[:, 0]+1) * (anchors[:, 3]-anchors[:, 2]+1)
+        areab = (boxes[:, 1]-boxes[:, 0]+1) * (boxes[:, 3]-boxes[:, 2]+1)
+        w = np.minimum(boxes[:, 1], anchors[:, 1]) - \
+            np.maximum(boxes[:, 0], anchors[:, 0]) + 1
+        h = np.minimum(boxes[:, 3], anchors[:, 3]) - \
+            np.maximum(boxes[:, 2], anchors[:, 2]) + 1
+        intersection = np.maximum(w, 0)*np.maximum(h, 0)
+        scores = intersection/(areab+areaa-intersection)
+
+        keep = scores > threshold
+        box_ids = box_ids[keep]
+        anchor_ids = anchor_ids[keep]
+        scores = scores[keep]
+
+        if check:
+            full = jaccard_overlap_matrix(boxes_arr, self.corners)
+            ref_box_ids, ref_anchor_ids = np.nonzero(full > threshold)
+            order = np.lexsort((anchor_ids, box_ids))
+            if not (np.array_equal(box_ids[order], ref_box_ids) and
+                    np.array_equal(anchor_ids[order], ref_anchor_ids) and
+                    np.allclose(scores[order],
+                                full[ref_box_ids, ref_anchor_ids])):
+                raise RuntimeError('Anchor index mismatch: {} pairs found, '
+                                   '{} expected'.format(len(box_ids),
+                                                        len(ref_box_ids)))
+
+        return box_ids, anchor_ids, scores
+
+    #---------------------------------------------------------------------------
+    def compute_overlap(self, box_arr, threshold):
+        """
+        Same as compute_overlap(box_arr, anchors, threshold) but only tests
+        the candidate anchors. Requires threshold to be non-negative.
+        """
+        box_arr = np.asarray(box_arr)[np.newaxis]
+        _, anchor_ids, scores = self.overlaps(box_arr, threshold)
+        order = np.lexsort((anchor_ids, -scores))
+        best = None
+        if len(order):
+            best = Score(anchor_ids[order[0]], scores[order[0]])
+        order = np.argsort(anchor_ids)
+        good = [Score(idx, score)
+                for idx, score in zip(anchor_ids[order], scores[order])]
+        return Overlap(best, good)
+
+#-------------------------------------------------------------------------------
+
+
 def compute_overlap(box_arr, anchors_arr, threshold):
     iou = jaccard_overlap(box_arr, anchors_arr)
     overlap = iou > threshold
@@ -174,6 +536,22 @@ def compute_location(box, anchor):
 #-------------------------------------------------------------------------------
 
 
+def encode_locations(boxes_prop, anchors_prop):
+    """
+    Vectorized version of compute_location. Takes an (N, 4) array of
+    proportional [cx, cy, w, h] boxes and an (N, 4) array of the matching
+    proportional anchor params and returns an (N, 4) array of offsets.
+    """
+    arr = np.empty((len(boxes_prop), 4), dtype=np.float64)
+    arr[:, 0] = (boxes_prop[:, 0]-anchors_prop[:, 0])/anchors_prop[:, 2]*10
+    arr[:, 1] = (boxes_prop[:, 1]-anchors_prop[:, 1])/anchors_prop[:, 3]*10
+    arr[:, 2] = np.log(boxes_prop[:, 2]/anchors_prop[:, 2])*5
+    arr[:, 3] = np.log(boxes_prop[:, 3]/anchors_prop[:, 3])*5
+    return arr
+
+#-------------------------------------------------------------------------------
+
+
 def decode_location(box, anchor):
     box[box > 100] = 100  # only happens early training
 
@@ -186,134 +564,241 @@ def decode_location(box, anchor):
 #-------------------------------------------------------------------------------
 
 
-def decode_boxes(pred, anchors, confidence_threshold=0.01, lid2name={},
-                 detections_cap=200):
+def decode_locations(loc, anchors_prop):
+    """
+    Vectorized version of decode_location. Takes an (N, 4) array of encoded
+    offsets and an (N, 4) array of the matching proportional anchor params
+    and returns an (N, 4) array of proportional [cx, cy, w, h] boxes.
+    """
+    loc = np.minimum(loc, 100)  # only happens early training
+
+    boxes = np.empty(loc.shape, dtype=np.float64)
+    boxes[:, 0] = loc[:, 0]/10 * anchors_prop[:, 2] + anchors_prop[:, 0]
+    boxes[:, 1] = loc[:, 1]/10 * anchors_prop[:, 3] + anchors_prop[:, 1]
+    boxes[:, 2] = np.exp(loc[:, 2]/5) * anchors_prop[:, 2]
+    boxes[:, 3] = np.exp(loc[:, 3]/5) * anchors_prop[:, 3]
+    return boxes
+
+#-------------------------------------------------------------------------------
+
+
+def select_top_k(scores, groups, k):
     """
-    Decode boxes from the neural net predictions.
-    Label names are decoded using the lid2name dictionary - the id to name
-    translation is not done if the corresponding key does not exist.
+    Find the indices of at most k highest scores in every group. Only the
+    groups having more than k elements get partitioned.
+    :return: a sorted array of indices
     """
+    counts = np.bincount(groups)
+    full = np.flatnonzero(counts > k)
+    if len(full) == 0:
+        return np.arange(len(scores))
+
+    keep = np.ones(len(scores), dtype=bool)
+    for group in full:
+        members = np.flatnonzero(groups == group)
+        part = np.argpartition(-scores[members], k-1)[k:]
+        keep[members[part]] = False
+    return np.flatnonzero(keep)
+
+#-------------------------------------------------------------------------------
+
+
+def decode_boxes(pred, anchors, confidence_threshold=0.01, detections_cap=200,
+                 class_detections_cap=None):
+    """
+    Decode boxes from the neural net predictions for a whole batch at once.
+    Only the confidences above the threshold are considered, they are
+    partitioned down to the caps and only the survivors get sorted.
+    :param pred:                 the (batch_size, num_anchors, num_classes+4)
+                                 result tensor of the network or the
+                                 (num_anchors, num_classes+4) result for a
+                                 single image
+    :param anchors:              an (num_anchors, 4) array of proportional
+                                 anchor params (see AnchorTable) or a list of
+                                 Anchor tuples
+    :param detections_cap:       maximum number of detections per image;
+                                 None means no limit
+    :param class_detections_cap: maximum number of detections per class and
+                                 image; None means no limit
+    :return: Detections with normalized boxes, grouped by image and sorted
+             by decreasing confidence within each image
+    """
+    if not isinstance(anchors, np.ndarray):
+        anchors = anchors2prop(anchors)
+    if pred.ndim == 2:
+        pred = pred[np.newaxis]
 
     #---------------------------------------------------------------------------
-    # Find the detections
+    # Find the detections with confidence over a threshold
     #---------------------------------------------------------------------------
-    num_classes = pred.shape[1]-4
-    bg_class = num_classes-1
-    box_class = np.argmax(pred[:, :num_classes-1], axis=1)
-    confidence = pred[np.arange(len(pred)), box_class]
-    if detections_cap is not None:
-        detections = np.argsort(confidence)[::-1][:detections_cap]
-    else:
-        detections = np.argsort(confidence)[::-1]
+    num_classes = pred.shape[2]-4
+    confidence = np.max(pred[:, :, :num_classes-1], axis=2)
+
+    image_ids, anchor_ids = np.nonzero(confidence >= confidence_threshold)
+    scores = confidence[image_ids, anchor_ids]
+    labels = np.argmax(pred[image_ids, anchor_ids, :num_classes-1], axis=1)
 
     #---------------------------------------------------------------------------
-    # Decode coordinates of each box with confidence over a threshold
+    # Apply the caps and sort the survivors
     #---------------------------------------------------------------------------
-    boxes = []
-    for idx in detections:
-        confidence = pred[idx, box_class[idx]]
-        if confidence < confidence_threshold:
-            break
-
-        center, size = decode_location(pred[idx, num_classes:], anchors[idx])
-        cid = box_class[idx]
-        cname = None
-        if cid in lid2name:
-            cname = lid2name[cid]
-        det = (confidence, normalize_box(Box(cname, cid, center, size)))
-        boxes.append(det)
+    if class_detections_cap is not None:
+        keep = select_top_k(scores, image_ids*num_classes+labels,
+                            class_detections_cap)
+        image_ids = image_ids[keep]
+        anchor_ids = anchor_ids[keep]
+        scores = scores[keep]
+        labels = labels[keep]
 
-    return boxes
+    if detections_cap is not None:
+        keep = select_top_k(scores, image_ids, detections_cap)
+        image_ids = image_ids[keep]
+        anchor_ids = anchor_ids[keep]
+        scores = scores[keep]
+        labels = labels[keep]
+
+    order = np.lexsort((-scores, image_ids))
+    image_ids = image_ids[order]
+    anchor_ids = anchor_ids[order]
+    scores = scores[order]
+    labels = labels[order]
+
+    #---------------------------------------------------------------------------
+    # Decode their coordinates
+    #---------------------------------------------------------------------------
+    loc = pred[image_ids, anchor_ids, num_classes:]
+    boxes = decode_locations(loc, anchors[anchor_ids])
+    boxes = normalize_props(boxes)
+    return Detections(boxes, scores, labels, image_ids)
 
 #-------------------------------------------------------------------------------
 
 
-def non_maximum_suppression(boxes, overlap_threshold):
+def batched_nms(boxes, scores, labels, overlap_threshold=0.45,
+                image_ids=None, top_k=None, max_detections=None):
+    """
+    Run a per-class non-maximum suppression over the detections of a whole
+    batch of images.
+    :param boxes:             an (N, 4) array of absolute [xmin, xmax, ymin,
+                              ymax] box params
+    :param scores:            an (N) array of confidences
+    :param labels:            an (N) array of class ids; boxes of different
+                              classes never suppress each other
+    :param overlap_threshold: the jaccard overlap above which the less
+                              confident box is suppressed
+    :param image_ids:         an (N) array of ids of the images the
+                              detections come from; None means one image
+    :param top_k:             number of the most confident detections per
+                              image considered for suppression; None means
+                              all of them
+    :param max_detections:    maximum number of detections kept per image;
+                              None means no limit
+    :return: indices of the selected detections grouped by image and sorted by
+             decreasing confidence within each image; the detections with
+             non-finite boxes or scores are never selected
+    """
+    if len(scores) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    scores = np.asarray(scores)
+    labels = np.asarray(labels)
+    if image_ids is None:
+        image_ids = np.zeros(len(scores), dtype=np.int64)
+    image_ids = np.asarray(image_ids)
+    boxes = np.asarray(boxes, dtype=np.float64)
+
     #---------------------------------------------------------------------------
-    # Convert to absolute coordinates and to a more convenient format
+    # Drop the detections with non-finite params on purpose: they can't be
+    # compared with anything and they would spoil the class offsets of all
+    # the others
     #---------------------------------------------------------------------------
-    xmin = []
-    xmax = []
-    ymin = []
-    ymax = []
-    conf = []
-    img_size = Size(1000, 1000)
-
-    for box in boxes:
-        params = prop2abs(box[1].center, box[1].size, img_size)
-        xmin.append(params[0])
-        xmax.append(params[1])
-        ymin.append(params[2])
-        ymax.append(params[3])
-        conf.append(box[0])
-
-    xmin = np.array(xmin)
-    xmax = np.array(xmax)
-    ymin = np.array(ymin)
-    ymax = np.array(ymax)
-    conf = np.array(conf)
+    finite = np.isfinite(boxes).all(axis=1) & np.isfinite(scores)
+    if not finite.all():
+        keep = np.flatnonzero(finite)
+        pick = batched_nms(boxes[keep], scores[keep], labels[keep],
+                           overlap_threshold, image_ids[keep], top_k,
+                           max_detections)
+        return keep[pick]
 
     #---------------------------------------------------------------------------
-    # Compute the area of each box and sort the indices by confidence level
-    # (lowest confidence first first).
+    # Shift the boxes of each class by an offset larger than the extent of all
+    # the boxes, so that boxes of different classes never overlap and
+    # all the classes can be processed in one go
     #---------------------------------------------------------------------------
+    boxes = boxes - boxes.min()
+    offsets = labels.astype(np.float64)*(boxes.max()+2)
+    boxes = boxes + offsets[:, np.newaxis]
+    xmin = boxes[:, 0]
+    xmax = boxes[:, 1]
+    ymin = boxes[:, 2]
+    ymax = boxes[:, 3]
     area = (xmax-xmin+1) * (ymax-ymin+1)
-    idxs = np.argsort(conf)
-    pick = []
 
     #---------------------------------------------------------------------------
-    # Loop until we still have indices to process
+    # Sort the detections by image and by decreasing confidence and figure out
+    # where the detections of each image start and end
     #---------------------------------------------------------------------------
-    while len(idxs) > 0:
-        #-----------------------------------------------------------------------
-        # Grab the last index (ie. the most confident detection), remove it from
-        # the list of indices to process, and put it on the list of picks
-        #-----------------------------------------------------------------------
-        last = idxs.shape[0]-1
-        i = idxs[last]
-        idxs = np.delete(idxs, last)
-        pick.append(i)
-        suppress = []
+    order = np.lexsort((-scores, image_ids))
+    sorted_ids = image_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    ends = np.r_[starts[1:], len(order)]
 
-        #-----------------------------------------------------------------------
-        # Figure out the intersection with the remaining windows
-        #-----------------------------------------------------------------------
-        xxmin = np.maximum(xmin[i], xmin[idxs])
-        xxmax = np.minimum(xmax[i], xmax[idxs])
-        yymin = np.maximum(ymin[i], ymin[idxs])
-        yymax = np.minimum(ymax[i], ymax[idxs])
-
-        w = np.maximum(0, xxmax-xxmin+1)
-        h = np.maximum(0, yymax-yymin+1)
-        intersection = w*h
+    pick = []
+    for start, end in zip(starts, ends):
+        if top_k is not None:
+            end = min(end, start+top_k)
+        idxs = order[start:end]
+        num_picked = 0
 
         #-----------------------------------------------------------------------
-        # Compute IOU and suppress indices with IOU higher than a threshold
+        # Take the most confident remaining detection and drop the remaining
+        # ones that overlap with it too much
         #-----------------------------------------------------------------------
-        union = area[i]+area[idxs]-intersection
-        iou = intersection/union
-        overlap = iou > overlap_threshold
-        suppress = np.nonzero(overlap)[0]
-        idxs = np.delete(idxs, suppress)
+        while len(idxs) > 0:
+            i = idxs[0]
+            pick.append(i)
+            num_picked += 1
+            if max_detections is not None and num_picked >= max_detections:
+                break
+
+            idxs = idxs[1:]
+            xxmin = np.maximum(xmin[i], xmin[idxs])
+            xxmax = np.minimum(xmax[i], xmax[idxs])
+            yymin = np.maximum(ymin[i], ymin[idxs])
+            yymax = np.minimum(ymax[i], ymax[idxs])
+
+            w = np.maximum(0, xxmax-xxmin+1)
+            h = np.maximum(0, yymax-yymin+1)
+            intersection = w*h
+            union = area[i]+area[idxs]-intersection
+            idxs = idxs[intersection <= overlap_threshold*union]
+
+    return np.array(pick, dtype=np.int64)
 
-    #---------------------------------------------------------------------------
-    # Return the selected boxes
-    #---------------------------------------------------------------------------
-    selected = []
-    for i in pick:
-        selected.append(boxes[i])
+#-------------------------------------------------------------------------------
 
-    return selected
 
-#-------------------------------------------------------------------------------
+def non_maximum_suppression(detections, overlap_threshold, top_k=None,
+                            max_detections=None):
+    """
+    Run the non-maximum suppression over the detections of every image
+    disregarding their labels
+    """
+    labels = np.zeros(len(detections), dtype=np.int64)
+    pick = batched_nms(detections.corners, detections.scores, labels,
+                       overlap_threshold, detections.image_ids, top_k,
+                       max_detections)
+    return detections[pick]
 
+#-------------------------------------------------------------------------------
 
-def suppress_overlaps(boxes):
-    class_boxes = defaultdict(list)
-    selected_boxes = []
-    for box in boxes:
-        class_boxes[box[1].labelid].append(box)
 
-    for k, v in class_boxes.items():
-        selected_boxes += non_maximum_suppression(v, 0.45)
-    return selected_boxes
+def suppress_overlaps(detections, overlap_threshold=0.45, top_k=None,
+                      max_detections=None):
+    """
+    Run the non-maximum suppression over the detections of every image
+    separately for every class
+    """
+    pick = batched_nms(detections.corners, detections.scores,
+                       detections.labels, overlap_threshold,
+                       detections.image_ids, top_k, max_detections)
+    return detections[pick]
@@ -9,7 +9,8 @@ import numpy as np
 
 from average_precision import APCalculator, APs2mAP
 from training_data import TrainingData
-from ssdutils import get_anchors_for_preset, decode_boxes, suppress_overlaps
+from ssdutils import get_anchor_table
+from ssdutils import decode_boxes, suppress_overlaps
 from ssdvgg import SSDVGG
 from utils import *
 from tqdm import tqdm
@@ -57,6 +58,23 @@ def main():
                         help='continue training from the latest checkpoint')
     parser.add_argument('--num-workers', type=int, default=mp.cpu_count(),
                         help='number of parallel generators')
+    parser.add_argument('--image-cache-size', type=float, default=0,
+                        help='size of the shared cache of the decoded images '
+                             'in GB; 0 disables the cache')
+    parser.add_argument('--views', type=int, default=1,
+                        help='number of augmented training samples made out '
+                             'of every decoded image')
+    parser.add_argument('--views-in-batch', type=str2bool, default='False',
+                        help='put the views of an image in the same batch')
+    parser.add_argument('--shards-dir', default=None,
+                        help='stream the training samples from the augmented '
+                             'epochs materialized by process_dataset.py in '
+                             'this directory')
+    parser.add_argument('--cache-valid', type=str2bool, default='True',
+                        help='store the processed validation samples after '
+                             'the first validation pass and reuse them')
+    parser.add_argument('--profile-transforms', type=str2bool, default='False',
+                        help='print the timings of the transforms every epoch')
 
     args = parser.parse_args()
 
@@ -73,6 +91,12 @@ def main():
     print('[i] Weight decay:         ', args.weight_decay)
     print('[i] Continue:             ', args.continue_training)
     print('[i] Number of workers:    ', args.num_workers)
+    print('[i] Image cache size (GB):', args.image_cache_size)
+    print('[i] Views per image:      ', args.views)
+    print('[i] Views in batch:       ', args.views_in_batch)
+    print('[i] Profile transforms:   ', args.profile_transforms)
+    print('[i] Shards directory:     ', args.shards_dir)
+    print('[i] Cache validation set: ', args.cache_valid)
 
     #---------------------------------------------------------------------------
     # Find an existing checkpoint
@@ -130,7 +154,11 @@ def main():
     #---------------------------------------------------------------------------
     print('[i] Configuring the training data...')
     try:
-        td = TrainingData(args.data_dir)
+        td = TrainingData(args.data_dir,
+                          int(args.image_cache_size*1024**3),
+                          args.views, args.views_in_batch,
+                          args.profile_transforms, args.shards_dir,
+                          args.cache_valid, start_epoch)
         print('[i] # training samples:   ', td.num_train)
         print('[i] # validation samples: ', td.num_valid)
         print('[i] # classes:            ', td.num_classes)
@@ -186,7 +214,7 @@ def main():
                                                sess.graph)
         saver = tf.train.Saver(max_to_keep=20)
 
-        anchors = get_anchors_for_preset(td.preset)
+        anchors = get_anchor_table(td.preset, args.data_dir).prop
         training_ap_calc = APCalculator()
         validation_ap_calc = APCalculator()
 
@@ -201,9 +229,9 @@ def main():
                                          td.lname2id.keys(), restore)
 
         training_imgs = ImageSummary(sess, summary_writer, 'training',
-                                     td.label_colors, restore)
+                                     td.label_colors, td.lid2name, restore)
         validation_imgs = ImageSummary(sess, summary_writer, 'validation',
-                                       td.label_colors, restore)
+                                       td.label_colors, td.lid2name, restore)
 
         training_loss = LossSummary(sess, summary_writer, 'training',
                                     td.num_train, restore)
@@ -252,9 +280,10 @@ def main():
                 if e == 0:
                     continue
 
-                for i in range(result.shape[0]):
-                    boxes = decode_boxes(result[i], anchors, 0.5, td.lid2name)
-                    boxes = suppress_overlaps(boxes)
+                detections = decode_boxes(result, anchors, 0.5)
+                detections = suppress_overlaps(detections)
+                detections = detections.split(result.shape[0])
+                for i, boxes in enumerate(detections):
                     training_ap_calc.add_detections(gt_boxes[i], boxes)
 
                     if len(training_imgs_samples) < 3:
@@ -278,9 +307,10 @@ def main():
                 if e == 0:
                     continue
 
-                for i in range(result.shape[0]):
-                    boxes = decode_boxes(result[i], anchors, 0.5, td.lid2name)
-                    boxes = suppress_overlaps(boxes)
+                detections = decode_boxes(result, anchors, 0.5)
+                detections = suppress_overlaps(detections)
+                detections = detections.split(result.shape[0])
+                for i, boxes in enumerate(detections):
                     validation_ap_calc.add_detections(gt_boxes[i], boxes)
 
                     if len(validation_imgs_samples) < 3:
@@ -311,6 +341,16 @@ def main():
 
             summary_writer.flush()
 
+            if td.image_cache is not None:
+                print('[i] Image cache: {hits} hits, {misses} misses, '
+                      '{evictions} evictions, {images} images, {bytes} bytes'
+                      .format(**td.image_cache.stats()))
+
+            if td.transform_profiler is not None:
+                print('[i] Transform profile:')
+                print(td.transform_profiler.table())
+                td.transform_profiler.clear()
+
             #-------------------------------------------------------------------
             # Save a checktpoint
             #-------------------------------------------------------------------
@@ -323,6 +363,7 @@ def main():
         saver.save(sess, checkpoint)
         print('[i] Checkpoint saved:', checkpoint)
 
+    td.close()
     return 0
 
 
@@ -1,14 +1,19 @@
 import pickle
 import random
 import math
-import cv2
-import os
 
-import multiprocessing as mp
 import numpy as np
-import Queue as q
 
-from data_queue import DataQueue
+from epoch_shards import EpochShards
+from sample_cache import SampleCache, transforms_key
+from sparse_labels import SparseLabels
+from image_cache import ImageCache
+from image_loader import set_image_cache
+from ssdutils import get_anchor_table
+from transforms import Transform, LabelCreatorTransform, run_views
+from transform_compiler import compile_transforms
+from transform_profiler import TransformProfiler
+from worker_pool import WorkerPool
 from copy import copy
 
 #-------------------------------------------------------------------------------
@@ -16,7 +21,30 @@ from copy import copy
 
 class TrainingData:
     #---------------------------------------------------------------------------
-    def __init__(self, data_dir):
+    def __init__(self, data_dir, image_cache_size=0, views=1,
+                 views_in_batch=False, profile=False, shards_dir=None,
+                 cache_valid=False, start_epoch=0):
+        """
+        :param image_cache_size: the byte budget of the shared cache of the
+                                 decoded images; 0 disables the cache
+        :param views:            number of independently augmented training
+                                 samples made out of every decoded image
+        :param views_in_batch:   put the views of an image in the same batch
+                                 instead of spreading them over consecutive
+                                 batches
+        :param profile:          collect the timings of the transforms in
+                                 transform_profiler
+        :param shards_dir:       stream the training samples from the epochs
+                                 materialized in this directory instead of
+                                 augmenting them
+        :param cache_valid:      store the processed validation samples in
+                                 the data directory during the first
+                                 validation pass and stream them from there
+                                 afterwards
+        :param start_epoch:      the training epoch to start at, so that the
+                                 epoch shards continue where the restored
+                                 training left off
+        """
         #-----------------------------------------------------------------------
         # Read the dataset info
         #-----------------------------------------------------------------------
@@ -45,144 +73,286 @@ class TrainingData:
         self.lname2id = data['lname2id']
         self.train_tfs = data['train-transforms']
         self.valid_tfs = data['valid-transforms']
-        self.train_generator = self.__batch_generator(train_samples,
-                                                      self.train_tfs)
-        self.valid_generator = self.__batch_generator(valid_samples,
+        self.batch_distort = data.get('batch-distort')
+        self.processors = {}
+        self.pool = None
+        self.train_generator = self.__batch_generator('train', train_samples,
+                                                      self.train_tfs,
+                                                      views, views_in_batch,
+                                                      self.batch_distort)
+        self.valid_generator = self.__batch_generator('valid', valid_samples,
                                                       self.valid_tfs)
+        self.shards = None
+        if shards_dir is not None:
+            self.shards = EpochShards(shards_dir, start_epoch)
+            if self.shards.num_samples != len(train_samples) or \
+               self.shards.image_size != self.preset.image_size:
+                raise RuntimeError('The epoch shards in {} do not match the '
+                                   'training data'.format(shards_dir))
+            self.train_generator = self.__shard_generator()
         self.num_train = len(train_samples)
         self.num_valid = len(valid_samples)
         self.train_samples = list(map(lambda x: x[2], train_samples))
         self.valid_samples = list(map(lambda x: x[2], valid_samples))
 
+        #-----------------------------------------------------------------------
+        # The validation transforms are deterministic, so their results can
+        # be reused as long as the preset, the samples and the transforms
+        # stay the same
+        #-----------------------------------------------------------------------
+        self.valid_cache = None
+        if cache_valid:
+            key = repr((self.preset, self.num_classes, self.valid_samples,
+                        transforms_key(self.valid_tfs)))
+            self.valid_cache = SampleCache(data_dir, 'valid-cache-' +
+                                           self.preset.name, key,
+                                           self.preset.num_anchors,
+                                           self.num_classes)
+            self.valid_generator = self.__cached_generator(
+                self.valid_cache, self.valid_generator, self.num_valid)
+
+        #-----------------------------------------------------------------------
+        # Compute the anchors before the workers get forked so that they can
+        # share them
+        #-----------------------------------------------------------------------
+        get_anchor_table(self.preset, data_dir)
+
+        #-----------------------------------------------------------------------
+        # Set the image cache up for the same reason
+        #-----------------------------------------------------------------------
+        self.image_cache = None
+        if image_cache_size > 0:
+            self.image_cache = ImageCache(image_cache_size)
+        set_image_cache(self.image_cache)
+
+        #-----------------------------------------------------------------------
+        # The workers profile the transforms on their own and the results
+        # get merged here
+        #-----------------------------------------------------------------------
+        self.transform_profiler = None
+        if profile:
+            self.transform_profiler = TransformProfiler()
+        Transform.profiler = self.transform_profiler
+
+    #---------------------------------------------------------------------------
+    def __shard_generator(self):
+        label_creator = LabelCreatorTransform(preset=self.preset,
+                                              num_classes=self.num_classes)
+
+        #-----------------------------------------------------------------------
+        # The images are ready, only the labels need to be made out of the
+        # ground truth, which is cheap enough to do here
+        #-----------------------------------------------------------------------
+        def gen_batch(batch_size, num_workers=0):
+            for images, gts in self.shards.read_epoch(batch_size):
+                labels = [label_creator(None, None, gt)[1] for gt in gts]
+                images = images.astype(np.float32)
+                labels = np.array(labels, dtype=np.float32)
+                yield images, labels, [gt.boxes for gt in gts]
+
+        return gen_batch
+
+    #---------------------------------------------------------------------------
+    def __cached_generator(self, cache, generator, num_samples):
+        def gen_batch(batch_size, num_workers=0):
+            if cache.complete():
+                return cache.read(batch_size)
+            return cache.write(generator(batch_size, num_workers),
+                               num_samples)
+
+        return gen_batch
+
+    #---------------------------------------------------------------------------
+    def __get_pool(self, batch_size, num_workers):
+        #-----------------------------------------------------------------------
+        # The workers are kept for the following epochs and serve all the
+        # generators; they only get replaced if they can't hold the batches
+        #-----------------------------------------------------------------------
+        if self.pool is not None:
+            if self.pool.num_workers == num_workers and \
+               self.pool.img_shape[0] >= batch_size:
+                return self.pool
+            self.pool.close()
+
+        img_template = np.zeros((batch_size, self.preset.image_size.h,
+                                 self.preset.image_size.w, 3),
+                                dtype=np.float32)
+        self.pool = WorkerPool(self.processors, img_template, num_workers)
+        return self.pool
+
+    #---------------------------------------------------------------------------
+    def explain(self, sample_index, train=True):
+        """
+        Plan the transforms of a sample the way the generators do
+        :param train: take the sample and the transforms from the training
+                      set, otherwise from the validation set
+        :return: a list of the descriptions of the image steps
+        """
+        samples = self.train_samples if train else self.valid_samples
+        transforms = self.train_tfs if train else self.valid_tfs
+        compiled = compile_transforms(transforms)
+        _, _, steps = compiled.prepare_matched(None, samples[sample_index])
+        return compiled.explain(steps)
+
     #---------------------------------------------------------------------------
-    def __batch_generator(self, sample_list_, transforms):
+    def close(self):
+        """
+        Stop the workers
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    #---------------------------------------------------------------------------
+    def __batch_generator(self, name, sample_list_, transforms, views=1,
+                          views_in_batch=False, batch_distort=None):
         image_size = (self.preset.image_size.w, self.preset.image_size.h)
+        compiled = compile_transforms(transforms)
 
         #-----------------------------------------------------------------------
-        def run_transforms(sample):
-            args = sample
-            for t in transforms:
-                args = t(*args)
-            return args
-
-        #-----------------------------------------------------------------------
-        def process_samples(samples):
-            images = []
-            labels = []
-            gt_boxes = []
-            for s in samples:
-                done = False
-                counter = 0
-                while not done and counter < 50:
-                    image, label, gt = run_transforms(s)
-                    num_bg = np.count_nonzero(label[:, self.num_classes])
-                    done = num_bg < label.shape[0]
-                    counter += 1
-
-                images.append(image.astype(np.float32))
-                labels.append(label.astype(np.float32))
-                gt_boxes.append(gt.boxes)
-
-            images = np.array(images, dtype=np.float32)
-            labels = np.array(labels, dtype=np.float32)
-            return images, labels, gt_boxes
-
-        #-----------------------------------------------------------------------
-        def batch_producer(sample_queue, batch_queue):
-            while True:
-                #---------------------------------------------------------------
-                # Process the sample
-                #---------------------------------------------------------------
-                try:
-                    samples = sample_queue.get(timeout=1)
-                except q.Empty:
-                    break
-
-                images, labels, gt_boxes = process_samples(samples)
-
-                #---------------------------------------------------------------
-                # Pad the result in the case where we don't have enough samples
-                # to fill the entire batch
-                #---------------------------------------------------------------
-                if images.shape[0] < batch_queue.img_shape[0]:
-                    images_norm = np.zeros(batch_queue.img_shape,
-                                           dtype=np.float32)
-                    labels_norm = np.zeros(batch_queue.label_shape,
-                                           dtype=np.float32)
-                    images_norm[:images.shape[0]] = images
-                    labels_norm[:images.shape[0]] = labels
-                    batch_queue.put(images_norm, labels_norm, gt_boxes)
-                else:
-                    batch_queue.put(images, labels, gt_boxes)
+        def plan_transforms(sample):
+            #-------------------------------------------------------------------
+            # Plan the transforms on the ground truth until at least one
+            # anchor gets matched
+            #-------------------------------------------------------------------
+            return compiled.prepare_matched(*sample[1:])
+
+        #-----------------------------------------------------------------------
+        def process_sample(sample, count):
+            #-------------------------------------------------------------------
+            # Plan the views of the sample and process them with one load of
+            # the image
+            #-------------------------------------------------------------------
+            plans = [plan_transforms(sample) for _ in range(count)]
+            images = run_views([p[2] for p in plans], sample[0])
+            return [(image, p[0], p[1]) for image, p in zip(images, plans)]
+
+        #-----------------------------------------------------------------------
+        def process_job(samples, batches):
+            #-------------------------------------------------------------------
+            # Make as many views of every sample as the batches need
+            #-------------------------------------------------------------------
+            counts = [0] * len(samples)
+            for batch in batches:
+                for i in batch:
+                    counts[i] += 1
+
+            sample_views = []
+            for sample, count in zip(samples, counts):
+                sample_views.append(process_sample(sample, count)[::-1])
+
+            #-------------------------------------------------------------------
+            # Assemble the batches
+            #-------------------------------------------------------------------
+            result = []
+            for batch in batches:
+                images = []
+                labels = []
+                gt_boxes = []
+                for i in batch:
+                    image, label, gt = sample_views[i].pop()
+                    images.append(image)
+                    labels.append(label.astype(np.float32))
+                    gt_boxes.append(gt.boxes)
+
+                images = np.array(images)
+                if batch_distort is not None:
+                    images = batch_distort.distort_batch(images)
+                labels = np.array(labels, dtype=np.float32)
+                result.append((images, labels, gt_boxes))
+            return result
+
+        #-----------------------------------------------------------------------
+        def stream_sample(sample, count):
+            #-------------------------------------------------------------------
+            # The colors of the views get distorted here, in the workers and
+            # on uint8, before they go to the slots. Only the matched anchors
+            # of the labels are sent, the consumer makes the dense arrays
+            # again.
+            #-------------------------------------------------------------------
+            views = process_sample(sample, count)
+            images = [image for image, _, _ in views]
+            if batch_distort is not None:
+                images = batch_distort.distort_batch(np.array(images))
+            for image, (_, label, gt) in zip(images, views):
+                label = SparseLabels.from_dense(label[None], self.num_classes)
+                yield image, label, gt.boxes
+
+        self.processors[name] = stream_sample
+
+        #-----------------------------------------------------------------------
+        def plan_jobs(sample_list, batch_size):
+            #-------------------------------------------------------------------
+            # Every job is a tuple of (samples, batches), where the batches
+            # are lists of indices to the samples, so that a worker makes
+            # all the views of a sample out of one load of the image. To
+            # keep the number of samples per epoch, only the first
+            # 1/views of the shuffled list gets used.
+            #-------------------------------------------------------------------
+            n = len(sample_list)
+            jobs = []
+            if views <= 1:
+                for offset in range(0, n, batch_size):
+                    samples = sample_list[offset:offset+batch_size]
+                    jobs.append((samples, [list(range(len(samples)))]))
+                return jobs
+
+            sources = sample_list[:int(math.ceil(n/float(views)))]
+
+            #-------------------------------------------------------------------
+            # The views of a sample follow each other in the batches
+            #-------------------------------------------------------------------
+            if views_in_batch:
+                ids = [i for i in range(len(sources)) for _ in range(views)]
+                ids = ids[:n]
+                for offset in range(0, n, batch_size):
+                    batch = ids[offset:offset+batch_size]
+                    first = batch[0]
+                    jobs.append((sources[first:batch[-1]+1],
+                                 [[i-first for i in batch]]))
+                return jobs
+
+            #-------------------------------------------------------------------
+            # Every chunk of samples produces one batch per view
+            #-------------------------------------------------------------------
+            remaining = n
+            for offset in range(0, len(sources), batch_size):
+                chunk = sources[offset:offset+batch_size]
+                batches = []
+                for _ in range(views):
+                    batch = list(range(min(len(chunk), remaining)))
+                    if batch:
+                        batches.append(batch)
+                        remaining -= len(batch)
+                jobs.append((chunk, batches))
+            return jobs
 
         #-----------------------------------------------------------------------
         def gen_batch(batch_size, num_workers=0):
             sample_list = copy(sample_list_)
             random.shuffle(sample_list)
+            jobs = plan_jobs(sample_list, batch_size)
 
             #-------------------------------------------------------------------
             # Set up the parallel generator
             #-------------------------------------------------------------------
             if num_workers > 0:
-                #---------------------------------------------------------------
-                # Set up the queues
-                #---------------------------------------------------------------
-                img_template = np.zeros((batch_size, self.preset.image_size.h,
-                                         self.preset.image_size.w, 3),
-                                        dtype=np.float32)
-                label_template = np.zeros((batch_size, self.preset.num_anchors,
-                                           self.num_classes+5),
-                                          dtype=np.float32)
-                max_size = num_workers*5
-                n_batches = int(math.ceil(len(sample_list_)/batch_size))
-                sample_queue = mp.Queue(n_batches)
-                batch_queue = DataQueue(img_template, label_template, max_size)
-
-                #---------------------------------------------------------------
-                # Set up the workers. Make sure we can fork safely even if
-                # OpenCV has been compiled with CUDA and multi-threading
-                # support.
-                #---------------------------------------------------------------
-                workers = []
-                os.environ['CUDA_VISIBLE_DEVICES'] = ""
-                cv2_num_threads = cv2.getNumThreads()
-                cv2.setNumThreads(1)
-                for i in range(num_workers):
-                    args = (sample_queue, batch_queue)
-                    w = mp.Process(target=batch_producer, args=args)
-                    workers.append(w)
-                    w.start()
-                del os.environ['CUDA_VISIBLE_DEVICES']
-                cv2.setNumThreads(cv2_num_threads)
-
-                #---------------------------------------------------------------
-                # Fill the sample queue with data
-                #---------------------------------------------------------------
-                for offset in range(0, len(sample_list), batch_size):
-                    samples = sample_list[offset:offset+batch_size]
-                    sample_queue.put(samples)
-
-                #---------------------------------------------------------------
-                # Return the data
-                #---------------------------------------------------------------
-                for offset in range(0, len(sample_list), batch_size):
-                    images, labels, gt_boxes = batch_queue.get()
-                    num_items = len(gt_boxes)
-                    yield images[:num_items], labels[:num_items], gt_boxes
+                pool = self.__get_pool(batch_size, num_workers)
+                for images, labels, gt_boxes in pool.run(name, jobs):
+                    labels = labels.to_dense(self.preset.num_anchors,
+                                             self.num_classes)
+                    yield images, labels, gt_boxes
 
-                #---------------------------------------------------------------
-                # Join the workers
-                #---------------------------------------------------------------
-                for w in workers:
-                    w.join()
+                if self.transform_profiler is not None:
+                    for stats in pool.collect_stats():
+                        self.transform_profiler.merge(stats)
 
             #-------------------------------------------------------------------
             # Return a serial generator
             #-------------------------------------------------------------------
             else:
-                for offset in range(0, len(sample_list), batch_size):
-                    samples = sample_list[offset:offset+batch_size]
-                    images, labels, gt_boxes = process_samples(samples)
-                    yield images, labels, gt_boxes
+                for job in jobs:
+                    for images, labels, gt_boxes in process_job(*job):
+                        yield images.astype(np.float32), labels, gt_boxes
 
         return gen_batch
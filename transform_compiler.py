@@ -0,0 +1,146 @@
+import random
+import copy
+
+import numpy as np
+
+from transforms import Transform, ComposeTransform, RandomTransform
+from transforms import TransformPickerTransform, StepList, merge_steps
+from transforms import link_load_step
+
+#-------------------------------------------------------------------------------
+# A transform tree compiles into a list of nodes:
+#  * ('op', transform)            - a transform planned with its prepare method
+#  * ('maybe', prob, nodes, name) - nodes planned with the given probability,
+#                                   named after the transform they come from
+#  * ('pick', [nodes, ...])       - one of the node lists picked at random
+# Planning a sample walks the nodes, drawing all the random decisions, and
+# emits the image steps into one flat list.
+#-------------------------------------------------------------------------------
+
+
+def compile_nodes(transforms):
+    """
+    Flatten the compositions and drop the branches that never run
+    """
+    nodes = []
+    for t in transforms:
+        if isinstance(t, ComposeTransform):
+            nodes += compile_nodes(t.transforms)
+
+        elif isinstance(t, RandomTransform):
+            if t.prob <= 0:
+                continue
+            inner = compile_nodes([t.transform])
+            if t.prob >= 1:
+                nodes += inner
+            elif inner:
+                nodes.append(('maybe', t.prob, inner,
+                              type(t.transform).__name__))
+
+        elif isinstance(t, TransformPickerTransform):
+            choices = [compile_nodes([c]) for c in t.transforms]
+            if len(choices) == 1:
+                nodes += choices[0]
+            elif choices:
+                nodes.append(('pick', choices))
+
+        else:
+            nodes.append(('op', t))
+    return nodes
+
+#-------------------------------------------------------------------------------
+
+
+def describe_step(step):
+    return getattr(step, 'name', type(step).__name__)
+
+#-------------------------------------------------------------------------------
+
+
+class CompiledTransforms:
+    """
+    A transform tree flattened into an execution plan. Every sample gets a
+    flat list of image steps, with the skipped branches left out and the
+    adjacent lookup tables merged, instead of going through the nested
+    calls of the containers. The random numbers are drawn in a different
+    order than when calling the tree, so the samples are distributed the
+    same way but are not the same.
+    """
+
+    #---------------------------------------------------------------------------
+    def __init__(self, transforms):
+        self.nodes = compile_nodes(transforms)
+
+    #---------------------------------------------------------------------------
+    def emit(self, nodes, label, gt, steps):
+        profiler = Transform.profiler
+        for node in nodes:
+            if node[0] == 'maybe':
+                if random.uniform(0, 1) < node[1]:
+                    label, gt = self.emit(node[2], label, gt, steps)
+                elif profiler is not None:
+                    profiler.skip(node[3])
+
+            elif node[0] == 'pick':
+                choice = node[1][random.randint(0, len(node[1])-1)]
+                label, gt = self.emit(choice, label, gt, steps)
+
+            else:
+                if profiler is None:
+                    label, gt, step = node[1].prepare(label, gt)
+                else:
+                    label, gt, step = profiler.prepare(node[1], label, gt)
+                if isinstance(step, StepList):
+                    steps += step.steps
+                elif step is not None:
+                    if not hasattr(step, 'name'):
+                        step.name = type(node[1]).__name__
+                    steps.append(step)
+        return label, gt
+
+    #---------------------------------------------------------------------------
+    def prepare(self, label, gt):
+        """
+        Plan a sample
+        :return: a tuple of (label, gt, steps) like prepare_transforms
+        """
+        steps = []
+        label, gt = self.emit(self.nodes, label, gt, steps)
+        return label, gt, merge_steps(steps)
+
+    #---------------------------------------------------------------------------
+    def prepare_matched(self, label, gt, tries=50):
+        """
+        Plan a sample until its label, as made by LabelCreatorTransform, has
+        at least one anchor matched with an object, giving up after the
+        given number of tries
+        """
+        for _ in range(tries):
+            result = self.prepare(label, gt)
+            matched = result[0]
+            background = matched.shape[1]-5
+            if np.count_nonzero(matched[:, background]) < matched.shape[0]:
+                break
+        return result
+
+    #---------------------------------------------------------------------------
+    @staticmethod
+    def explain(steps):
+        """
+        List the operations of a plan, with the loading step linked to the
+        geometric steps the way run_steps does it, so that it shows the
+        reduction and the region it will decode. The linking is done on a
+        copy, so the plan can still be run.
+        """
+        steps = copy.deepcopy(steps)
+        link_load_step([steps])
+        return [describe_step(step) for step in steps]
+
+#-------------------------------------------------------------------------------
+
+
+def compile_transforms(transforms):
+    """
+    Compile a list of transforms, possibly nesting other transforms
+    """
+    return CompiledTransforms(transforms)
@@ -0,0 +1,104 @@
+import time
+
+from collections import OrderedDict
+
+#-------------------------------------------------------------------------------
+# The counters kept for every transform
+#-------------------------------------------------------------------------------
+FIELDS = ['plans', 'skips', 'plan_time', 'steps', 'step_time', 'step_bytes']
+
+#-------------------------------------------------------------------------------
+
+
+def step_key(step):
+    """
+    Name the transform that an image step comes from; the step names may
+    carry the parameters of the step in parentheses
+    """
+    name = getattr(step, 'name', None) or type(step).__name__
+    return name.split('(')[0]
+
+#-------------------------------------------------------------------------------
+
+
+class TransformProfiler:
+    """
+    Collect the wall time of the planning and of the image steps of the
+    transforms, how many times they were planned, run and skipped by the
+    random transforms, and how many bytes their image steps returned. It's
+    enabled by setting it as Transform.profiler.
+    """
+
+    #---------------------------------------------------------------------------
+    def __init__(self):
+        self.stats = OrderedDict()
+
+    #---------------------------------------------------------------------------
+    def entry(self, name):
+        if name not in self.stats:
+            self.stats[name] = OrderedDict((f, 0) for f in FIELDS)
+        return self.stats[name]
+
+    #---------------------------------------------------------------------------
+    def prepare(self, transform, label, gt):
+        """
+        Plan the transform and time it
+        """
+        start = time.perf_counter()
+        result = transform.prepare(label, gt)
+        entry = self.entry(type(transform).__name__)
+        entry['plans'] += 1
+        entry['plan_time'] += time.perf_counter()-start
+        return result
+
+    #---------------------------------------------------------------------------
+    def run(self, step, data):
+        """
+        Run the image step and time it
+        """
+        start = time.perf_counter()
+        data = step(data)
+        entry = self.entry(step_key(step))
+        entry['steps'] += 1
+        entry['step_time'] += time.perf_counter()-start
+        entry['step_bytes'] += getattr(data, 'nbytes', 0)
+        return data
+
+    #---------------------------------------------------------------------------
+    def skip(self, name):
+        self.entry(name)['skips'] += 1
+
+    #---------------------------------------------------------------------------
+    def merge(self, stats):
+        """
+        Add the stats collected by another profiler, ie. in a worker process
+        """
+        for name, other in stats.items():
+            entry = self.entry(name)
+            for field in FIELDS:
+                entry[field] += other[field]
+
+    #---------------------------------------------------------------------------
+    def clear(self):
+        self.stats = OrderedDict()
+
+    #---------------------------------------------------------------------------
+    def table(self):
+        """
+        Format the stats as a table sorted by the total time, slowest first.
+        The times of the workers add up, so they may exceed the wall time.
+        """
+        width = max([32] + [len(name) for name in self.stats])
+        lines = ['{:{}} {:>9} {:>9} {:>10} {:>9} {:>10} {:>9} {:>10}'
+                 .format('transform', width, 'plans', 'skips', 'plan [s]', 'steps',
+                         'step [s]', 'step [ms]', 'out [MB]')]
+        entries = sorted(self.stats.items(),
+                         key=lambda x: -(x[1]['plan_time']+x[1]['step_time']))
+        for name, e in entries:
+            per_step = 1000*e['step_time']/e['steps'] if e['steps'] else 0
+            lines.append('{:{}} {:9d} {:9d} {:10.3f} {:9d} {:10.3f} {:9.3f} '
+                         '{:10.1f}'.format(name, width, e['plans'], e['skips'],
+                                           e['plan_time'], e['steps'],
+                                           e['step_time'], per_step,
+                                           e['step_bytes']/1024.**2))
+        return '\n'.join(lines)
@@ -3,42 +3,261 @@ import random
 
 import numpy as np
 
-from ssdutils import get_anchors_for_preset, get_preset_by_name, anchors2array
-from ssdutils import box2array, compute_overlap, compute_location
-from utils import Size, Sample, Point, Box, abs2prop, prop2abs
-from math import sqrt
+from ssdutils import get_anchor_table, get_preset_by_name, anchors2array
+from ssdutils import anchors2prop, encode_locations
+from ssdutils import jaccard_overlap_matrix, match_anchors, match_overlaps
+from ssdutils import AnchorIndex
+from utils import Size, Sample, Point, Box
+from geometry import props2corners, transform_props, flip_props
+from image_loader import read_jpeg_size, pick_reduction, reduce_region
+from image_loader import load_image
 
 #-------------------------------------------------------------------------------
 
 
 class Transform:
+    # whether the transform works on every pixel independently, so that it
+    # does not matter which part of the image or at which resolution it sees
+    pixelwise = False
+
+    # the TransformProfiler timing the planning and the image steps of all
+    # the transforms, None when profiling is disabled
+    profiler = None
+
     def __init__(self, **kwargs):
         for arg, val in kwargs.items():
             setattr(self, arg, val)
         self.initialized = False
 
+    def prepare(self, label, gt):
+        """
+        Plan the transformation of a sample without touching its image, so
+        that the plan can be checked and redrawn cheaply.
+        :return: a tuple of (label, gt, step), where step is a function
+                 transforming the image or None if the image does not
+                 change. By default the transform is assumed to only change
+                 the image.
+        """
+        def step(data):
+            return self(data, label, gt)[0]
+        step.pixelwise = self.pixelwise
+        return label, gt, step
+
 #-------------------------------------------------------------------------------
 
 
-class ImageLoaderTransform(Transform):
+def prepare_transforms(transforms, label, gt):
     """
-    Load and image from the file specified in the Sample object
+    Plan a sequence of transforms
+    :return: a tuple of (label, gt, steps) with the list of image steps
     """
+    steps = []
+    profiler = Transform.profiler
+    for t in transforms:
+        if profiler is None:
+            label, gt, step = t.prepare(label, gt)
+        else:
+            label, gt, step = profiler.prepare(t, label, gt)
+        if isinstance(step, StepList):
+            steps += step.steps
+        elif step is not None:
+            steps.append(step)
+    return label, gt, steps
 
-    def __call__(self, data, label, gt):
-        return cv2.imread(gt.filename), label, gt
+#-------------------------------------------------------------------------------
+
+
+def find_geometric_step(steps):
+    """
+    Find the first geometric step reading the output of the loading step,
+    with only pixelwise steps in between. Loading steps have a request
+    method and geometric steps have source_request and rebase methods.
+    :return: the step or None
+    """
+    for step in steps[1:]:
+        if hasattr(step, 'source_request'):
+            return step
+        if not getattr(step, 'pixelwise', False):
+            return None
+    return None
 
 #-------------------------------------------------------------------------------
 
 
-def process_overlap(overlap, box, anchor, matches, num_classes, vec):
-    if overlap.idx in matches and matches[overlap.idx] >= overlap.score:
+def link_load_step(step_lists):
+    """
+    Tell the loading step of the first plan which regions of the image the
+    geometric steps of all the plans read and at what scales, so that it can
+    decode less, and rebase the geometric steps on what gets loaded. The
+    plans must be plans of the same sample.
+    """
+    loader = step_lists[0][0] if step_lists[0] else None
+    if not hasattr(loader, 'request'):
         return
 
-    matches[overlap.idx] = overlap.score
-    vec[overlap.idx, 0:num_classes+1] = 0
-    vec[overlap.idx, box.labelid] = 1
-    vec[overlap.idx, num_classes+1:] = compute_location(box, anchor)
+    consumers = [find_geometric_step(steps) for steps in step_lists]
+    requests = [c.source_request() if c is not None else (None, (1, 1))
+                for c in consumers]
+    reduction, offset = loader.request(requests)
+    for consumer in consumers:
+        if consumer is not None:
+            consumer.rebase(reduction, offset)
+
+#-------------------------------------------------------------------------------
+
+
+def run_steps(steps, data):
+    """
+    Run the image steps of a plan
+    """
+    link_load_step([steps])
+    profiler = Transform.profiler
+    for step in steps:
+        if profiler is None:
+            data = step(data)
+        else:
+            data = profiler.run(step, data)
+    return data
+
+#-------------------------------------------------------------------------------
+
+
+def run_views(step_lists, data):
+    """
+    Run the image steps of several plans of the same sample, loading the
+    image only once if all the plans start with a loading step. The steps
+    must not modify their input in place, since the views share the loaded
+    image.
+    :return: a list of images
+    """
+    if not all(steps and isinstance(steps[0], LoadStep)
+               for steps in step_lists):
+        return [run_steps(steps, data) for steps in step_lists]
+
+    link_load_step(step_lists)
+    profiler = Transform.profiler
+    if profiler is None:
+        data = step_lists[0][0](data)
+    else:
+        data = profiler.run(step_lists[0][0], data)
+
+    images = []
+    for steps in step_lists:
+        image = data
+        for step in steps[1:]:
+            if profiler is None:
+                image = step(image)
+            else:
+                image = profiler.run(step, image)
+        images.append(image)
+    return images
+
+#-------------------------------------------------------------------------------
+
+
+class StepList:
+    """
+    Image steps of a transform doing several things, returned by prepare as
+    one step. The plans splice the steps in, so that they get profiled and
+    merged with their neighbours on their own.
+    """
+
+    #---------------------------------------------------------------------------
+    def __init__(self, name, steps):
+        self.name = name
+        self.steps = steps
+        self.pixelwise = all(getattr(s, 'pixelwise', False) for s in steps)
+
+    #---------------------------------------------------------------------------
+    def __call__(self, data):
+        for step in self.steps:
+            data = step(data)
+        return data
+
+#-------------------------------------------------------------------------------
+
+
+class LoadStep:
+    """
+    Image step loading the image of a sample. With reduce set, if the step
+    is asked for regions at given scales, JPEG files get decoded at the
+    lowest resolution giving at least the requested scales and only the
+    bounding box of the regions is kept.
+    """
+
+    #---------------------------------------------------------------------------
+    def __init__(self, filename, reduce=True):
+        self.filename = filename
+        self.reduce = reduce
+        self.reduction = 1
+        self.region = None
+
+    #---------------------------------------------------------------------------
+    @property
+    def name(self):
+        return 'ImageLoaderTransform(reduction={}, region={})' \
+            .format(self.reduction, self.region)
+
+    #---------------------------------------------------------------------------
+    def request(self, requests):
+        """
+        :param requests: a list of (region, scale) tuples, where the region
+                         is the [xmin, xmax, ymin, ymax] bounds of the
+                         needed region of the full resolution image or None
+                         for the entire image, and the scale is a (sx, sy)
+                         tuple of output pixels per input pixel
+        :return: a tuple of (reduction, offset), where the offset is the
+                 (x, y) position of the loaded region in the reduced image
+        """
+        if not self.reduce:
+            return self.reduction, (0, 0)
+
+        if read_jpeg_size(self.filename) is not None:
+            scale = max(max(abs(s[0]), abs(s[1])) for _, s in requests)
+            self.reduction = pick_reduction((scale, scale))
+
+        regions = [r for r, _ in requests]
+        if any(r is None or r[0] >= r[1] or r[2] >= r[3] for r in regions):
+            return self.reduction, (0, 0)
+
+        regions = np.array(regions)
+        region = [regions[:, 0].min(), regions[:, 1].max(),
+                  regions[:, 2].min(), regions[:, 3].max()]
+        self.region = reduce_region(region, self.reduction)
+        return self.reduction, (self.region[0], self.region[2])
+
+    #---------------------------------------------------------------------------
+    def __call__(self, data):
+        return load_image(self.filename, self.reduction, self.region)
+
+#-------------------------------------------------------------------------------
+
+
+def reduction_matrix(reduction, offset):
+    """
+    Make a 3x3 matrix mapping the pixels of a region of a reduced image to
+    the pixels of the full resolution image. The pixel centers are mapped
+    onto the centers of the blocks they were reduced from.
+    """
+    return np.array([[reduction, 0, (offset[0]+0.5)*reduction-0.5],
+                     [0, reduction, (offset[1]+0.5)*reduction-0.5],
+                     [0, 0, 1]], dtype=np.float64)
+
+#-------------------------------------------------------------------------------
+
+
+class ImageLoaderTransform(Transform):
+    """
+    Load and image from the file specified in the Sample object
+    Parameters: reduce (optional; decode JPEG files only at the resolution
+                and only the region that the geometric transforms need)
+    """
+
+    def __call__(self, data, label, gt):
+        return load_image(gt.filename), label, gt
+
+    def prepare(self, label, gt):
+        return label, gt, LoadStep(gt.filename, getattr(self, 'reduce', False))
 
 #-------------------------------------------------------------------------------
 
@@ -46,16 +265,23 @@ def process_overlap(overlap, box, anchor, matches, num_classes, vec):
 class LabelCreatorTransform(Transform):
     """
     Create a label vector out of a ground trut sample
-    Parameters: preset, num_classes
+    Parameters: preset, num_classes, matching (optional; 'index' - only test
+                the anchors close to the boxes, 'dense' - test all the
+                anchors, 'check' - use the index and verify the result
+                against the dense matching)
     """
     #---------------------------------------------------------------------------
 
     def initialize(self):
-        self.anchors = get_anchors_for_preset(self.preset)
-        self.vheight = len(self.anchors)
+        table = get_anchor_table(self.preset)
+        self.anchors_prop = table.prop
+        self.vheight = len(table.prop)
         self.vwidth = self.num_classes+5  # background class + location offsets
         self.img_size = Size(1000, 1000)
-        self.anchors_arr = anchors2array(self.anchors, self.img_size)
+        self.anchors_arr = table.corners
+        self.anchor_index = AnchorIndex(self.preset, table)
+        if not hasattr(self, 'matching'):
+            self.matching = 'index'
         self.initialized = True
 
     #---------------------------------------------------------------------------
@@ -67,42 +293,41 @@ class LabelCreatorTransform(Transform):
             self.initialize()
 
         vec = np.zeros((self.vheight, self.vwidth), dtype=np.float32)
+        vec[:, self.num_classes] = 1  # background class
+
+        if not gt.boxes:
+            return data, vec, gt
 
         #-----------------------------------------------------------------------
-        # For every box compute the best match and all the matches above 0.5
-        # Jaccard overlap
+        # Compute the Jaccard overlaps of the boxes and the anchors and match
+        # them resolving conflicts in favor of a better match
         #-----------------------------------------------------------------------
-        overlaps = {}
-        for box in gt.boxes:
-            box_arr = box2array(box, self.img_size)
-            overlaps[box] = compute_overlap(box_arr, self.anchors_arr, 0.5)
+        boxes_prop = anchors2prop(gt.boxes)
+        boxes_arr = props2corners(boxes_prop, self.img_size)
+        if self.matching == 'dense':
+            overlaps = jaccard_overlap_matrix(boxes_arr, self.anchors_arr)
+            box_ids, anchor_ids = match_anchors(overlaps, 0.5)
+        else:
+            check = self.matching == 'check'
+            overlaps = self.anchor_index.overlaps(boxes_arr, 0.5, check)
+            box_ids, anchor_ids = match_overlaps(*overlaps)
 
         #-----------------------------------------------------------------------
-        # Set up the training vector resolving conflicts in favor of a better
-        # match
+        # Set up the training vector
         #-----------------------------------------------------------------------
-        vec[:, self.num_classes] = 1  # background class
-        vec[:, self.num_classes+1] = 0  # x offset
-        vec[:, self.num_classes+2] = 0  # y offset
-        vec[:, self.num_classes+3] = 0  # log width scale
-        vec[:, self.num_classes+4] = 0  # log height scale
-
-        matches = {}
-        for box in gt.boxes:
-            for overlap in overlaps[box].good:
-                anchor = self.anchors[overlap.idx]
-                process_overlap(overlap, box, anchor, matches, self.num_classes, vec)
-
-        matches = {}
-        for box in gt.boxes:
-            overlap = overlaps[box].best
-            if not overlap:
-                continue
-            anchor = self.anchors[overlap.idx]
-            process_overlap(overlap, box, anchor, matches, self.num_classes, vec)
+        labels = np.array([box.labelid for box in gt.boxes], dtype=np.int64)
+        vec[anchor_ids, self.num_classes] = 0
+        vec[anchor_ids, labels[box_ids]] = 1
+        vec[anchor_ids, self.num_classes+1:] = \
+            encode_locations(boxes_prop[box_ids], self.anchors_prop[anchor_ids])
 
         return data, vec, gt
 
+    #---------------------------------------------------------------------------
+    def prepare(self, label, gt):
+        _, label, gt = self(None, label, gt)
+        return label, gt, None
+
 #-------------------------------------------------------------------------------
 
 
@@ -117,6 +342,39 @@ class ResizeTransform(Transform):
         resized = cv2.resize(data, (self.width, self.height), interpolation=alg)
         return resized, label, gt
 
+    def prepare(self, label, gt):
+        alg = random.choice(self.algorithms)
+        return label, gt, ResizeStep(self, alg, gt.imgsize)
+
+#-------------------------------------------------------------------------------
+
+
+class ResizeStep:
+    """
+    Image step of the ResizeTransform. It reads the entire image, so it only
+    needs to know the scale of the input.
+    """
+
+    def __init__(self, transform, algorithm, imgsize):
+        self.transform = transform
+        self.algorithm = algorithm
+        self.imgsize = imgsize
+
+    @property
+    def name(self):
+        return 'ResizeTransform(algorithm={})'.format(self.algorithm)
+
+    def source_request(self):
+        return None, (self.transform.width/float(self.imgsize.w),
+                      self.transform.height/float(self.imgsize.h))
+
+    def rebase(self, reduction, offset):
+        pass
+
+    def __call__(self, data):
+        return cv2.resize(data, (self.transform.width, self.transform.height),
+                          interpolation=self.algorithm)
+
 #-------------------------------------------------------------------------------
 
 
@@ -132,6 +390,14 @@ class RandomTransform(Transform):
             return self.transform(data, label, gt)
         return data, label, gt
 
+    def prepare(self, label, gt):
+        p = random.uniform(0, 1)
+        if p < self.prob:
+            return self.transform.prepare(label, gt)
+        if Transform.profiler is not None:
+            Transform.profiler.skip(type(self.transform).__name__)
+        return label, gt, None
+
 #-------------------------------------------------------------------------------
 
 
@@ -147,6 +413,12 @@ class ComposeTransform(Transform):
             args = t(*args)
         return args
 
+    def prepare(self, label, gt):
+        label, gt, steps = prepare_transforms(self.transforms, label, gt)
+        if not steps:
+            return label, gt, None
+        return label, gt, lambda data: run_steps(steps, data)
+
 #-------------------------------------------------------------------------------
 
 
@@ -160,6 +432,66 @@ class TransformPickerTransform(Transform):
         pick = random.randint(0, len(self.transforms)-1)
         return self.transforms[pick](data, label, gt)
 
+    def prepare(self, label, gt):
+        pick = random.randint(0, len(self.transforms)-1)
+        return self.transforms[pick].prepare(label, gt)
+
+#-------------------------------------------------------------------------------
+
+
+class LutStep:
+    """
+    Image step mapping the pixel values of uint8 images through a lookup
+    table. Adjacent steps can be merged into one table. Images of other
+    types go through the fallback functions computing the same thing.
+    """
+    pixelwise = True
+
+    #---------------------------------------------------------------------------
+    def __init__(self, table, name, fallback):
+        self.table = table
+        self.names = [name]
+        self.fallbacks = [fallback]
+
+    #---------------------------------------------------------------------------
+    @property
+    def name(self):
+        return 'LUT({})'.format(', '.join(self.names))
+
+    #---------------------------------------------------------------------------
+    def merge(self, other):
+        """
+        :return: a step applying this table and then the other one
+        """
+        step = LutStep(other.table[self.table], None, None)
+        step.names = self.names + other.names
+        step.fallbacks = self.fallbacks + other.fallbacks
+        return step
+
+    #---------------------------------------------------------------------------
+    def __call__(self, data):
+        if data.dtype != np.uint8:
+            for fallback in self.fallbacks:
+                data = fallback(data)
+            return data
+        return cv2.LUT(data, self.table)
+
+#-------------------------------------------------------------------------------
+
+
+def merge_steps(steps):
+    """
+    Merge the adjacent lookup table steps
+    """
+    merged = []
+    for step in steps:
+        if merged and isinstance(step, LutStep) and \
+           isinstance(merged[-1], LutStep):
+            merged[-1] = merged[-1].merge(step)
+        else:
+            merged.append(step)
+    return merged
+
 #-------------------------------------------------------------------------------
 
 
@@ -169,14 +501,26 @@ class BrightnessTransform(Transform):
     Parameters: delta
     """
 
-    def __call__(self, data, label, gt):
+    pixelwise = True
+
+    def apply(self, data, delta):
         data = data.astype(np.float32)
-        delta = random.randint(-self.delta, self.delta)
         data += delta
         data[data > 255] = 255
         data[data < 0] = 0
-        data = data.astype(np.uint8)
-        return data, label, gt
+        return data.astype(np.uint8)
+
+    def __call__(self, data, label, gt):
+        delta = random.randint(-self.delta, self.delta)
+        return self.apply(data, delta), label, gt
+
+    def prepare(self, label, gt):
+        delta = random.randint(-self.delta, self.delta)
+        if delta == 0:
+            return label, gt, None
+        table = self.apply(np.arange(256, dtype=np.uint8), delta)
+        return label, gt, LutStep(table, type(self).__name__,
+                                  lambda data: self.apply(data, delta))
 
 #-------------------------------------------------------------------------------
 
@@ -187,14 +531,24 @@ class ContrastTransform(Transform):
     Parameters: lower, upper
     """
 
-    def __call__(self, data, label, gt):
+    pixelwise = True
+
+    def apply(self, data, delta):
         data = data.astype(np.float32)
-        delta = random.uniform(self.lower, self.upper)
         data *= delta
         data[data > 255] = 255
         data[data < 0] = 0
-        data = data.astype(np.uint8)
-        return data, label, gt
+        return data.astype(np.uint8)
+
+    def __call__(self, data, label, gt):
+        delta = random.uniform(self.lower, self.upper)
+        return self.apply(data, delta), label, gt
+
+    def prepare(self, label, gt):
+        delta = random.uniform(self.lower, self.upper)
+        table = self.apply(np.arange(256, dtype=np.uint8), delta)
+        return label, gt, LutStep(table, type(self).__name__,
+                                  lambda data: self.apply(data, delta))
 
 #-------------------------------------------------------------------------------
 
@@ -205,13 +559,16 @@ class HueTransform(Transform):
     Parameters: delta
     """
 
+    pixelwise = True
+
     def __call__(self, data, label, gt):
         data = cv2.cvtColor(data, cv2.COLOR_BGR2HSV)
         data = data.astype(np.float32)
         delta = random.randint(-self.delta, self.delta)
-        data[0] += delta
-        data[0][data[0] > 180] -= 180
-        data[0][data[0] < 0] += 180
+        hue = data[:, :, 0]
+        hue += delta
+        hue[hue > 180] -= 180
+        hue[hue < 0] += 180
         data = data.astype(np.uint8)
         data = cv2.cvtColor(data, cv2.COLOR_HSV2BGR)
         return data, label, gt
@@ -221,17 +578,20 @@ class HueTransform(Transform):
 
 class SaturationTransform(Transform):
     """
-    Transform hue
+    Transform saturation
     Parameters: lower, upper
     """
 
+    pixelwise = True
+
     def __call__(self, data, label, gt):
         data = cv2.cvtColor(data, cv2.COLOR_BGR2HSV)
         data = data.astype(np.float32)
         delta = random.uniform(self.lower, self.upper)
-        data[1] *= delta
-        data[1][data[1] > 255] = 255
-        data[1][data[1] < 0] = 0
+        saturation = data[:, :, 1]
+        saturation *= delta
+        saturation[saturation > 255] = 255
+        saturation[saturation < 0] = 0
         data = data.astype(np.uint8)
         data = cv2.cvtColor(data, cv2.COLOR_HSV2BGR)
         return data, label, gt
@@ -244,50 +604,343 @@ class ReorderChannelsTransform(Transform):
     Reorder Image Channels
     """
 
+    pixelwise = True
+
     def __call__(self, data, label, gt):
         channels = [0, 1, 2]
         random.shuffle(channels)
         return data[:, :, channels], label, gt
 
+    def prepare(self, label, gt):
+        channels = [0, 1, 2]
+        random.shuffle(channels)
+        if channels == [0, 1, 2]:
+            return label, gt, None
+
+        def step(data):
+            return data[:, :, channels]
+        step.pixelwise = True
+        step.name = '{}({})'.format(type(self).__name__, channels)
+        return label, gt, step
+
 #-------------------------------------------------------------------------------
 
 
-def transform_box(box, orig_size, new_size, h_off, w_off):
+class PhotometricDistortTransform(Transform):
+    """
+    Apply the brightness, contrast, hue and saturation distortions and the
+    channel reordering in one pass. All the parameters are sampled up front
+    in the same way as the composition of the separate transforms does it:
+    brightness, then contrast, saturation and hue in this or in the
+    saturation, hue, contrast order, and then the channel reordering, every
+    step happening with its own probability. Brightness and contrast are
+    applied as uint8 lookup tables and hue and saturation as a lookup table
+    on the HSV image, so only one HSV round trip is made.
+    Parameters: brightness_prob, brightness_delta, contrast_prob,
+                contrast_lower, contrast_upper, hue_prob, hue_delta,
+                saturation_prob, saturation_lower, saturation_upper,
+                reorder_prob
+    """
+    pixelwise = True
+
+    #---------------------------------------------------------------------------
+    def initialize(self):
+        self.identity = np.arange(256, dtype=np.float32)
+        self.initialized = True
+
+    #---------------------------------------------------------------------------
+    def sample_params(self):
+        """
+        Sample the distortion parameters; None means that the step is skipped
+        :return: a tuple of (brightness, contrast_first, contrast_last, hue,
+                 saturation, channels)
+        """
+        brightness = None
+        if random.uniform(0, 1) < self.brightness_prob:
+            brightness = random.randint(-self.brightness_delta,
+                                        self.brightness_delta)
+
+        contrast_first = None
+        contrast_last = None
+        hue = None
+        saturation = None
+        contrast_is_first = random.randint(0, 1) == 0
+        if contrast_is_first:
+            if random.uniform(0, 1) < self.contrast_prob:
+                contrast_first = random.uniform(self.contrast_lower,
+                                                self.contrast_upper)
+        if random.uniform(0, 1) < self.saturation_prob:
+            saturation = random.uniform(self.saturation_lower,
+                                        self.saturation_upper)
+        if random.uniform(0, 1) < self.hue_prob:
+            hue = random.randint(-self.hue_delta, self.hue_delta)
+        if not contrast_is_first:
+            if random.uniform(0, 1) < self.contrast_prob:
+                contrast_last = random.uniform(self.contrast_lower,
+                                               self.contrast_upper)
+
+        channels = None
+        if random.uniform(0, 1) < self.reorder_prob:
+            channels = [0, 1, 2]
+            random.shuffle(channels)
+
+        return brightness, contrast_first, contrast_last, hue, saturation, \
+            channels
+
+    #---------------------------------------------------------------------------
+    def bgr_table(self, table, brightness=None, contrast=None):
+        """
+        Compose the brightness and contrast adjustments with a float32 lookup
+        table keeping it integral the way the uint8 images are
+        """
+        if brightness is not None:
+            table = np.clip(table+brightness, 0, 255)
+        if contrast is not None:
+            table = np.trunc(np.clip(table*np.float32(contrast), 0, 255))
+        return table
+
     #---------------------------------------------------------------------------
-    # Compute the new coordinates of the box
+    def hsv_table(self, hue, saturation):
+        """
+        Make a 3-channel lookup table shifting the hue and scaling the
+        saturation of an HSV image
+        """
+        table = np.empty((1, 256, 3), dtype=np.uint8)
+        h = self.identity
+        if hue is not None:
+            h = h+hue
+            h[h > 180] -= 180
+            h[h < 0] += 180
+        s = self.identity
+        if saturation is not None:
+            s = np.trunc(np.clip(s*np.float32(saturation), 0, 255))
+        table[0, :, 0] = h.astype(np.uint8)
+        table[0, :, 1] = s
+        table[0, :, 2] = self.identity
+        return table
+
     #---------------------------------------------------------------------------
-    xmin, xmax, ymin, ymax = prop2abs(box.center, box.size, orig_size)
-    xmin += w_off
-    xmax += w_off
-    ymin += h_off
-    ymax += h_off
+    def make_steps(self, brightness, contrast_first, contrast_last, hue,
+                   saturation, channels):
+        """
+        Make the image steps applying the given parameters: a lookup table
+        per brightness and contrast adjustment, the HSV lookup and the
+        channel reordering. The adjacent tables get merged, so without the
+        HSV step all the BGR adjustments fold into one table.
+        """
+        if not self.initialized:
+            self.initialize()
+
+        name = type(self).__name__
+
+        def to_uint8(data):
+            if data.dtype != np.uint8:
+                data = np.clip(data, 0, 255).astype(np.uint8)
+            return data
+
+        def lut(param, table):
+            table = table.astype(np.uint8)
+            return LutStep(table, '{}.{}'.format(name, param),
+                           lambda data: cv2.LUT(to_uint8(data), table))
+
+        steps = []
+        if brightness is not None:
+            table = self.bgr_table(self.identity, brightness=brightness)
+            steps.append(lut('brightness({:+d})'.format(brightness), table))
+
+        if contrast_first is not None:
+            table = self.bgr_table(self.identity, contrast=contrast_first)
+            steps.append(lut('contrast({:.3f})'.format(contrast_first), table))
+
+        if hue is not None or saturation is not None:
+            hsv_table = self.hsv_table(hue, saturation)
+
+            def hsv_step(data):
+                data = cv2.cvtColor(to_uint8(data), cv2.COLOR_BGR2HSV)
+                cv2.LUT(data, hsv_table, dst=data)
+                return cv2.cvtColor(data, cv2.COLOR_HSV2BGR)
+            hsv_step.pixelwise = True
+            hsv_step.name = '{}.hsv(hue={}, saturation={})'.format(
+                name, 'None' if hue is None else '{:+d}'.format(hue),
+                'None' if saturation is None else '{:.3f}'.format(saturation))
+            steps.append(hsv_step)
+
+        if contrast_last is not None:
+            table = self.bgr_table(self.identity, contrast=contrast_last)
+            steps.append(lut('contrast({:.3f})'.format(contrast_last), table))
+
+        if channels is not None and channels != [0, 1, 2]:
+            def reorder_step(data):
+                return to_uint8(data)[:, :, channels]
+            reorder_step.pixelwise = True
+            reorder_step.name = '{}.reorder({})'.format(name, channels)
+            steps.append(reorder_step)
+
+        return merge_steps(steps)
 
     #---------------------------------------------------------------------------
-    # Check if the center falls within the image
+    def __call__(self, data, label, gt):
+        if data.dtype != np.uint8:
+            data = np.clip(data, 0, 255).astype(np.uint8)
+        for step in self.make_steps(*self.sample_params()):
+            data = step(data)
+        return data, label, gt
+
     #---------------------------------------------------------------------------
-    width = xmax - xmin
-    height = ymax - ymin
-    new_cx = xmin + int(width/2)
-    new_cy = ymin + int(height/2)
-    if new_cx < 0 or new_cx >= new_size.w:
-        return None
-    if new_cy < 0 or new_cy >= new_size.h:
-        return None
+    def prepare(self, label, gt):
+        """
+        Sample the parameters now and return plain lookups as the image steps
+        """
+        steps = self.make_steps(*self.sample_params())
+        if not steps:
+            return label, gt, None
+        if len(steps) == 1:
+            return label, gt, steps[0]
+        return label, gt, StepList(type(self).__name__, steps)
 
-    center, size = abs2prop(xmin, xmax, ymin, ymax, new_size)
-    return Box(box.label, box.labelid, center, size)
+    #---------------------------------------------------------------------------
+    def sample_batch_params(self, n):
+        """
+        Sample the distortion parameters of n images at once with the same
+        distribution as sample_params
+        :return: a tuple of (brightness, contrast_first, contrast_last, hue,
+                 saturation, channels) arrays, where the skipped steps are
+                 NaNs and the channels are an (n, 3) array of permutations,
+                 the identity if the reordering is skipped
+        """
+        draws = [random.random() for _ in range(13*n)]
+        draws = np.array(draws).reshape(n, 13)
+
+        def maybe(i, prob, value):
+            return np.where(draws[:, i] < prob, value, np.nan)
+
+        def integer(i, delta):
+            return np.floor(draws[:, i]*(2*delta+1)) - delta
+
+        def uniform(i, lower, upper):
+            return lower + (upper-lower)*draws[:, i]
+
+        brightness = maybe(0, self.brightness_prob,
+                           integer(1, self.brightness_delta))
+        contrast = maybe(3, self.contrast_prob,
+                         uniform(4, self.contrast_lower, self.contrast_upper))
+        contrast_is_first = draws[:, 2] < 0.5
+        contrast_first = np.where(contrast_is_first, contrast, np.nan)
+        contrast_last = np.where(contrast_is_first, np.nan, contrast)
+        saturation = maybe(5, self.saturation_prob,
+                           uniform(6, self.saturation_lower,
+                                   self.saturation_upper))
+        hue = maybe(7, self.hue_prob, integer(8, self.hue_delta))
+
+        reorder = draws[:, 9] < self.reorder_prob
+        channels = np.argsort(draws[:, 10:13], axis=1)
+        channels[~reorder] = [0, 1, 2]
+
+        return brightness, contrast_first, contrast_last, hue, saturation, \
+            channels
+
+    #---------------------------------------------------------------------------
+    def distort_batch(self, images):
+        """
+        Distort a (B, H, W, 3) batch of images, every image with its own
+        parameters. The parameters and the lookup tables of all the images
+        are made at once and the images are then distorted one by one, so
+        that every image stays in the cache while it goes through all its
+        steps; gathering the whole batch per step is a lot slower.
+        """
+        if not self.initialized:
+            self.initialize()
+
+        if images.dtype != np.uint8:
+            images = np.clip(images, 0, 255).astype(np.uint8)
+
+        n = images.shape[0]
+        brightness, contrast_first, contrast_last, hue, saturation, \
+            channels = self.sample_batch_params(n)
+
+        #-----------------------------------------------------------------------
+        # Build the BGR tables the same way bgr_table does; without the HSV
+        # step the last contrast adjustment folds into the first table
+        #-----------------------------------------------------------------------
+        def scale(tables, factors, on):
+            factors = factors[on, None].astype(np.float32)
+            tables[on] = np.trunc(np.clip(tables[on]*factors, 0, 255))
+
+        hsv = ~np.isnan(hue) | ~np.isnan(saturation)
+        last = ~np.isnan(contrast_last)
+        fold = last & ~hsv
+        post_on = last & hsv
+
+        pre = np.tile(self.identity, (n, 1))
+        on = ~np.isnan(brightness)
+        pre[on] = np.clip(pre[on]+brightness[on, None].astype(np.float32),
+                          0, 255)
+        scale(pre, contrast_first, ~np.isnan(contrast_first))
+        scale(pre, contrast_last, fold)
+        pre_on = on | ~np.isnan(contrast_first) | fold
+        pre = pre.astype(np.uint8)
+
+        post = np.tile(self.identity, (n, 1))
+        scale(post, contrast_last, post_on)
+        post = post.astype(np.uint8)
+
+        reorder = np.any(channels != [0, 1, 2], axis=1)
+
+        #-----------------------------------------------------------------------
+        # Run the steps; the reordering writes straight to the output
+        #-----------------------------------------------------------------------
+        output = np.empty(images.shape, dtype=np.uint8)
+        for i in range(n):
+            img = images[i]
+            if pre_on[i]:
+                img = cv2.LUT(img, pre[i])
+            if hsv[i]:
+                table = self.hsv_table(None if np.isnan(hue[i]) else hue[i],
+                                       None if np.isnan(saturation[i])
+                                       else saturation[i])
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+                cv2.LUT(img, table, dst=img)
+                img = cv2.cvtColor(img, cv2.COLOR_HSV2BGR)
+            if post_on[i]:
+                img = cv2.LUT(img, post[i])
+            if reorder[i]:
+                c = channels[i]
+                cv2.mixChannels([img], [output[i]],
+                                [c[0], 0, c[1], 1, c[2], 2])
+            else:
+                output[i] = img
+
+        return output
+
+#-------------------------------------------------------------------------------
+
+
+def props2boxes(boxes, props):
+    """
+    Make a list of boxes with the labels of the given boxes and the new params
+    """
+    return [Box(box.label, box.labelid, Point(p[0], p[1]), Size(p[2], p[3]))
+            for box, p in zip(boxes, props.tolist())]
+
+#-------------------------------------------------------------------------------
+
+
+def transform_box(box, orig_size, new_size, h_off, w_off):
+    boxes = transform_gt(Sample(None, [box], orig_size), new_size, h_off,
+                         w_off).boxes
+    return boxes[0] if boxes else None
 
 #-------------------------------------------------------------------------------
 
 
 def transform_gt(gt, new_size, h_off, w_off):
-    boxes = []
-    for box in gt.boxes:
-        box = transform_box(box, gt.imgsize, new_size, h_off, w_off)
-        if box is None:
-            continue
-        boxes.append(box)
-    return Sample(gt.filename, boxes, new_size)
+    if not gt.boxes:
+        return Sample(gt.filename, [], new_size)
+
+    props, keep = transform_props(anchors2prop(gt.boxes), gt.imgsize,
+                                  new_size, h_off, w_off)
+    boxes = [box for box, k in zip(gt.boxes, keep) if k]
+    return Sample(gt.filename, props2boxes(boxes, props[keep]), new_size)
 
 #-------------------------------------------------------------------------------
 
@@ -298,29 +951,45 @@ class ExpandTransform(Transform):
     Parameters: max_ratio, mean_value
     """
 
-    def __call__(self, data, label, gt):
-        #-----------------------------------------------------------------------
-        # Calculate sizes and offsets
-        #-----------------------------------------------------------------------
+    #---------------------------------------------------------------------------
+    def plan(self, gt):
+        """
+        Sample the size of the expanded image and the position of the input
+        image in it
+        :return: a tuple of (gt, h_off, w_off) with the transformed ground
+                 truth
+        """
         ratio = random.uniform(1, self.max_ratio)
         orig_size = gt.imgsize
         new_size = Size(int(orig_size.w*ratio), int(orig_size.h*ratio))
         h_off = random.randint(0, new_size.h-orig_size.h)
         w_off = random.randint(0, new_size.w-orig_size.w)
+        return transform_gt(gt, new_size, h_off, w_off), h_off, w_off
 
+    #---------------------------------------------------------------------------
+    def prepare(self, label, gt):
         #-----------------------------------------------------------------------
-        # Create the new image and place the input image in it
+        # Calculate sizes and offsets
         #-----------------------------------------------------------------------
-        img = np.zeros((new_size.h, new_size.w, 3))
-        img[:, :] = np.array(self.mean_value)
-        img[h_off:h_off+orig_size.h, w_off:w_off+orig_size.w, :] = data
+        orig_size = gt.imgsize
+        gt, h_off, w_off = self.plan(gt)
+        new_size = gt.imgsize
 
         #-----------------------------------------------------------------------
-        # Transform the ground truth
+        # Create the new image and place the input image in it
         #-----------------------------------------------------------------------
-        gt = transform_gt(gt, new_size, h_off, w_off)
+        def step(data):
+            img = np.zeros((new_size.h, new_size.w, 3))
+            img[:, :] = np.array(self.mean_value)
+            img[h_off:h_off+orig_size.h, w_off:w_off+orig_size.w, :] = data
+            return img
+
+        return label, gt, step
 
-        return img, label, gt
+    #---------------------------------------------------------------------------
+    def __call__(self, data, label, gt):
+        label, gt, step = self.prepare(label, gt)
+        return step(data), label, gt
 
 #-------------------------------------------------------------------------------
 
@@ -332,59 +1001,84 @@ class SamplerTransform(Transform):
             min_jaccard_overlap
     """
 
-    def __call__(self, data, label, gt):
+    #---------------------------------------------------------------------------
+    def plan(self, gt):
+        """
+        Sample the crop
+        :return: None if no crop satisfies the constraints or a tuple of
+                 (gt, crop) with the transformed ground truth and a
+                 [xmin, xmax, ymin, ymax] array of the crop bounds
+        """
         #-----------------------------------------------------------------------
         # Check whether to sample or not
         #-----------------------------------------------------------------------
         if not self.sample:
-            return data, label, gt
+            crop = np.array([0, gt.imgsize.w, 0, gt.imgsize.h])
+            return gt, crop
 
         #-----------------------------------------------------------------------
-        # Retry sampling a couple of times
+        # Sample all the trial boxes at once
+        #-----------------------------------------------------------------------
+        trials = [random.random() for _ in range(4*self.max_trials)]
+        trials = np.array(trials).reshape(self.max_trials, 4)
+        scale = self.min_scale + (self.max_scale-self.min_scale)*trials[:, 0]
+        aspect_ratio = self.min_aspect_ratio + \
+            (self.max_aspect_ratio-self.min_aspect_ratio)*trials[:, 1]
+
+        # make sure width and height will not be larger than 1
+        aspect_ratio = np.maximum(aspect_ratio, scale**2)
+        aspect_ratio = np.minimum(aspect_ratio, 1/(scale**2))
+
+        props = np.empty((self.max_trials, 4))
+        props[:, 2] = scale*np.sqrt(aspect_ratio)
+        props[:, 3] = scale/np.sqrt(aspect_ratio)
+        props[:, 0] = 0.5*props[:, 2] + (1-props[:, 2])*trials[:, 2]
+        props[:, 1] = 0.5*props[:, 3] + (1-props[:, 3])*trials[:, 3]
+
         #-----------------------------------------------------------------------
+        # Pick the first box that satisfies the jaccard overlap constraint
+        # with its best matching ground truth box
+        #-----------------------------------------------------------------------
+        if not gt.boxes:
+            return None
+
+        crops = props2corners(props, gt.imgsize)
         source_boxes = anchors2array(gt.boxes, gt.imgsize)
-        box = None
-        box_arr = None
-        for _ in range(self.max_trials):
-            #-------------------------------------------------------------------
-            # Sample a bounding box
-            #-------------------------------------------------------------------
-            scale = random.uniform(self.min_scale, self.max_scale)
-            aspect_ratio = random.uniform(self.min_aspect_ratio,
-                                          self.max_aspect_ratio)
-
-            # make sure width and height will not be larger than 1
-            aspect_ratio = max(aspect_ratio, scale**2)
-            aspect_ratio = min(aspect_ratio, 1/(scale**2))
-
-            width = scale*sqrt(aspect_ratio)
-            height = scale/sqrt(aspect_ratio)
-            cx = 0.5*width + random.uniform(0, 1-width)
-            cy = 0.5*height + random.uniform(0, 1-height)
-            center = Point(cx, cy)
-            size = Size(width, height)
-
-            #-------------------------------------------------------------------
-            # Check if the box satisfies the jaccard overlap constraint
-            #-------------------------------------------------------------------
-            box_arr = np.array(prop2abs(center, size, gt.imgsize))
-            overlap = compute_overlap(box_arr, source_boxes, 0)
-            if overlap.best and overlap.best.score >= self.min_jaccard_overlap:
-                box = Box(None, None, center, size)
-                break
-
-        if box is None:
+        best = np.max(jaccard_overlap_matrix(crops, source_boxes), axis=1)
+        accepted = np.nonzero((best > 0) &
+                              (best >= self.min_jaccard_overlap))[0]
+        if not len(accepted):
             return None
+        box_arr = crops[accepted[0]].astype(np.int64)
 
         #-----------------------------------------------------------------------
-        # Crop the box and adjust the ground truth
+        # Adjust the ground truth to the crop
         #-----------------------------------------------------------------------
         new_size = Size(box_arr[1]-box_arr[0], box_arr[3]-box_arr[2])
         w_off = -box_arr[0]
         h_off = -box_arr[2]
-        data = data[box_arr[2]:box_arr[3], box_arr[0]:box_arr[1]]
-        gt = transform_gt(gt, new_size, h_off, w_off)
+        return transform_gt(gt, new_size, h_off, w_off), box_arr
 
+    #---------------------------------------------------------------------------
+    def prepare(self, label, gt):
+        result = self.plan(gt)
+        if result is None:
+            raise RuntimeError('Unable to sample a crop of: '+gt.filename)
+
+        gt, box_arr = result
+
+        def step(data):
+            return data[box_arr[2]:box_arr[3], box_arr[0]:box_arr[1]]
+        return label, gt, step
+
+    #---------------------------------------------------------------------------
+    def __call__(self, data, label, gt):
+        result = self.plan(gt)
+        if result is None:
+            return None
+
+        gt, box_arr = result
+        data = data[box_arr[2]:box_arr[3], box_arr[0]:box_arr[1]]
         return data, label, gt
 
 #-------------------------------------------------------------------------------
@@ -392,17 +1086,50 @@ class SamplerTransform(Transform):
 
 class SamplePickerTransform(Transform):
     """
-    Run a bunch of sample transforms and return one of the produced samples
+    Run the sample transforms in random order and return the first produced
+    sample
     Parameters: samplers
     """
 
+    #---------------------------------------------------------------------------
+    def plan(self, gt):
+        """
+        Pick a sampler at random and plan its crop, falling back to the other
+        samplers in random order if it fails. The result has the same
+        distribution as picking one of the successful crops of all the
+        samplers.
+        :return: a tuple of (gt, crop) as returned by SamplerTransform.plan
+        """
+        order = list(range(len(self.samplers)))
+        random.shuffle(order)
+        for i in order:
+            plan = self.samplers[i].plan(gt)
+            if plan is not None:
+                return plan
+        raise RuntimeError('None of the samplers produced a crop')
+
+    #---------------------------------------------------------------------------
+    def prepare(self, label, gt):
+        gt, box_arr = self.plan(gt)
+
+        def step(data):
+            return data[box_arr[2]:box_arr[3], box_arr[0]:box_arr[1]]
+        return label, gt, step
+
+    #---------------------------------------------------------------------------
     def __call__(self, data, label, gt):
-        samples = []
-        for sampler in self.samplers:
-            sample = sampler(data, label, gt)
-            if sample is not None:
-                samples.append(sample)
-        return random.choice(samples)
+        label, gt, step = self.prepare(label, gt)
+        return step(data), label, gt
+
+#-------------------------------------------------------------------------------
+
+
+def flip_gt(gt):
+    """
+    Flip the ground truth boxes horizontally
+    """
+    props = flip_props(anchors2prop(gt.boxes))
+    return Sample(gt.filename, props2boxes(gt.boxes, props), gt.imgsize)
 
 #-------------------------------------------------------------------------------
 
@@ -413,12 +1140,145 @@ class HorizontalFlipTransform(Transform):
     """
 
     def __call__(self, data, label, gt):
-        data = cv2.flip(data, 1)
-        boxes = []
-        for box in gt.boxes:
-            center = Point(1-box.center.x, box.center.y)
-            box = Box(box.label, box.labelid, center, box.size)
-            boxes.append(box)
-        gt = Sample(gt.filename, boxes, gt.imgsize)
+        return cv2.flip(data, 1), label, flip_gt(gt)
 
-        return data, label, gt
+    def prepare(self, label, gt):
+        return label, flip_gt(gt), lambda data: cv2.flip(data, 1)
+
+#-------------------------------------------------------------------------------
+
+
+class GeometricTransform(Transform):
+    """
+    Expand, crop, flip and resize the image with one affine warp. The whole
+    geometry is planned on the ground truth first, drawing the random
+    numbers in the same order as the separate transforms do, and then the
+    input image is warped straight into the output size, filling the space
+    around it with the mean value and keeping the image in uint8. Warping
+    cannot average areas, so with INTER_AREA the image gets resized by area
+    to the output scale first.
+    Parameters: expand_prob, expand (ExpandTransform), sampler
+                (SamplePickerTransform), flip_prob, width, height, algorithms
+    """
+
+    #---------------------------------------------------------------------------
+    def plan(self, gt):
+        """
+        Plan the geometric transformation
+        :return: a tuple of (gt, matrix, algorithm) where the matrix maps
+                 the pixels of the input image to the pixels of the output
+        """
+        #-----------------------------------------------------------------------
+        # Place the image in an expanded frame and pick the crop in it
+        #-----------------------------------------------------------------------
+        h_off = w_off = 0
+        if random.uniform(0, 1) < self.expand_prob:
+            gt, h_off, w_off = self.expand.plan(gt)
+        gt, crop = self.sampler.plan(gt)
+
+        flip = random.uniform(0, 1) < self.flip_prob
+        if flip:
+            gt = flip_gt(gt)
+
+        algorithm = random.choice(self.algorithms)
+
+        #-----------------------------------------------------------------------
+        # Compose the offsets, the flip and the scaling. The scaling maps
+        # pixel centers onto pixel centers like cv2.resize does.
+        #-----------------------------------------------------------------------
+        crop_w = float(crop[1]-crop[0])
+        crop_h = float(crop[3]-crop[2])
+        sx = self.width/crop_w
+        sy = self.height/crop_h
+        x_off = w_off-crop[0]
+        y_off = h_off-crop[2]
+        if flip:
+            matrix = [[-sx, 0, (crop_w-0.5-x_off)*sx-0.5],
+                      [0, sy, (y_off+0.5)*sy-0.5]]
+        else:
+            matrix = [[sx, 0, (x_off+0.5)*sx-0.5],
+                      [0, sy, (y_off+0.5)*sy-0.5]]
+
+        return gt, np.array(matrix, dtype=np.float64), algorithm
+
+    #---------------------------------------------------------------------------
+    def warp(self, data, matrix, algorithm):
+        #-----------------------------------------------------------------------
+        # Shrink the image by area to the output scale and leave the offsets,
+        # the flip and the rounding of the size to a linear warp
+        #-----------------------------------------------------------------------
+        if algorithm == cv2.INTER_AREA:
+            algorithm = cv2.INTER_LINEAR
+            h, w = data.shape[:2]
+            new_w = min(max(int(round(w*abs(matrix[0, 0]))), 1), w)
+            new_h = min(max(int(round(h*abs(matrix[1, 1]))), 1), h)
+            if new_w != w or new_h != h:
+                data = cv2.resize(data, (new_w, new_h),
+                                  interpolation=cv2.INTER_AREA)
+                rx = w/float(new_w)
+                ry = h/float(new_h)
+                matrix = matrix.dot([[rx, 0, 0.5*rx-0.5],
+                                     [0, ry, 0.5*ry-0.5],
+                                     [0, 0, 1]])
+
+        return cv2.warpAffine(data, matrix, (self.width, self.height),
+                              flags=algorithm,
+                              borderMode=cv2.BORDER_CONSTANT,
+                              borderValue=[float(x) for x in
+                                           self.expand.mean_value])
+
+    #---------------------------------------------------------------------------
+    def prepare(self, label, gt):
+        imgsize = gt.imgsize
+        gt, matrix, algorithm = self.plan(gt)
+        return label, gt, WarpStep(self, matrix, algorithm, imgsize)
+
+    #---------------------------------------------------------------------------
+    def __call__(self, data, label, gt):
+        label, gt, step = self.prepare(label, gt)
+        return step(data), label, gt
+
+#-------------------------------------------------------------------------------
+
+
+class WarpStep:
+    """
+    Image step of the GeometricTransform
+    """
+
+    #---------------------------------------------------------------------------
+    def __init__(self, transform, matrix, algorithm, imgsize):
+        self.transform = transform
+        self.matrix = matrix
+        self.algorithm = algorithm
+        self.imgsize = imgsize
+
+    #---------------------------------------------------------------------------
+    @property
+    def name(self):
+        return 'GeometricTransform(algorithm={})'.format(self.algorithm)
+
+    #---------------------------------------------------------------------------
+    def source_request(self):
+        """
+        Map the output frame back onto the input image
+        :return: a tuple of (region, scale) as taken by LoadStep.request
+        """
+        inverse = cv2.invertAffineTransform(self.matrix)
+        w = self.transform.width
+        h = self.transform.height
+        corners = np.array([[-0.5, -0.5, 1], [w-0.5, h-0.5, 1]])
+        corners = corners.dot(inverse.T)
+        region = [max(corners[:, 0].min(), 0),
+                  min(corners[:, 0].max(), self.imgsize.w),
+                  max(corners[:, 1].min(), 0),
+                  min(corners[:, 1].max(), self.imgsize.h)]
+        return region, (self.matrix[0, 0], self.matrix[1, 1])
+
+    #---------------------------------------------------------------------------
+    def rebase(self, reduction, offset):
+        self.matrix = self.matrix.dot(reduction_matrix(reduction, offset))
+
+    #---------------------------------------------------------------------------
+    def __call__(self, data):
+        return self.transform.warp(data, self.matrix, self.algorithm)
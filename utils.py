@@ -1,12 +1,20 @@
 import argparse
-import math
 import cv2
 
-import tensorflow as tf
 import numpy as np
 
+try:
+    import tensorflow as tf
+except ImportError:
+    # only the summaries and the variable initialization need tensorflow,
+    # the box utilities and the benchmarks run without it
+    tf = None
+
 from collections import namedtuple
 
+from geometry import props2corners, corners2props, valid_props
+from geometry import normalize_props
+
 #-------------------------------------------------------------------------------
 
 
@@ -77,15 +85,8 @@ def abs2prop(xmin, xmax, ymin, ymax, imgsize):
     """
     Convert the absolute min-max box bound to proportional center-width bounds
     """
-    width = float(xmax-xmin)
-    height = float(ymax-ymin)
-    cx = float(xmin)+width/2
-    cy = float(ymin)+height/2
-    width /= imgsize.w
-    height /= imgsize.h
-    cx /= imgsize.w
-    cy /= imgsize.h
-    return Point(cx, cy), Size(width, height)
+    props = corners2props([[xmin, xmax, ymin, ymax]], imgsize)[0]
+    return Point(*props[:2]), Size(*props[2:])
 
 #-------------------------------------------------------------------------------
 
@@ -94,20 +95,16 @@ def prop2abs(center, size, imgsize):
     """
     Convert proportional center-width bounds to absolute min-max bounds
     """
-    width2 = size.w*imgsize.w/2
-    height2 = size.h*imgsize.h/2
-    cx = center.x*imgsize.w
-    cy = center.y*imgsize.h
-    return int(cx-width2), int(cx+width2), int(cy-height2), int(cy+height2)
+    props = [[center.x, center.y, size.w, size.h]]
+    corners = props2corners(props, imgsize)[0]
+    return tuple(int(x) for x in corners)
 
 #-------------------------------------------------------------------------------
 
 
 def box_is_valid(box):
-    for x in [box.center.x, box.center.y, box.size.w, box.size.h]:
-        if math.isnan(x) or math.isinf(x):
-            return False
-    return True
+    props = [[box.center.x, box.center.y, box.size.w, box.size.h]]
+    return bool(valid_props(props)[0])
 
 #-------------------------------------------------------------------------------
 
@@ -116,32 +113,19 @@ def normalize_box(box):
     if not box_is_valid(box):
         return box
 
-    img_size = Size(1000, 1000)
-    xmin, xmax, ymin, ymax = prop2abs(box.center, box.size, img_size)
-    xmin = max(xmin, 0)
-    xmax = min(xmax, img_size.w-1)
-    ymin = max(ymin, 0)
-    ymax = min(ymax, img_size.h-1)
-
-    # this happens early in the training when box min and max are outside
-    # of the image
-    xmin = min(xmin, xmax)
-    ymin = min(ymin, ymax)
-
-    center, size = abs2prop(xmin, xmax, ymin, ymax, img_size)
-    return Box(box.label, box.labelid, center, size)
+    props = [[box.center.x, box.center.y, box.size.w, box.size.h]]
+    props = normalize_props(props)[0]
+    return Box(box.label, box.labelid, Point(*props[:2]), Size(*props[2:]))
 
 #-------------------------------------------------------------------------------
 
 
-def draw_box(img, box, color):
-    img_size = Size(img.shape[1], img.shape[0])
-    xmin, xmax, ymin, ymax = prop2abs(box.center, box.size, img_size)
+def draw_labeled_rect(img, xmin, xmax, ymin, ymax, label, color):
     img_box = np.copy(img)
     cv2.rectangle(img_box, (xmin, ymin), (xmax, ymax), color, 2)
     cv2.rectangle(img_box, (xmin-1, ymin), (xmax+1, ymin-20), color, cv2.FILLED)
     font = cv2.FONT_HERSHEY_SIMPLEX
-    cv2.putText(img_box, box.label, (xmin+5, ymin-5), font, 0.5,
+    cv2.putText(img_box, label, (xmin+5, ymin-5), font, 0.5,
                 (255, 255, 255), 1, cv2.LINE_AA)
     alpha = 0.8
     cv2.addWeighted(img_box, alpha, img, 1.-alpha, 0, img)
@@ -149,6 +133,27 @@ def draw_box(img, box, color):
 #-------------------------------------------------------------------------------
 
 
+def draw_box(img, box, color):
+    img_size = Size(img.shape[1], img.shape[0])
+    xmin, xmax, ymin, ymax = prop2abs(box.center, box.size, img_size)
+    draw_labeled_rect(img, xmin, xmax, ymin, ymax, box.label, color)
+
+#-------------------------------------------------------------------------------
+
+
+def draw_detections(img, detections, colors, lid2name):
+    """
+    Draw the Detections of an image
+    """
+    img_size = Size(img.shape[1], img.shape[0])
+    corners = detections.abs_corners(img_size)
+    for i, name in enumerate(detections.label_names(lid2name)):
+        xmin, xmax, ymin, ymax = [int(x) for x in corners[i]]
+        draw_labeled_rect(img, xmin, xmax, ymin, ymax, name, colors[name])
+
+#-------------------------------------------------------------------------------
+
+
 class PrecisionSummary:
     #---------------------------------------------------------------------------
     def __init__(self, session, writer, sample_name, labels, restore=False):
@@ -204,10 +209,12 @@ class PrecisionSummary:
 
 class ImageSummary:
     #---------------------------------------------------------------------------
-    def __init__(self, session, writer, sample_name, colors, restore=False):
+    def __init__(self, session, writer, sample_name, colors, lid2name,
+                 restore=False):
         self.session = session
         self.writer = writer
         self.colors = colors
+        self.lid2name = lid2name
 
         sess = session
         sum_name = sample_name+'_img'
@@ -226,8 +233,7 @@ class ImageSummary:
         imgs = np.zeros((3, 512, 512, 3))
         for i, sample in enumerate(samples):
             img = cv2.resize(sample[0], (512, 512))
-            for _, box in sample[1]:
-                draw_box(img, box, self.colors[box.label])
+            draw_detections(img, sample[1], self.colors, self.lid2name)
             img[img > 255] = 255
             img[img < 0] = 0
             imgs[i] = cv2.cvtColor(img.astype(np.uint8), cv2.COLOR_BGR2RGB)
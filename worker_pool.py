@@ -0,0 +1,225 @@
+import atexit
+import cv2
+import os
+
+import multiprocessing as mp
+
+from data_queue import DataQueue
+from sparse_labels import SparseLabels
+from transforms import Transform
+from transform_profiler import TransformProfiler
+
+#-------------------------------------------------------------------------------
+
+
+class WorkerPool:
+    """
+    Batch producing processes that live as long as the pool does. The work
+    comes in epoch-scoped streams of (samples, batches) jobs, where the
+    batches are lists of indices to the samples, like the ones made by
+    TrainingData. The samples get scheduled to the workers one by one, so
+    that a slow one doesn't hold any other up, and the batches are
+    assembled here.
+
+    Every batch gets a slot of the ring leased before its samples are
+    scheduled. The workers write the images straight into their places in
+    the slot and send back the labels and the boxes. The batches are
+    yielded as soon as all their samples are done, so the order can change
+    within the window of the leased slots.
+
+    A sample is processed by the function registered under the name of its
+    stream. The functions need to be in the processors dictionary before
+    the pool is made, since the workers get everything they use when they
+    are forked. A function gets the sample and the number of its views and
+    yields an (image, SparseLabels, boxes) tuple per view.
+    """
+
+    #---------------------------------------------------------------------------
+    def __init__(self, processors, img_template, num_workers):
+        self.processors = processors
+        self.num_workers = num_workers
+        self.img_shape = img_template.shape
+        self.num_slots = num_workers*5
+        self.job_queue = mp.Queue()
+        self.result_queue = mp.Queue()
+        self.batch_queue = DataQueue(img_template, self.num_slots)
+        self.stats_queue = mp.Queue(num_workers)
+        self.barrier = mp.Barrier(num_workers)
+        self.run_id = mp.Value('i', 0)
+        self.pending = 0
+        self.leased = set()
+
+        #-----------------------------------------------------------------------
+        # Make sure we can fork safely even if OpenCV has been compiled with
+        # CUDA and multi-threading support.
+        #-----------------------------------------------------------------------
+        self.workers = []
+        os.environ['CUDA_VISIBLE_DEVICES'] = ""
+        cv2_num_threads = cv2.getNumThreads()
+        cv2.setNumThreads(1)
+        for i in range(num_workers):
+            w = mp.Process(target=self.__work)
+            w.daemon = True
+            self.workers.append(w)
+            w.start()
+        del os.environ['CUDA_VISIBLE_DEVICES']
+        cv2.setNumThreads(cv2_num_threads)
+        atexit.register(self.close)
+
+    #---------------------------------------------------------------------------
+    def __work(self):
+        if Transform.profiler is not None:
+            Transform.profiler = TransformProfiler()
+
+        while True:
+            task = self.job_queue.get()
+            if task is None:
+                break
+
+            #-------------------------------------------------------------------
+            # Hand the profile over and wait for the other workers, so that
+            # every one of them gets exactly one flush request
+            #-------------------------------------------------------------------
+            if task == 'flush':
+                stats = {}
+                if Transform.profiler is not None:
+                    stats = Transform.profiler.stats
+                    Transform.profiler.clear()
+                self.stats_queue.put(stats)
+                self.barrier.wait()
+                continue
+
+            #-------------------------------------------------------------------
+            # Skip the samples of the streams the consumer has given up on,
+            # but answer anyway, so that it knows when the slots are no
+            # longer written to
+            #-------------------------------------------------------------------
+            run_id, stream, sample, places = task
+            if run_id != self.run_id.value:
+                self.result_queue.put([])
+                continue
+
+            results = []
+            views = self.processors[stream](sample, len(places))
+            for (slot_id, pos), (image, label, boxes) in zip(places, views):
+                self.batch_queue.slots[slot_id][pos] = image
+                results.append((slot_id, pos, label, boxes))
+            self.result_queue.put(results)
+
+    #---------------------------------------------------------------------------
+    def __drain(self):
+        #-----------------------------------------------------------------------
+        # Wait for the samples of an abandoned stream and take its slots back
+        #-----------------------------------------------------------------------
+        with self.run_id.get_lock():
+            self.run_id.value += 1
+        while self.pending:
+            self.result_queue.get()
+            self.pending -= 1
+        for slot_id in self.leased:
+            self.batch_queue.release(slot_id)
+        self.leased = set()
+
+    #---------------------------------------------------------------------------
+    def __lease(self):
+        slot_id, _ = self.batch_queue.lease()
+        self.leased.add(slot_id)
+        return slot_id
+
+    #---------------------------------------------------------------------------
+    def __release(self, slot_id):
+        self.leased.remove(slot_id)
+        self.batch_queue.release(slot_id)
+
+    #---------------------------------------------------------------------------
+    def run(self, stream, jobs):
+        """
+        Process a stream of jobs, abandoning the previous one if it has not
+        been read to the end
+        :return: a generator of (images, labels, boxes) tuples, where the
+                 images are a view valid until the next batch is requested
+                 and the labels are SparseLabels
+        """
+        self.__drain()
+        run_id = self.run_id.value
+
+        #-----------------------------------------------------------------------
+        # Keep one slot for the batch the consumer holds
+        #-----------------------------------------------------------------------
+        window = self.num_slots-1
+        if any(len(job[1]) > window for job in jobs):
+            raise ValueError('a job can have at most {} batches'
+                             .format(window))
+
+        batches = {}
+        held = None
+        next_job = 0
+        while next_job < len(jobs) or batches:
+            #-------------------------------------------------------------------
+            # Schedule the samples of as many jobs as there are free slots
+            # for their batches
+            #-------------------------------------------------------------------
+            while next_job < len(jobs) and \
+                  len(batches)+len(jobs[next_job][1]) <= window:
+                samples, job_batches = jobs[next_job]
+                next_job += 1
+                places = [[] for _ in samples]
+                for batch in job_batches:
+                    slot_id = self.__lease()
+                    batches[slot_id] = [len(batch), [None]*len(batch),
+                                        [None]*len(batch)]
+                    for pos, i in enumerate(batch):
+                        places[i].append((slot_id, pos))
+
+                for sample, sample_places in zip(samples, places):
+                    if sample_places:
+                        self.job_queue.put((run_id, stream, sample,
+                                            sample_places))
+                        self.pending += 1
+
+            #-------------------------------------------------------------------
+            # Collect a sample and pass its batches on if they are complete
+            #-------------------------------------------------------------------
+            results = self.result_queue.get()
+            self.pending -= 1
+            for slot_id, pos, label, boxes in results:
+                batch = batches[slot_id]
+                batch[0] -= 1
+                batch[1][pos] = label
+                batch[2][pos] = boxes
+                if batch[0]:
+                    continue
+
+                del batches[slot_id]
+                if held is not None:
+                    self.__release(held)
+                held = slot_id
+                num_items = len(batch[1])
+                yield (self.batch_queue.slots[slot_id][:num_items],
+                       SparseLabels.stack(batch[1]), batch[2])
+
+        if held is not None:
+            self.__release(held)
+
+    #---------------------------------------------------------------------------
+    def collect_stats(self):
+        """
+        Collect the transform profiles of all the workers
+        :return: a list of TransformProfiler stats, one per worker
+        """
+        for _ in self.workers:
+            self.job_queue.put('flush')
+        return [self.stats_queue.get() for _ in self.workers]
+
+    #---------------------------------------------------------------------------
+    def close(self):
+        if not self.workers:
+            return
+
+        self.__drain()
+        for _ in self.workers:
+            self.job_queue.put(None)
+        for w in self.workers:
+            w.join()
+        self.workers = []
+        self.batch_queue.close()